@@ -29,8 +29,12 @@ lookup <lang dependent files> | lookup2cg |
 vislcg3 <disambiguation files> | vislcg3 <function files |
 vislcg3 <dependency files>
 '''
+import collections
+import distutils.dep_util
 import os
+import re
 import sys
+import time
 import subprocess
 import multiprocessing
 import lxml.etree as etree
@@ -42,19 +46,69 @@ import argparse_version
 import util
 
 
+class AnalysisTimeout(Exception):
+    '''Raised when the tools spend too long on an analysis'''
+    pass
+
+
 class Analyser(object):
     '''A class which can analyse giellatekno xml formatted documents
     using preprocess, lookup, lookup2cg and vislcg3
     '''
+    # Separates the documents of a batch in the input of the tools.
+    # lookup2cg turns it into a cohort, which is replaced by the flush
+    # command of vislcg3 before the cg stages. vislcg3 passes the flush
+    # command on to its output, where the batch is split again.
+    delimiter = b'<SKIP/>'
+    # apertium-deshtml hides markup like the delimiter from hfst-proc,
+    # so with hfst the documents are separated by a word no fst knows.
+    hfst_delimiter = b'CorpusToolsBatchDelimiter'
+    flush = b'<STREAMCMD:FLUSH>'
+    # The memory a run of a tool needs, in multiples of the size of the
+    # fst or grammar file it loads.
+    memory_factor = 2
+    # The number of files sent through each run of the tools, unless the
+    # tools are piped.
+    default_batch_size = 20
+
     def __init__(self, lang,
                  fstkit,
                  fst_file,
                  disambiguation_analysis_file,
                  function_analysis_file,
-                 dependency_analysis_file):
+                 dependency_analysis_file,
+                 batch_size=None,
+                 pipe=False,
+                 jobs=None,
+                 timeout=None):
         '''Set the files needed by preprocess, lookup and vislcg3
+
+        batch_size is the number of files that are sent through each run
+        of the tools, so that the fst and the grammars are only loaded
+        once per batch. If it is None, it is default_batch_size, or 1 if
+        pipe is True.
+
+        If pipe is True, files that are analysed one by one are sent
+        through the tools connected by OS pipes.
+
+        jobs is the number of files or batches that are analysed at the
+        same time by analyse_in_parallel. If it is None, it is found
+        from the number of cpus and the available memory.
+
+        timeout is the number of seconds the tools may spend on a file
+        before they are killed. If it is None, they are never killed.
         '''
         self.lang = lang
+        if batch_size is None:
+            batch_size = 1 if pipe else self.default_batch_size
+        self.batch_size = batch_size
+        self.pipe = pipe
+        self.jobs = jobs
+        self.timeout = timeout
+        self.deadline = None
+        self.xml_file = None
+        self.batch_files = None
+        self.timings = util.Timings()
         self.xml_printer = ccat.XMLPrinter(lang=lang, all_paragraphs=True)
         self.fstkit = fstkit
 
@@ -74,28 +128,92 @@ class Analyser(object):
         if not os.path.exists(filename):
             raise(util.ArgumentError('ERROR: {} does not exist'.format(filename)))
 
-    def collect_files(self, converted_dirs):
+    @property
+    def dependencies(self):
+        '''The files every analysis depends on'''
+        return [self.fst_file,
+                self.disambiguation_analysis_file,
+                self.function_analysis_file,
+                self.dependency_analysis_file]
+
+    @staticmethod
+    def analysis_name(xml_file):
+        '''Return the name of the analysed version of xml_file'''
+        return xml_file.replace('converted/', 'analysed/')
+
+    @classmethod
+    def marker_name(cls, xml_file):
+        '''Return the name of the file that records that xml_file had
+        nothing to analyse'''
+        return cls.analysis_name(xml_file) + '.unanalysed'
+
+    def outcome_name(self, xml_file):
+        '''Return the file that records the last analysis of xml_file
+
+        That is the analysed file or the marker, whichever is newer.
+        '''
+        names = [name for name in (self.analysis_name(xml_file),
+                                   self.marker_name(xml_file))
+                 if os.path.exists(name)]
+        if len(names) > 0:
+            return max(names, key=os.path.getmtime)
+        else:
+            return self.analysis_name(xml_file)
+
+    def is_stale(self, xml_file):
+        '''Check if xml_file must be analysed
+
+        That is when neither its analysed file nor its marker exist, or
+        they are older than xml_file or than any of the fst and grammar
+        files.
+        '''
+        return distutils.dep_util.newer_group(
+            [xml_file] + self.dependencies, self.outcome_name(xml_file))
+
+    def record_outcome(self, result):
+        '''Write a marker for OCR files and files without text
+
+        They get no analysed file, the marker makes them count as up to
+        date in the next run.
+        '''
+        if result['status'] in ('empty', 'ocr'):
+            marker = self.marker_name(result['xml_file'])
+            self.makedirs(marker)
+            with open(marker, 'w') as marker_file:
+                marker_file.write(result['status'] + '\n')
+
+    def collect_files(self, converted_dirs, force=True):
         '''converted_dirs is a list of directories containing converted
         xml files
+
+        Unless force is True, files whose analysis is up to date are
+        left out, and counted in self.uptodate.
         '''
         self.xml_files = []
+        self.uptodate = 0
         for cdir in converted_dirs:
             if os.path.isfile(cdir):
-                self.append_file(cdir)
+                self.append_file(cdir, force)
             else:
                 for root, dirs, files in os.walk(cdir):
                     for xml_file in files:
                         if self.lang in root and xml_file.endswith('.xml'):
-                            self.append_file(os.path.join(root, xml_file))
+                            self.append_file(os.path.join(root, xml_file),
+                                             force)
 
-    def append_file(self, xml_file):
+    def append_file(self, xml_file, force=True):
         '''Append xml_file to the xml_files list'''
         try:
-            self.xml_files.append(
-                unicode(xml_file, sys.getfilesystemencoding()))
+            if not isinstance(xml_file, unicode):
+                xml_file = unicode(xml_file, sys.getfilesystemencoding())
         except UnicodeDecodeError:
                 print >>sys.stderr, (
                     'Could not handle the file name {}'.format(xml_file))
+        else:
+            if force or self.is_stale(xml_file):
+                self.xml_files.append(xml_file)
+            else:
+                self.uptodate += 1
 
     @staticmethod
     def makedirs(filename):
@@ -106,10 +224,46 @@ class Analyser(object):
         except OSError:
             pass
 
+    @property
+    def xml_file(self):
+        '''The document that is analysed'''
+        return self._xml_file
+
+    @xml_file.setter
+    def xml_file(self, xml_file):
+        '''Set the document to analyse, forgetting the outputs of the
+        previous one
+        '''
+        self._xml_file = xml_file
+        self.outputs = {}
+
+    def stage(self, name, previous, run):
+        '''Return the output of the stage name for the current document
+
+        The stage runs run on the output of the function previous. If
+        the output of previous is None, so is the output of the stage.
+
+        The output is remembered, so each stage runs once per document.
+        The time spent in run is added to self.timings as name.
+        '''
+        try:
+            return self.outputs[name]
+        except KeyError:
+            output = previous()
+            if output is not None:
+                with self.timings.timer(name):
+                    output = run(output)
+            self.outputs[name] = output
+            return output
+
     def ccat(self):
         """Turn an xml formatted file into clean text
         """
-        self.xml_printer.parse_file(self.xml_file.get_name())
+        return self.stage('ccat', self.xml_file.get_name, self.run_ccat)
+
+    def run_ccat(self, filename):
+        '''Return the text of filename, or None if it has no text'''
+        self.xml_printer.parse_file(filename)
         text = self.xml_printer.process_file().getvalue()
         if len(text) > 0:
             return text
@@ -118,99 +272,166 @@ class Analyser(object):
         '''Run the command with input using subprocess
         '''
         runner = util.ExternalCommandRunner()
-        runner.run(command, to_stdin=input)
+        runner.run(command, to_stdin=input, timeout=self.time_left())
+        if runner.timed_out:
+            raise AnalysisTimeout('{} timed out'.format(command[0]))
         self.check_error(command, runner.stderr)
 
         return runner.stdout
 
+    def time_left(self):
+        '''The number of seconds left before self.deadline
+
+        Returns None if there is no deadline
+        '''
+        if self.deadline is not None:
+            return max(0, self.deadline - time.time())
+
     def preprocess(self):
         """Runs preprocess on the ccat output.
         Returns the output of preprocess
         """
-        pre_process_command = util.get_preprocess_command(self.lang)
+        return self.stage('preprocess', self.ccat, self.run_preprocess)
 
-        text = self.ccat()
-        if text is not None:
-            return self.run_external_command(pre_process_command, text)
+    def run_preprocess(self, text):
+        '''Run preprocess on text'''
+        return self.run_external_command(self.preprocess_command(), text)
+
+    def preprocess_command(self):
+        return util.get_preprocess_command(self.lang)
 
     def lookup(self):
         """Runs lookup on the preprocess output
         Returns the output of preprocess
         """
-        lookup_command = ['lookup', '-q', '-flags', 'mbTT', self.fst_file]
+        return self.stage('lookup', self.preprocess, self.run_lookup)
 
-        preprocess = self.preprocess()
-        if preprocess is not None:
-            return self.run_external_command(lookup_command, preprocess)
+    def run_lookup(self, preprocess):
+        '''Run lookup on the output of preprocess'''
+        return self.run_external_command(self.lookup_command(), preprocess)
+
+    def lookup_command(self):
+        return ['lookup', '-q', '-flags', 'mbTT', self.fst_file]
 
     def lookup2cg(self):
         """Runs lookup2cg on the lookup output
         Returns the output of lookup2cg
+
+        With hfst, the ccat output is analysed directly.
         """
         if self.fstkit == 'hfst':
-            text = self.ccat()
-            lookup = self.run_external_command('apertium-deshtml', text)
-            lookup2cg_command = ['hfst-proc', '--cg', self.fst_file]
+            return self.stage('lookup2cg', self.ccat, self.run_lookup2cg)
+        else:
+            return self.stage('lookup2cg', self.lookup, self.run_lookup2cg)
+
+    def run_lookup2cg(self, lookup):
+        '''Make cg input
+
+        For hfst, lookup is the ccat output, for xfst it is the output
+        of lookup
+        '''
+        for command in self.lookup2cg_commands():
+            lookup = self.run_external_command(command, lookup)
+
+        return lookup
+
+    def lookup2cg_commands(self):
+        '''The commands that make cg input'''
+        if self.fstkit == 'hfst':
+            return [['apertium-deshtml'],
+                    ['hfst-proc', '--cg', self.fst_file]]
         else:
-            lookup2cg_command = ['lookup2cg']
-            lookup = self.lookup()
+            return [['lookup2cg']]
+
+    def run_vislcg3(self, grammar, cg):
+        '''Run vislcg3 with grammar on cg'''
+        return self.run_external_command(self.vislcg3_command(grammar), cg)
+
+    def vislcg3_command(self, grammar):
+        return ['vislcg3', '-g', grammar]
 
-        if lookup is not None:
-            return self.run_external_command(lookup2cg_command, lookup)
+    def run_disambiguation(self, cg):
+        return self.run_vislcg3(self.disambiguation_analysis_file, cg)
+
+    def run_function(self, cg):
+        return self.run_vislcg3(self.function_analysis_file, cg)
+
+    def run_dependency(self, cg):
+        return self.run_vislcg3(self.dependency_analysis_file, cg)
 
     def disambiguation_analysis(self):
         """Runs vislcg3 on the lookup2cg output
 
         Produces a disambiguation analysis
         """
-        dis_analysis_command = \
-            ['vislcg3', '-g', self.disambiguation_analysis_file]
-
-        lookup2cg = self.lookup2cg()
-        if lookup2cg is not None:
-            self.disambiguation = \
-                self.run_external_command(dis_analysis_command, lookup2cg)
-        else:
-            self.disambiguation = None
+        return self.stage('disambiguation', self.lookup2cg,
+                          self.run_disambiguation)
 
     def function_analysis(self):
         """Runs vislcg3 on the disambiguation analysis
 
         Return the output of this process
         """
-        self.disambiguation_analysis()
-
-        function_analysis_command = \
-            ['vislcg3', '-g', self.function_analysis_file]
-
-        if self.get_disambiguation() is not None:
-            return self.run_external_command(function_analysis_command,
-                                             self.get_disambiguation())
+        return self.stage('function', self.disambiguation_analysis,
+                          self.run_function)
 
     def dependency_analysis(self):
         """Runs vislcg3 on the functions analysis output
 
         Produces a dependency analysis
         """
-        function_analysis = self.function_analysis()
+        return self.stage('dependency', self.function_analysis,
+                          self.run_dependency)
 
-        if function_analysis is not None:
-            dep_analysis_command = \
-                ['vislcg3', '-g', self.dependency_analysis_file]
+    def pipeline_commands(self):
+        '''The commands that make a dependency analysis of ccat output
 
-            self.dependency = \
-                self.run_external_command(dep_analysis_command,
-                                          self.function_analysis())
+        The disambiguation analysis is the output of the third last
+        command
+        '''
+        commands = []
+        if self.fstkit != 'hfst':
+            commands.append(self.preprocess_command())
+            commands.append(self.lookup_command())
+        commands.extend(self.lookup2cg_commands())
+        commands.append(
+            self.vislcg3_command(self.disambiguation_analysis_file))
+        commands.append(self.vislcg3_command(self.function_analysis_file))
+        commands.append(self.vislcg3_command(self.dependency_analysis_file))
+
+        return commands
+
+    def pipe_analysis(self):
+        '''Make the disambiguation and dependency analysis in one go
+
+        The tools are connected by OS pipes, like in a shell pipeline,
+        instead of passing each output through python. The
+        disambiguation analysis is copied out of the pipeline with tee.
+        '''
+        text = self.ccat()
+        if text is not None:
+            commands = self.pipeline_commands()
+            runner = util.ExternalPipelineRunner()
+            with self.timings.timer('pipeline'):
+                runner.run(commands, to_stdin=text, tee=[len(commands) - 3],
+                           timeout=self.time_left())
+            if runner.timed_out:
+                raise AnalysisTimeout('The pipeline timed out')
+            for command, error in zip(commands, runner.stderr):
+                self.check_error(command, error)
+
+            self.outputs['disambiguation'] = runner.tees[len(commands) - 3]
+            self.outputs['dependency'] = runner.stdout
 
     def get_disambiguation(self):
         '''Get the disambiguation analysis
         '''
-        return self.disambiguation
+        return self.outputs.get('disambiguation')
 
     def get_dependency(self):
         '''Get the dependency analysis
         '''
-        return self.dependency
+        return self.outputs.get('dependency')
 
     def get_analysis_xml(self):
         '''Replace the body of the converted document with disambiguation
@@ -231,50 +452,363 @@ class Analyser(object):
 
     def check_error(self, command, error):
         '''Print errors
+
+        The tools cannot tell which file of a batch an error belongs to,
+        so all the files of the batch are named.
         '''
         if error is not None and len(error) > 0:
-            print >>sys.stderr, self.xml_file.get_name()
+            if self.batch_files is not None:
+                print >>sys.stderr, 'In the batch of', \
+                    ', '.join(self.batch_files)
+            else:
+                print >>sys.stderr, self.xml_file.get_name()
             print >>sys.stderr, command
             print >>sys.stderr, error
 
     def analyse(self, xml_file):
         '''Analyse a file if it is not ocr'ed
+
+        Returns the result of the analysis, made by new_result
+        '''
+        self.timings = util.Timings()
+        result = self.new_result(xml_file)
+        self.analyse_result(result)
+        self.record_outcome(result)
+
+        return result
+
+    @staticmethod
+    def new_result(xml_file):
+        '''Make the result of the analysis of xml_file
+
+        The result is a dict with the name and size of the file, the
+        status of the analysis, the error that stopped it and the
+        timings of the stages. The status is one of analysed, ocr, empty,
+        timeout or failed.
+        '''
+        return {'xml_file': xml_file,
+                'size': Analyser.file_size(xml_file),
+                'status': None,
+                'error': None,
+                'timings': None}
+
+    @staticmethod
+    def file_size(filename):
+        '''Return the size of filename, or 0 if it cannot be read'''
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def set_failure(result, status, error):
+        '''Record in result that the analysis stopped because of error'''
+        print >>sys.stderr, result['xml_file'], status, error
+        result['status'] = status
+        result['error'] = str(error)
+
+    def analyse_result(self, result):
+        '''Analyse the file of result and record the outcome in result
+
+        The tools are killed if they spend more than self.timeout
+        seconds on the file.
+        '''
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+        try:
+            result['status'] = self.analyse_file(result['xml_file'])
+        except AnalysisTimeout as error:
+            self.set_failure(result, 'timeout', error)
+        except (etree.XMLSyntaxError, EnvironmentError) as error:
+            self.set_failure(result, 'failed', error)
+        finally:
+            self.deadline = None
+        result['timings'] = self.timings
+
+    def analyse_file(self, xml_file):
+        '''Analyse a file if it is not ocr'ed
+
+        Returns the status of the analysis
         '''
         self.xml_file = parallelize.CorpusXMLFile(xml_file)
-        analysis_xml_name = self.xml_file.get_name().replace('converted/',
-                                                             'analysed/')
 
         if self.xml_file.get_ocr() is None:
-            self.dependency_analysis()
-            if self.get_disambiguation() is not None:
-                self.makedirs(analysis_xml_name)
-                self.get_analysis_xml()
-                self.xml_file.write(analysis_xml_name)
+            if self.pipe:
+                self.pipe_analysis()
+            else:
+                self.dependency_analysis()
+            if self.get_disambiguation() is None:
+                return 'empty'
+            self.write_analysis()
+            return 'analysed'
         else:
             print >>sys.stderr, xml_file, 'is an OCR file and will not be \
             analysed'
+            return 'ocr'
+
+    def write_analysis(self):
+        '''Write the analysed document to the analysed directory
+        '''
+        analysis_xml_name = self.analysis_name(self.xml_file.get_name())
+        with self.timings.timer('write'):
+            self.makedirs(analysis_xml_name)
+            self.get_analysis_xml()
+            self.xml_file.write(analysis_xml_name)
+
+    def analyse_batch(self, xml_files):
+        '''Analyse the files in xml_files with one run of the tools
+
+        The ccat output of the files is joined with the delimiter in
+        between, and the disambiguation and dependency analysis are split
+        back into one analysis per file. If the analysis cannot be split
+        into as many parts as there are files, or the tools time out,
+        the files are analysed one by one.
+
+        Returns a list with the result of each file. The timings of the
+        whole batch are kept in the result of the first file.
+        '''
+        if len(xml_files) == 1:
+            return [self.analyse(xml_files[0])]
+
+        self.timings = util.Timings()
+        results = []
+        documents = []
+        for xml_file in xml_files:
+            result = self.new_result(xml_file)
+            results.append(result)
+            try:
+                self.xml_file = parallelize.CorpusXMLFile(xml_file)
+                if self.xml_file.get_ocr() is None:
+                    text = self.ccat()
+                    if text is not None:
+                        documents.append((result, self.xml_file, text))
+                    else:
+                        result['status'] = 'empty'
+                else:
+                    print >>sys.stderr, xml_file, 'is an OCR file and will \
+                    not be analysed'
+                    result['status'] = 'ocr'
+            except (etree.XMLSyntaxError, EnvironmentError) as error:
+                self.set_failure(result, 'failed', error)
+
+        analyses = None
+        if len(documents) > 0:
+            if self.timeout is not None:
+                self.deadline = time.time() + self.timeout * len(documents)
+            self.batch_files = [result['xml_file']
+                                for result, _, _ in documents]
+            try:
+                analyses = self.batch_analysis(
+                    [text for _, _, text in documents])
+                if analyses is None:
+                    print >>sys.stderr, 'Could not split the analysis of', \
+                        len(documents), 'files, analysing them one by one'
+            except AnalysisTimeout:
+                print >>sys.stderr, 'The analysis of', len(documents), \
+                    'files timed out, analysing them one by one'
+            finally:
+                self.deadline = None
+                self.batch_files = None
+
+        if analyses is None:
+            for result, _, _ in documents:
+                self.analyse_result(result)
+        else:
+            for (result, xml_file, _), (disambiguation, dependency) in zip(
+                    documents, analyses):
+                self.xml_file = xml_file
+                self.outputs['disambiguation'] = disambiguation
+                self.outputs['dependency'] = dependency
+                try:
+                    self.write_analysis()
+                except (etree.XMLSyntaxError, EnvironmentError) as error:
+                    self.set_failure(result, 'failed', error)
+                else:
+                    result['status'] = 'analysed'
+
+        for result in results:
+            self.record_outcome(result)
+            result['timings'] = None
+        results[0]['timings'] = self.timings
+
+        return results
+
+    def batch_analysis(self, texts):
+        '''Run the tools once over all the ccat outputs in texts
+
+        Returns a list with a tuple of the disambiguation and dependency
+        analysis of each text, or None if the analysis could not be split
+        '''
+        lookup = (self.batch_delimiter + b'\n').join(texts)
+        if self.fstkit != 'hfst':
+            with self.timings.timer('preprocess'):
+                preprocess = self.run_preprocess(lookup)
+            with self.timings.timer('lookup'):
+                lookup = self.run_lookup(preprocess)
+        with self.timings.timer('lookup2cg'):
+            lookup2cg = self.delimiter_to_flush(self.run_lookup2cg(lookup))
+        with self.timings.timer('disambiguation'):
+            disambiguation = self.run_disambiguation(lookup2cg)
+        with self.timings.timer('function'):
+            function = self.run_function(disambiguation)
+        with self.timings.timer('dependency'):
+            dependency = self.run_dependency(function)
+
+        disambiguations = self.split_at_flush(disambiguation)
+        dependencies = self.split_at_flush(dependency)
+        if len(disambiguations) == len(dependencies) == len(texts):
+            return zip(disambiguations, dependencies)
+
+    @property
+    def batch_delimiter(self):
+        '''The delimiter that survives the tools of self.fstkit'''
+        if self.fstkit == 'hfst':
+            return self.hfst_delimiter
+        else:
+            return self.delimiter
+
+    def delimiter_to_flush(self, cg):
+        '''Replace the delimiter cohorts in cg with the flush command
+        '''
+        return re.sub(
+            b'^"<' + re.escape(self.batch_delimiter) + b'>"\n(\t.*\n)*',
+            self.flush + b'\n',
+            cg,
+            flags=re.MULTILINE)
+
+    def split_at_flush(self, cg):
+        '''Split the vislcg3 output cg at the flush commands
+        '''
+        return re.split(b'^' + re.escape(self.flush) + b'\n', cg,
+                        flags=re.MULTILINE)
+
+    def batches(self):
+        '''Split self.xml_files into lists of at most batch_size files
+
+        The largest files come first, so that they do not end up as the
+        last tasks of a parallel analysis, with all the other workers idle.
+        '''
+        xml_files = sorted(self.xml_files, key=self.file_size, reverse=True)
+        return [xml_files[i:i + self.batch_size]
+                for i in range(0, len(xml_files), self.batch_size)]
+
+    def processes_per_task(self):
+        '''The number of external processes that analyse a task at once'''
+        if self.pipe:
+            # The commands and tee
+            return len(self.pipeline_commands()) + 1
+        else:
+            return 1
+
+    def memory_per_task(self):
+        '''Estimate the memory in bytes needed to analyse a task
+
+        Each tool is assumed to need memory_factor times the size of the
+        fst or grammar it loads. When the tools are piped they all run at
+        once, otherwise one at a time.
+        '''
+        sizes = [self.file_size(dependency)
+                 for dependency in self.dependencies]
+        if self.pipe:
+            size = sum(sizes)
+        else:
+            size = max(sizes)
+
+        return max(1, size * self.memory_factor)
+
+    def pool_size(self):
+        '''The number of tasks to analyse at the same time
+
+        Unless self.jobs is set, there are at most two external processes
+        per cpu, and the tasks must fit in the available memory.
+        '''
+        if self.jobs is not None:
+            return self.jobs
+
+        size = multiprocessing.cpu_count() * 2 // self.processes_per_task()
+        memory = util.available_memory()
+        if memory is not None:
+            size = min(size, memory // self.memory_per_task())
+
+        return max(1, size)
 
     def analyse_in_parallel(self):
-        '''Analyse file in parallel
+        '''Analyse files in parallel
+
+        The workers get the analyser once, when they start, and then
+        only the names of the files of each task. The results are
+        returned as the tasks are done.
+
+        Returns a list of the results of all files
         '''
-        pool_size = multiprocessing.cpu_count() * 2
-        pool = multiprocessing.Pool(processes=pool_size,)
-        pool.map(
-            unwrap_self_analyse,
-            zip([self]*len(self.xml_files), self.xml_files))
+        batches = self.batches()
+        pool = multiprocessing.Pool(
+            processes=min(self.pool_size(), len(batches)),
+            initializer=init_worker,
+            initargs=(self,))
+        results = []
+        for batch_results in pool.imap_unordered(analyse_in_worker, batches,
+                                                 chunksize=1):
+            results.extend(batch_results)
         pool.close()  # no more tasks
         pool.join()   # wrap up current tasks
 
+        return results
+
     def analyse_serially(self):
         '''Analyse files one by one
+
+        Returns a list of the results of all files
+        '''
+        results = []
+        for batch in self.batches():
+            print >>sys.stderr, 'Analysing', ', '.join(batch)
+            results.extend(self.analyse_batch(batch))
+
+        return results
+
+    @staticmethod
+    def print_timings(results):
+        '''Print how the time spent in each stage is spread
+
+        results is a list of the results of each file
         '''
-        for xml_file in self.xml_files:
-            print >>sys.stderr, 'Analysing', xml_file
-            self.analyse(xml_file)
+        histogram = util.StageHistogram()
+        for result in results:
+            if result['timings'] is not None:
+                for stage, seconds in result['timings'].stages.iteritems():
+                    histogram.add(stage, seconds)
+        print >>sys.stderr, histogram.format()
+
+    @staticmethod
+    def print_summary(results):
+        '''Print how many files got each status, and which files timed
+        out or failed
+        '''
+        statuses = collections.Counter(result['status'] for result in results)
+        print >>sys.stderr, ', '.join(
+            '{} {}'.format(statuses[status], status)
+            for status in ['analysed', 'ocr', 'empty', 'timeout', 'failed']
+            if statuses[status] > 0)
+        for result in results:
+            if result['status'] in ['timeout', 'failed']:
+                print >>sys.stderr, result['status'], result['xml_file'], \
+                    result['error']
+
+
+# The analyser of a worker process of analyse_in_parallel
+worker_analyser = None
+
+
+def init_worker(analyser):
+    '''Keep the analyser in the worker process'''
+    global worker_analyser
+    worker_analyser = analyser
 
 
-def unwrap_self_analyse(arg, **kwarg):
-    return Analyser.analyse(*arg, **kwarg)
+def analyse_in_worker(xml_files):
+    '''Analyse a task of analyse_in_parallel in a worker process'''
+    return worker_analyser.analyse_batch(xml_files)
 
 
 def parse_options():
@@ -294,6 +828,45 @@ def parse_options():
     parser.add_argument('converted_dirs', nargs='+',
                         help="director(y|ies) where the converted files \
                         exist")
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        help="Send this many files through each run of \
+                        the analysis tools, so that the fst and the \
+                        grammars are loaded once per batch instead of once \
+                        per file. Loading them takes a few seconds, so a \
+                        corpus of many small files gains the most: pick a \
+                        size where the text of a batch takes about as long \
+                        to analyse as the loading, e.g. 20 to 100 files of \
+                        a few pages. Keep it lower for big files, since the \
+                        output of a whole batch is held in memory. Default \
+                        is {}, or 1 with --pipe.".format(
+                            Analyser.default_batch_size))
+    parser.add_argument('--pipe',
+                        action='store_true',
+                        help="Connect the analysis tools with OS pipes \
+                        instead of passing the output of each tool \
+                        through python. Only used for files that are \
+                        analysed one by one, so the batch size defaults to \
+                        1.")
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help="Analyse all files. By default, files are only \
+                        analysed if their analysis is older than the \
+                        converted file or the fst and grammar files.")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        help="Analyse this many files or batches at the \
+                        same time. By default this is found from the \
+                        number of cpus and the available memory.")
+    parser.add_argument('--timeout',
+                        type=float,
+                        help="Kill the analysis tools if they spend more \
+                        than this many seconds on a file. By default they \
+                        are never killed.")
+    parser.add_argument('--timings',
+                        action='store_true',
+                        help="Print a histogram of the time spent in each \
+                        stage of the analysis.")
     parser.add_argument('-k', '--fstkit',
                         choices=['hfst', 'xfst'],
                         default='xfst',
@@ -328,17 +901,26 @@ def main():
                            'gtcore/gtdshared/smi/src/syntax/korp.cg3'),
                        dependency_analysis_file=os.path.join(
                            os.getenv('GTHOME'),
-                           'gtcore/gtdshared/smi/src/syntax/dependency.cg3')
+                           'gtcore/gtdshared/smi/src/syntax/dependency.cg3'),
+                       batch_size=args.batch_size,
+                       pipe=args.pipe,
+                       jobs=args.jobs,
+                       timeout=args.timeout
         )
     except util.ArgumentError as a:
         print >>sys.stderr, a.message
         sys.exit(4)
 
-    ana.collect_files(args.converted_dirs)
+    ana.collect_files(args.converted_dirs, force=args.force)
+    if ana.uptodate > 0:
+        print >>sys.stderr, 'Skipping', ana.uptodate, 'up to date files'
     if len(ana.xml_files) > 0:
         if args.serial:
-            ana.analyse_serially()
+            results = ana.analyse_serially()
         else:
-            ana.analyse_in_parallel()
-    else:
+            results = ana.analyse_in_parallel()
+        ana.print_summary(results)
+        if args.timings:
+            ana.print_timings(results)
+    elif ana.uptodate == 0:
         print >>sys.stderr, "Did not find any files in", args.converted_dirs
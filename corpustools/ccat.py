@@ -22,16 +22,22 @@
 
 from lxml import etree
 import StringIO
+import collections
+import multiprocessing
 import os
 import sys
 import argparse
 
 import argparse_version
+import util
 
 
 class XMLPrinter:
     """This is a class to convert giellatekno xml formatted files to plain text
     """
+    error_tags = ['error', 'errorort', 'errorortreal', 'errormorphsyn',
+                  'errorsyn', 'errorlex', 'errorlang']
+
     def __init__(self,
                  lang=None,
                  all_paragraphs=False,
@@ -129,6 +135,85 @@ class XMLPrinter:
         else:
             self.hyph_replacement = hyph_replacement
 
+        self.compile_handlers()
+
+    def __getstate__(self):
+        '''The handler table holds bound methods, which cannot be pickled
+        '''
+        state = self.__dict__.copy()
+        del state['handlers']
+        del state['included_langs']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile_handlers()
+
+    def compile_handlers(self):
+        '''Resolve the options into a tag to handler table
+
+        The handler of a child element only depends on its tag, so the
+        option flags are evaluated once per tag instead of once per
+        element. The error tags are resolved here, other tags when they
+        are first seen in visit_children.
+
+        Likewise, included_langs caches whether text in a given language
+        should be printed, and visited_types holds the paragraph types
+        that should be printed.
+        '''
+        self.handlers = {}
+        for tag in self.error_tags:
+            self.handlers[tag] = self.choose_handler(etree.Element(tag))
+        self.included_langs = {}
+
+        self.visited_types = set()
+        if self.paragraph is True:
+            self.visited_types.update([None, 'text'])
+        if self.title is True:
+            self.visited_types.add('title')
+        if self.listitem is True:
+            self.visited_types.add('listitem')
+        if self.table is True:
+            self.visited_types.add('tablecell')
+
+    def choose_handler(self, element):
+        '''Return the method visit_children should call for element
+
+        The handlers take the arguments child, textlist, parentlang and
+        elementlang, where elementlang is the language of the parent of
+        child.
+        '''
+        if element.tag == 'errorlang' and self.noforeign and self.typos:
+            return self.skip_child
+        elif element.tag == 'errorlang' and self.noforeign:
+            return self.visit_child_tail
+        elif self.visit_error_inline(element):
+            return self.visit_child_error_inline
+        elif self.visit_error_not_inline(element):
+            return self.visit_child_error_not_inline
+        else:
+            return self.visit_child_nonerror
+
+    def skip_child(self, child, textlist, parentlang, elementlang):
+        pass
+
+    def visit_child_tail(self, child, textlist, parentlang, elementlang):
+        self.get_tail(child, textlist, parentlang)
+
+    def visit_child_error_inline(self, child, textlist, parentlang,
+                                 elementlang):
+        self.collect_inline_errors(
+            child,
+            textlist,
+            self.get_element_language(child, parentlang))
+
+    def visit_child_error_not_inline(self, child, textlist, parentlang,
+                                     elementlang):
+        self.collect_not_inline_errors(child, textlist)
+
+    def visit_child_nonerror(self, child, textlist, parentlang, elementlang):
+        self.visit_nonerror_element(child, textlist, elementlang)
+
     def get_lang(self):
         """
         Get the lang of the file
@@ -141,10 +226,11 @@ class XMLPrinter:
 
         Elements inherit the parents language if not explicitely set
         """
-        if element.get('{http://www.w3.org/XML/1998/namespace}lang') is None:
+        lang = element.get('{http://www.w3.org/XML/1998/namespace}lang')
+        if lang is None:
             return parentlang
         else:
-            return element.get('{http://www.w3.org/XML/1998/namespace}lang')
+            return lang
 
     def collect_not_inline_errors(self, element, textlist):
         '''Add the formatted errors as strings to the textlist list
@@ -243,24 +329,32 @@ class XMLPrinter:
 
         if len(textlist) > 0:
             if not self.one_word_per_line:
-                buffer.write(' '.join(textlist).encode('utf8'))
-                buffer.write(' ¶\n')
+                buffer.write(' '.join(textlist).encode('utf8') + ' ¶\n')
             else:
-                buffer.write('\n'.join(textlist).encode('utf8'))
-                buffer.write('\n')
+                buffer.write('\n'.join(textlist).encode('utf8') + '\n')
 
     def get_contents(self, elt_contents, textlist, elt_lang):
         if elt_contents is not None:
             text = elt_contents.strip()
-            if text != '' and (
-                    self.lang is None or
-                    (not self.invert_lang and elt_lang == self.lang) or
-                    (self.invert_lang and elt_lang != self.lang)):
+            if text != '' and self.include_lang(elt_lang):
                 if not self.one_word_per_line:
                     textlist.append(text)
                 else:
                     textlist.append('\n'.join(text.split()))
 
+    def include_lang(self, lang):
+        '''Return True if text in lang should be printed
+        '''
+        try:
+            return self.included_langs[lang]
+        except KeyError:
+            included = (
+                self.lang is None or
+                (not self.invert_lang and lang == self.lang) or
+                (self.invert_lang and lang != self.lang))
+            self.included_langs[lang] = included
+            return included
+
     def get_text(self, element, textlist, parentlang):
         '''Get the text part of an lxml element
         '''
@@ -278,23 +372,24 @@ class XMLPrinter:
     def visit_children(self, element, textlist, parentlang):
         """Visit the children of element, adding their content to textlist
         """
+        elementlang = self.get_element_language(element, parentlang)
+        handlers = self.handlers
         for child in element:
-            if child.tag == 'errorlang' and self.noforeign and self.typos:
-                pass
-            elif child.tag == 'errorlang' and self.noforeign:
-                self.get_tail(child, textlist, parentlang)
-            elif self.visit_error_inline(child):
-                self.collect_inline_errors(
-                    child,
-                    textlist,
-                    self.get_element_language(child, parentlang))
-            elif self.visit_error_not_inline(child):
-                self.collect_not_inline_errors(child, textlist)
-            else:
-                self.visit_nonerror_element(
-                    child,
-                    textlist,
-                    self.get_element_language(element, parentlang))
+            try:
+                handler = handlers[child.tag]
+            except KeyError:
+                handler = self.handler(child)
+            handler(child, textlist, parentlang, elementlang)
+
+    def handler(self, child):
+        '''Look up the handler of child in the handler table
+        '''
+        try:
+            return self.handlers[child.tag]
+        except KeyError:
+            handler = self.choose_handler(child)
+            self.handlers[child.tag] = handler
+            return handler
 
     def visit_nonerror_element(self, element, textlist, parentlang):
         """Visit and extract text from non error element
@@ -308,19 +403,8 @@ class XMLPrinter:
     def visit_this_node(self, element):
         '''Return True if the element should be visited
         '''
-        return (
-            self.all_paragraphs or
-            (
-                self.paragraph is True and (element.get('type') is None or
-                                            element.get('type') == 'text')
-            ) or (
-                self.title is True and element.get('type') == 'title'
-            ) or (
-                self.listitem is True and element.get('type') == 'listitem'
-            ) or (
-                self.table is True and element.get('type') == 'tablecell'
-            )
-        )
+        return (self.all_paragraphs or
+                element.get('type') in self.visited_types)
 
     def visit_error_not_inline(self, element):
         """Determine whether element should be visited
@@ -372,17 +456,59 @@ class XMLPrinter:
         elif self.disambiguation:
             self.print_element(self.etree.find('.//disambiguation'), buffer)
         else:
+            lang = None
             for paragraph in self.etree.findall('.//p'):
                 if self.visit_this_node(paragraph):
-                    self.collect_text(paragraph, self.get_lang(), buffer)
+                    if lang is None:
+                        lang = self.get_lang()
+                    self.collect_text(paragraph, lang, buffer)
 
         return buffer
 
-    def handle_hyph(self):
-        """Replace hyph tags
+    def stream_file(self, filename, buffer):
+        """Process filename paragraph by paragraph, writing into buffer
+
+        The file is read with iterparse, and each p element is written to
+        buffer as soon as its end tag is parsed. Processed paragraphs are
+        cleared and dropped from the tree, so memory use stays flat
+        regardless of the size of the file.
+
+        As in process_file, the language of a paragraph is inherited from
+        the document root.
         """
+        self.filename = filename
+        lang = None
+        has_hyph = False
+        for _, element in etree.iterparse(filename,
+                                          tag=('p', 'hyph'),
+                                          huge_tree=True):
+            if element.tag == 'hyph':
+                has_hyph = True
+                continue
+
+            if self.visit_this_node(element):
+                if lang is None:
+                    lang = element.getroottree().getroot().attrib[
+                        '{http://www.w3.org/XML/1998/namespace}lang']
+                if has_hyph and self.hyph_replacement is not None:
+                    self.handle_hyph(element)
+                self.collect_text(element, lang, buffer)
+            has_hyph = False
+
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def handle_hyph(self, element=None):
+        """Replace hyph tags found below element
+
+        If element is None, replace all hyph tags in the document
+        """
+        if element is None:
+            element = self.etree
         hyph_tails = []
-        for hyph in self.etree.findall('.//hyph'):
+        for hyph in element.findall('.//hyph'):
             if hyph.tail is not None:
                 hyph_tails.append(hyph.tail)
 
@@ -399,10 +525,171 @@ class XMLPrinter:
             buffer.write(element.text.encode('utf8'))
 
     def print_file(self, file_):
-        '''Print a xml file to stdout'''
+        '''Print a xml file to stdout
+
+        Paragraphs are streamed to stdout as they are parsed. The
+        disambiguation and dependency elements are printed from the
+        fully parsed file.
+        '''
         if file_.endswith('.xml'):
+            self.write_file(file_, sys.stdout)
+
+    def write_file(self, file_, buffer):
+        '''Write the text of a xml file to buffer'''
+        if self.dependency or self.disambiguation:
             self.parse_file(file_)
-            sys.stdout.write(self.process_file().getvalue())
+            buffer.write(self.process_file().getvalue())
+        else:
+            self.stream_file(file_, buffer)
+
+    def file_text(self, file_):
+        '''Return the text of a xml file'''
+        buffer = StringIO.StringIO()
+        self.write_file(file_, buffer)
+        return buffer.getvalue()
+
+
+def has_text(element):
+    '''Check if element contains any paragraph text
+
+    This is True when XMLPrinter(all_paragraphs=True,
+    hyph_replacement=None) would print something for element, but stops
+    at the first paragraph that has text.
+    '''
+    for paragraph in element.iter('p'):
+        for text in paragraph.itertext():
+            if text.strip() != '':
+                return True
+        if paragraph.tail is not None and paragraph.tail.strip() != '':
+            return True
+
+    return False
+
+
+def unwrap_self_file_text(arg, **kwarg):
+    return XMLPrinter.file_text(*arg, **kwarg)
+
+
+def find_xml_files(targets):
+    '''Find the xml files in targets
+
+    Directories are walked in sorted order, so the order of the files is
+    the same from run to run.
+
+    Yields tuples of the path of the file and its path relative to the
+    deepest directory that contains all the targets, so that files from
+    different targets get different relative paths.
+    '''
+    targets = [target for target in targets if exists(target)]
+    top = common_directory(targets)
+    for target in targets:
+        if os.path.isfile(target):
+            if target.endswith('.xml'):
+                yield target, os.path.relpath(target, top)
+        elif os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                for xml_file in sorted(files):
+                    if xml_file.endswith('.xml'):
+                        path = os.path.join(root, xml_file)
+                        yield path, os.path.relpath(path, top)
+
+
+def exists(target):
+    '''Check that target exists, complain if it does not'''
+    if os.path.exists(target):
+        return True
+    else:
+        print >>sys.stderr, '{} does not exist'.format(target)
+        return False
+
+
+def common_directory(targets):
+    '''Return the deepest directory that contains all of targets
+
+    A directory target contains itself, a file target is contained in
+    its directory.
+    '''
+    directories = []
+    for target in targets:
+        target = os.path.abspath(target)
+        if not os.path.isdir(target):
+            target = os.path.dirname(target)
+        directories.append(target.split(os.sep))
+
+    return os.sep.join(os.path.commonprefix(directories)) or os.sep
+
+
+def ccat_in_parallel(xml_printer, files, jobs, buffer_size=None):
+    '''Extract the text of files in jobs worker processes
+
+    files is a sequence of tuples as given by find_xml_files.
+
+    The texts are yielded in the order of files. At most buffer_size
+    files are handed out before the oldest one is yielded, so a slow file
+    holds back at most buffer_size finished texts.
+
+    Yields tuples of the path, the relative path and the text of the files.
+    '''
+    if buffer_size is None:
+        buffer_size = jobs * 4
+    pool = multiprocessing.Pool(processes=jobs)
+    pending = collections.deque()
+    try:
+        for path, relpath in files:
+            pending.append(
+                (path, relpath,
+                 pool.apply_async(unwrap_self_file_text,
+                                  ((xml_printer, path), ))))
+            if len(pending) >= buffer_size:
+                path, relpath, result = pending.popleft()
+                yield path, relpath, result.get()
+
+        while pending:
+            path, relpath, result = pending.popleft()
+            yield path, relpath, result.get()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def output_name(output_dir, relpath):
+    '''Return the name of the file in output_dir that mirrors the xml
+    file relpath
+
+    The .xml suffix of relpath is replaced by .txt
+    '''
+    return os.path.join(output_dir, os.path.splitext(relpath)[0] + '.txt')
+
+
+def check_output_names(output_dir, files):
+    '''Raise an ArgumentError if two of files would be written to the
+    same file in output_dir
+
+    files is a sequence of tuples as given by find_xml_files.
+    '''
+    seen = {}
+    for path, relpath in files:
+        name = output_name(output_dir, relpath)
+        if name in seen:
+            raise util.ArgumentError(
+                'ERROR: {} and {} would both be written to {}'.format(
+                    seen[name], path, name))
+        seen[name] = path
+
+
+def open_output(output_dir, relpath):
+    '''Open the file in output_dir that mirrors the xml file relpath
+    '''
+    path = output_name(output_dir, relpath)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return open(path, 'w')
 
 
 def parse_options():
@@ -507,6 +794,18 @@ def parse_options():
                         default='',
                         help='Replace hyph tags with the given argument')
 
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='The number of files to process in parallel. \
+                        The output is still written in file order. \
+                        Default is 1.')
+    parser.add_argument('-o', '--output-dir',
+                        help='Write the text of each file to a .txt file in \
+                        OUTPUT_DIR, mirroring the directory tree below \
+                        the deepest directory that contains all the \
+                        targets, instead of to stdout.')
+
     parser.add_argument('targets',
                         nargs='+',
                         help='Name of the files or directories to process. \
@@ -520,7 +819,7 @@ def parse_options():
 def main():
     """Set up the XMLPrinter class with the given command line options and
     process the given files and directories
-    Print the output to stdout
+    Print the output to stdout, or to the files in the output directory
     """
     args = parse_options()
 
@@ -545,16 +844,30 @@ def main():
                              disambiguation=args.disambiguation,
                              hyph_replacement=args.hyph_replacement)
 
-    for target in args.targets:
-        if os.path.exists(target):
-            if os.path.isfile(target):
-                xml_printer.print_file(target)
-            elif os.path.isdir(target):
-                for root, _, files in os.walk(target):
-                    for xml_file in files:
-                        xml_printer.print_file(os.path.join(root, xml_file))
-        else:
-            print >>sys.stderr, '{} does not exist'.format(target)
+    files = find_xml_files(args.targets)
+    if args.output_dir is not None:
+        files = list(files)
+        try:
+            check_output_names(args.output_dir, files)
+        except util.ArgumentError as error:
+            print >>sys.stderr, error.message
+            sys.exit(1)
+
+    if args.jobs > 1:
+        for _, relpath, text in ccat_in_parallel(xml_printer, files,
+                                                 args.jobs):
+            if args.output_dir is None:
+                sys.stdout.write(text)
+            else:
+                with open_output(args.output_dir, relpath) as output:
+                    output.write(text)
+    else:
+        for path, relpath in files:
+            if args.output_dir is None:
+                xml_printer.print_file(path)
+            else:
+                with open_output(args.output_dir, relpath) as output:
+                    xml_printer.write_file(path, output)
 
 if __name__ == '__main__':
     main()
@@ -22,24 +22,25 @@
 
 import argparse
 import codecs
+import collections
+import cProfile
 from copy import deepcopy
 import distutils.dep_util
 import distutils.spawn
+import glob
+import hashlib
 import io
+import json
 import multiprocessing
+import multiprocessing.util
 import os
+import pstats
 import re
 import sys
+import time
 
 from lxml import etree
 from lxml.html import clean
-from lxml.html import html5parser
-from pyth.plugins.rtf15.reader import Rtf15Reader
-from pyth.plugins.xhtml.writer import XHTMLWriter
-try:
-    from pydocx.export import PyDocXHTMLExporter as Docx2Html
-except ImportError:
-    from pydocx.parsers import Docx2Html
 
 
 import argparse_version
@@ -58,8 +59,27 @@ class ConversionException(Exception):
     pass
 
 
+def load_xslt(name):
+    '''Compile one of the stylesheets in the xslt directory'''
+    return etree.XSLT(etree.parse(os.path.join(here, 'xslt', name)))
+
+
+RESOURCES = util.ResourceRegistry()
+RESOURCES.register('dtd',
+                   lambda: etree.DTD(Converter.get_dtd_location()))
+RESOURCES.register('preprocxsl', lambda: load_xslt('preprocxsl.xsl'))
+RESOURCES.register('xhtml2corpus', lambda: load_xslt('xhtml2corpus.xsl'))
+RESOURCES.register('svg2corpus', lambda: load_xslt('svg2corpus.xsl'))
+RESOURCES.register('languageguesser', lambda: text_cat.Classifier(None))
+# The resources that every conversion needs
+STYLESHEETS = ['dtd', 'preprocxsl', 'xhtml2corpus', 'svg2corpus']
+
+
 class Converter(object):
     '''Take care of data common to all Converter classes'''
+    # How many paragraphs LanguageDetector classified or short-circuited
+    language_stats = None
+
     def __init__(self, filename, write_intermediate=False):
         codecs.register_error('mixed', self.mixed_decoder)
         self.orig = os.path.abspath(filename)
@@ -77,6 +97,15 @@ class Converter(object):
     def dependencies(self):
         return [self.orig, self.xsl]
 
+    @property
+    def timings(self):
+        '''The time spent in each stage of the conversion'''
+        try:
+            return self.__timings
+        except AttributeError:
+            self.__timings = util.Timings()
+            return self.__timings
+
     @property
     def logfile(self):
         '''The name of the logfile'''
@@ -109,7 +138,7 @@ class Converter(object):
 
     def validate_complete(self, complete):
         '''Validate the complete document'''
-        dtd = etree.DTD(Converter.get_dtd_location())
+        dtd = RESOURCES.get('dtd')
 
         if not dtd.validate(complete):
             with open(self.logfile, 'w') as logfile:
@@ -137,13 +166,15 @@ class Converter(object):
 
     def transform_to_complete(self):
         '''Combine the intermediate xml document with its medatata.'''
-        intermediate = self.convert2intermediate()
+        with self.timings.timer('intermediate'):
+            intermediate = self.convert2intermediate()
 
         self.maybe_write_intermediate(intermediate)
 
         try:
-            xm = XslMaker(self.xsl)
-            complete = xm.transformer(intermediate)
+            with self.timings.timer('xslt'):
+                xm = XslMaker(self.xsl)
+                complete = xm.transformer(intermediate)
 
             return complete.getroot()
         except etree.XSLTApplyError as e:
@@ -181,17 +212,24 @@ class Converter(object):
                         self.logfile))
 
     def fix_document(self, complete):
-        fixer = DocumentFixer(complete)
+        '''Run the DocumentFixer steps on complete
+
+        Each step is timed as its own fix.* stage, the fix stage only
+        covers the rest, so that no time is counted twice.
+        '''
+        with self.timings.timer('fix'):
+            fixer = DocumentFixer(complete)
 
-        fixer.fix_newstags()
-        fixer.soft_hyphen_to_hyph_tag()
-        fixer.set_word_count()
-        fixer.detect_quotes()
+            steps = ['fix_newstags', 'soft_hyphen_to_hyph_tag',
+                     'set_word_count', 'detect_quotes']
+            if (complete.
+                attrib['{http://www.w3.org/XML/1998/namespace}lang'] in
+                    ['sma', 'sme', 'smj', 'nob', 'fin']):
+                steps.append('fix_body_encoding')
 
-        if (complete.
-            attrib['{http://www.w3.org/XML/1998/namespace}lang'] in
-                ['sma', 'sme', 'smj', 'nob', 'fin']):
-            fixer.fix_body_encoding()
+        for step in steps:
+            with self.timings.timer('fix.' + step):
+                getattr(fixer, step)()
 
     mixed_to_unicode = {
         'e4': u'ä',
@@ -234,42 +272,62 @@ class Converter(object):
                         (u'\x8e', u'Ž')]
         return util.replace_all(replacements, content)
 
-    def make_complete(self, languageGuesser):
+    def make_complete(self, languageGuesser=None):
         '''Combine the intermediate giellatekno xml file and the metadata into
         a complete giellatekno xml file.
         Fix the character encoding
         Detect the languages in the xml file
+
+        Language detection is only done for multilingual documents. If
+        languageGuesser is None, the process wide language guesser is
+        loaded the first time it is needed.
         '''
         complete = self.transform_to_complete()
-        self.validate_complete(complete)
-        self.convert_errormarkup(complete)
+        with self.timings.timer('validate'):
+            self.validate_complete(complete)
+        with self.timings.timer('errormarkup'):
+            self.convert_errormarkup(complete)
         self.fix_document(complete)
-        ld = LanguageDetector(complete, languageGuesser)
-        ld.detect_language()
+        with self.timings.timer('languagedetection'):
+            if complete.find('header/multilingual') is not None:
+                if languageGuesser is None:
+                    languageGuesser = RESOURCES.get('languageguesser')
+                ld = LanguageDetector(complete, languageGuesser)
+                ld.detect_language()
+                self.language_stats = ld.stats
 
         return complete
 
-    def write_complete(self, languageguesser):
-        if distutils.dep_util.newer_group(
+    def write_complete(self, languageguesser=None, force=False):
+        '''Convert the original file and write the converted file
+
+        The file is only converted if the converted file is older than
+        its dependencies, or if force is True.
+
+        Returns one of 'uptodate', 'skipped', 'empty' or 'converted'
+        '''
+        if not force and not distutils.dep_util.newer_group(
                 self.dependencies, self.converted_name):
-            self.makedirs()
-
-            if (('goldstandard' in self.orig and '.correct.' in self.orig) or
-                    'goldstandard' not in self.orig):
-                complete = self.make_complete(languageguesser)
-
-                xml_printer = ccat.XMLPrinter(all_paragraphs=True,
-                                              hyph_replacement=None)
-                xml_printer.etree = etree.ElementTree(complete)
-                text = xml_printer.process_file().getvalue()
-
-                if len(text) > 0:
-                    with open(self.converted_name, 'w') as converted:
-                        converted.write(etree.tostring(complete,
-                                                       encoding='utf8',
-                                                       pretty_print='True'))
-                else:
-                    print >>sys.stderr, self.orig, "has no text"
+            return 'uptodate'
+
+        self.makedirs()
+
+        if not (('goldstandard' in self.orig and '.correct.' in self.orig) or
+                'goldstandard' not in self.orig):
+            return 'skipped'
+
+        complete = self.make_complete(languageguesser)
+
+        with self.timings.timer('write'):
+            has_text = ccat.has_text(complete)
+            if has_text:
+                util.write_xml(complete, self.converted_name)
+
+        if has_text:
+            return 'converted'
+        else:
+            print >>sys.stderr, self.orig, "has no text"
+            return 'empty'
 
     def makedirs(self):
         '''Make the converted directory.'''
@@ -338,7 +396,8 @@ class Converter(object):
         :returns: a utf-8 encoded string containing the content of the document
         '''
         runner = util.ExternalCommandRunner()
-        runner.run(command, cwd=self.tmpdir)
+        with self.timings.timer('extract'):
+            runner.run(command, cwd=self.tmpdir)
 
         if runner.returncode != 0:
             with open(self.logfile, 'w') as logfile:
@@ -460,8 +519,7 @@ class SVGConverter(Converter):
 
     def convert2intermediate(self):
         '''Transform svg to an intermediate xml document'''
-        svgXsltRoot = etree.parse(os.path.join(here, 'xslt/svg2corpus.xsl'))
-        transform = etree.XSLT(svgXsltRoot)
+        transform = RESOURCES.get('svg2corpus')
         doc = etree.parse(self.orig)
         intermediate = transform(doc)
 
@@ -1195,14 +1253,15 @@ class HTMLContentConverter(Converter):
         semiclean = self.remove_cruft(decoded)
         superclean = cleaner.clean_html(semiclean)
 
+        # html5lib is slow to import, so only import it when needed
+        from lxml.html import html5parser
+
         self.soup = html5parser.document_fromstring(superclean)
 
         self.convert2xhtml()
         #with open('{}.huff.xml'.format(self.orig), 'wb') as huff:
             #util.print_element(self.soup, 0, 2, huff)
 
-        self.converter_xsl = os.path.join(here, 'xslt/xhtml2corpus.xsl')
-
     def remove_cruft(self, content):
         '''from svenskakyrkan.se documents'''
         replacements = [
@@ -1626,8 +1685,7 @@ class HTMLContentConverter(Converter):
 
         The resulting xml is stored in intermediate
         '''
-        html_xslt_root = etree.parse(self.converter_xsl)
-        transform = etree.XSLT(html_xslt_root)
+        transform = RESOURCES.get('xhtml2corpus')
 
         intermediate = ''
 
@@ -1663,6 +1721,9 @@ class HTMLConverter(HTMLContentConverter):
 class RTFConverter(HTMLContentConverter):
     '''Convert html documents to the giellatekno xml format.'''
     def __init__(self, filename, write_intermediate=False):
+        from pyth.plugins.rtf15.reader import Rtf15Reader
+        from pyth.plugins.xhtml.writer import XHTMLWriter
+
         with open(filename, "rb") as rtf_document:
             content = rtf_document.read()
             try:
@@ -1679,6 +1740,10 @@ class RTFConverter(HTMLContentConverter):
 class DocxConverter(HTMLContentConverter):
     '''Convert docx documents to the giellatekno xml format'''
     def __init__(self, filename, write_intermediate=False):
+        try:
+            from pydocx.export import PyDocXHTMLExporter as Docx2Html
+        except ImportError:
+            from pydocx.parsers import Docx2Html
 
         HTMLContentConverter.__init__(self, filename,
                                       content=Docx2Html(filename).parsed)
@@ -2278,7 +2343,14 @@ class XslMaker(object):
 
     To convert the intermediate xml to a fullfledged  giellatekno document
     a combination of three xsl files + the intermediate xml file is needed.
+
+    Compiling the resulting stylesheet is expensive, so the compiled
+    transformers are kept in a bounded, process wide cache keyed by a hash
+    of the canonicalised metadata file.
     '''
+    CACHE_SIZE = 128
+    cache = collections.OrderedDict()
+    cache_stats = {'hits': 0, 'misses': 0}
 
     def __init__(self, xslfile):
         self.filename = xslfile
@@ -2295,10 +2367,10 @@ class XslMaker(object):
     def logfile(self):
         return self.filename + '.log'
 
-    @property
-    def xsl(self):
+    def parse_xsl(self):
+        '''Parse the file specific metadata file'''
         try:
-            filexsl = etree.parse(self.filename)
+            return etree.parse(self.filename)
         except etree.XMLSyntaxError as e:
             with open(self.logfile, 'w') as logfile:
                 logfile.write('Error at: {}'.format(str(util.lineno())))
@@ -2306,24 +2378,32 @@ class XslMaker(object):
                     logfile.write('{}\n'.format(str(entry)))
 
             raise ConversionException(
-                '{}: Syntax error. More info in {}'.format(self.__name__,
-                                                           self.logfile))
-
-        preprocessXsl = etree.parse(
-            os.path.join(here, 'xslt/preprocxsl.xsl'))
-        preprocessXslTransformer = etree.XSLT(preprocessXsl)
+                '{}: Syntax error. More info in {}'.format(
+                    type(self).__name__, self.logfile))
 
+    def preprocess(self, filexsl):
+        '''Make filexsl import common.xsl from this installation'''
         common_xsl_path = os.path.join(
             here, 'xslt/common.xsl').replace(' ', '%20')
 
-        return preprocessXslTransformer(
+        return RESOURCES.get('preprocxsl')(
             filexsl,
             commonxsl=etree.XSLT.strparam('file://{}'.format(common_xsl_path)))
 
     @property
-    def transformer(self):
+    def xsl(self):
+        return self.preprocess(self.parse_xsl())
+
+    @staticmethod
+    def cache_key(filexsl):
+        '''Hash the canonical form of the metadata, ignoring comments'''
+        return hashlib.sha1(etree.tostring(filexsl,
+                                           method='c14n',
+                                           with_comments=False)).hexdigest()
+
+    def compile(self, xsl):
         try:
-            return etree.XSLT(self.xsl)
+            return etree.XSLT(xsl)
         except etree.XSLTParseError as (e):
             with open(self.logfile, 'w') as logfile:
                 logfile.write('Error at: {}\n'.format(str(util.lineno())))
@@ -2335,10 +2415,44 @@ class XslMaker(object):
                 '{}: Invalid XML in {}. More info in {}'.format(
                     type(self).__name__, self.filename, self.logfile))
 
+    @property
+    def transformer(self):
+        filexsl = self.parse_xsl()
+        key = self.cache_key(filexsl)
+
+        try:
+            transformer = self.cache.pop(key)
+            self.cache_stats['hits'] += 1
+        except KeyError:
+            transformer = self.compile(self.preprocess(filexsl))
+            self.cache_stats['misses'] += 1
+
+        self.cache[key] = transformer
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+        return transformer
+
 
 class LanguageDetector(object):
-    '''Detect and set the languages of a document.'''
-    def __init__(self, document, languageGuesser):
+    '''Detect and set the languages of a document.
+
+    The classifier is not reliable for trivial texts, those that have
+    fewer than MIN_LETTERS letters or only one word. TRIVIAL_POLICY
+    decides what happens to them:
+    classify: classify them like any other text
+    script: texts without letters, like numbers and punctuation, get
+        the main language, the others are classified
+    inherit: trivial texts get the main language
+    lexicon: a trivial text whose words are only in the word model of
+        one candidate language gets that language, the rest get the
+        main language
+    '''
+    TRIVIAL_POLICIES = ['classify', 'script', 'inherit', 'lexicon']
+    TRIVIAL_POLICY = 'script'
+    MIN_LETTERS = 10
+
+    def __init__(self, document, languageGuesser, trivial_policy=None):
         self.document = document
         self.mainlang = self.document.\
             attrib['{http://www.w3.org/XML/1998/namespace}lang']
@@ -2354,6 +2468,15 @@ class LanguageDetector(object):
                 raise ConversionException('mainlang not set')
 
         self.languageGuesser = languageGuesser
+        if trivial_policy is None:
+            trivial_policy = self.TRIVIAL_POLICY
+        if trivial_policy not in self.TRIVIAL_POLICIES:
+            raise ValueError(
+                'Unknown trivial text policy {}'.format(trivial_policy))
+        self.trivial_policy = trivial_policy
+        # How many texts were classified, and how many were decided
+        # without the classifier
+        self.stats = {'classified': 0, 'inherited': 0, 'lexicon': 0}
 
     def get_document(self):
         return self.document
@@ -2369,32 +2492,106 @@ class LanguageDetector(object):
         language of the paragraph.
         Set the language of the quotes in the paragraph.
         '''
-
-        if paragraph.get('{http://www.w3.org/XML/1998/namespace}lang') is None:
-            paragraph_text = self.remove_quote(paragraph)
-            if self.languageGuesser is not None:
-                lang = self.languageGuesser.classify(paragraph_text,
-                                                     langs=self.inlangs)
-                if lang != self.get_mainlang():
-                    paragraph.set('{http://www.w3.org/XML/1998/namespace}lang',
-                                  lang)
-
-                self.set_span_language(paragraph)
+        if self.languageGuesser is not None:
+            self.set_languages(self.language_candidates(paragraph))
 
         return paragraph
 
     def set_span_language(self, paragraph):
         '''Set xml:lang of span element'''
-        for element in paragraph.iter("span"):
-            if element.get("type") == "quote":
-                if element.text is not None:
-                    lang = self.languageGuesser.classify(element.text,
-                                                         langs=self.inlangs)
-                    if lang != self.get_mainlang():
-                        element.set(
-                            '{http://www.w3.org/XML/1998/namespace}lang',
+        self.set_languages(self.quote_candidates(paragraph))
+
+    def language_candidates(self, paragraph):
+        '''Return the elements and texts whose language paragraph needs
+
+        That is the paragraph with its text outside the quotes, and its
+        quotes, unless the language of paragraph is already set.
+        '''
+        if paragraph.get('{http://www.w3.org/XML/1998/namespace}lang') is None:
+            return ([(paragraph, self.remove_quote(paragraph))] +
+                    self.quote_candidates(paragraph))
+        else:
+            return []
+
+    @staticmethod
+    def quote_candidates(paragraph):
+        '''Return the quotes of paragraph and their texts'''
+        return [(element, element.text)
+                for element in paragraph.iter("span")
+                if element.get("type") == "quote" and element.text is not None]
+
+    def set_languages(self, candidates):
+        '''Set xml:lang of the elements in candidates
+
+        candidates is a list of elements and their texts. The texts that
+        the trivial policy does not decide are classified in one batch.
+        Only languages other than the main language are set.
+        '''
+        decided = []
+        elements = []
+        texts = []
+        for element, text in candidates:
+            lang = self.trivial_language(text)
+            if lang is None:
+                elements.append(element)
+                texts.append(text)
+            else:
+                decided.append((element, lang))
+
+        langs = self.languageGuesser.classify_many(texts, langs=self.inlangs)
+        self.stats['classified'] += len(texts)
+        for element, lang in decided + zip(elements, langs):
+            if lang != self.get_mainlang():
+                element.set('{http://www.w3.org/XML/1998/namespace}lang',
                             lang)
 
+    def trivial_language(self, text):
+        '''Return the language of text if the trivial policy decides it
+
+        Returns None if text should be classified.
+        '''
+        if self.trivial_policy == 'classify':
+            return None
+
+        letters = sum(1 for char in text if char.isalpha())
+        if letters == 0:
+            self.stats['inherited'] += 1
+            return self.get_mainlang()
+        if self.trivial_policy == 'script':
+            return None
+
+        words = text.split()
+        if len(words) > 1 and letters >= self.MIN_LETTERS:
+            return None
+
+        if self.trivial_policy == 'lexicon':
+            lang = self.lexicon_language(text)
+            if lang is not None:
+                self.stats['lexicon'] += 1
+                return lang
+
+        self.stats['inherited'] += 1
+        return self.get_mainlang()
+
+    def lexicon_language(self, text):
+        '''Return the only candidate language that knows all words of text
+
+        Returns None if no language or more than one language has all the
+        words in its word model.
+        '''
+        words = [word
+                 for word in text_cat.NGramModel().tokenise(
+                     text_cat.ensure_unicode(text))
+                 if word != '']
+        langs = [lang
+                 for lang in sorted(self.languageGuesser.get_langs(
+                     self.inlangs))
+                 if words and all(
+                     word in self.languageGuesser.wmodels[lang].ngrams
+                     for word in words)]
+        if len(langs) == 1:
+            return langs[0]
+
     def remove_quote(self, paragraph):
         '''Extract all text except the one inside <span type='quote'>'''
         text = ''
@@ -2412,19 +2609,234 @@ class LanguageDetector(object):
         return text
 
     def detect_language(self):
-        '''Detect language in all the paragraphs in self.document'''
-        if self.document.find('header/multilingual') is not None:
+        '''Detect language in all the paragraphs in self.document
+
+        The texts of all the unset paragraphs and their quotes that the
+        trivial policy does not decide are classified in one batch.
+        '''
+        if (self.document.find('header/multilingual') is not None and
+                self.languageGuesser is not None):
+            candidates = []
             for paragraph in self.document.iter('p'):
-                self.set_paragraph_language(paragraph)
+                candidates.extend(self.language_candidates(paragraph))
+            self.set_languages(candidates)
+
+
+class BuildManifest(object):
+    '''Remember what convert2xml built from which inputs
+
+    The manifest is a JSON lines file, with one entry for each original
+    file. An entry records the size, mtime and sha1 of the original file
+    and its metadata file, the outcome of the conversion and a digest of
+    the files that all conversions depend on (the DTD, the xslt files and
+    the CorpusTools version).
+
+    Inputs whose size and mtime match the manifest are considered
+    unchanged without being read. If only the mtime differs, the content
+    hash decides.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.dependencies = self.dependencies_digest()
+
+        if os.path.exists(filename):
+            with open(filename) as manifest:
+                for line in manifest:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['orig']] = entry
+
+    @staticmethod
+    def dependencies_digest():
+        '''Hash the files and version every conversion depends on'''
+        digest = hashlib.sha1(argparse_version.version)
+        for filename in ([Converter.get_dtd_location()] +
+                         sorted(glob.glob(os.path.join(here, 'xslt',
+                                                       '*.xsl')))):
+            digest.update(BuildManifest.file_digest(filename))
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_digest(filename):
+        '''Return the sha1 of the content of filename'''
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as content:
+            for chunk in iter(lambda: content.read(1 << 16), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def fingerprint(filename):
+        '''Return size, mtime and sha1 of filename'''
+        stat = os.stat(filename)
+
+        return [stat.st_size, stat.st_mtime,
+                BuildManifest.file_digest(filename)]
+
+    @staticmethod
+    def key(orig_file):
+        '''Manifest entries are keyed by the absolute unicode path'''
+        orig_file = os.path.abspath(orig_file)
+        if isinstance(orig_file, unicode):
+            return orig_file
+        else:
+            return util.name_to_unicode(orig_file)
+
+    @staticmethod
+    def inputs(xsl_file):
+        '''Map the input names of a conversion to their file names'''
+        return {'orig': xsl_file[:-4], 'xsl': xsl_file}
+
+    def is_stale(self, xsl_file):
+        '''Decide whether the original file of xsl_file must be converted'''
+        inputs = self.inputs(xsl_file)
+        entry = self.entries.get(self.key(inputs['orig']))
+
+        if (entry is None or entry['dependencies'] != self.dependencies or
+                (entry['status'] == 'converted' and
+                 not os.path.exists(entry['converted']))):
+            return True
+
+        touched = False
+        for name, filename in inputs.iteritems():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return True
+
+            size, mtime, sha1 = entry['inputs'][name]
+            if stat.st_size != size:
+                return True
+            if stat.st_mtime != mtime:
+                if self.file_digest(filename) != sha1:
+                    return True
+                entry['inputs'][name] = [size, stat.st_mtime, sha1]
+                touched = True
+
+        if touched:
+            self.record(entry)
+
+        return False
+
+    def record(self, entry):
+        '''Add entry to the manifest, appending it to the manifest file'''
+        self.entries[entry['orig']] = entry
+        with open(self.filename, 'a') as manifest:
+            manifest.write(json.dumps(entry))
+            manifest.write('\n')
+
+    def record_result(self, result):
+        '''Record the outcome of ConverterManager.convert'''
+        if result.get('inputs') is not None:
+            self.record({'orig': self.key(result['xsl_file'][:-4]),
+                         'converted': result['converted'],
+                         'status': result['status'],
+                         'dependencies': self.dependencies,
+                         'inputs': result['inputs']})
+
+    def compact(self):
+        '''Rewrite the manifest file with one line per entry'''
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as manifest:
+            for orig in sorted(self.entries):
+                manifest.write(json.dumps(self.entries[orig]))
+                manifest.write('\n')
+        os.rename(tmpname, self.filename)
+
+
+class ConversionProgress(object):
+    '''Follow the progress of a conversion run
+
+    Show a progress line that is updated as the results come in, and
+    optionally write each result as a JSON line to a report file.
+    '''
+    def __init__(self, total, report=None, live=True, out=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self.live = live
+        self.out = out
+        if report is not None:
+            self.report = open(report, 'w')
+        else:
+            self.report = None
+
+    def add(self, result):
+        '''Count result, write it to the report and update the line'''
+        self.done += 1
+        if result['status'] in ['failed', 'missing']:
+            self.failed += 1
+
+        if self.report is not None:
+            self.report.write(json.dumps(result))
+            self.report.write('\n')
+            self.report.flush()
+
+        if self.live:
+            self.out.write('\r{}'.format(self.line()))
+            self.out.flush()
+
+    def line(self):
+        '''Describe how far the conversion has come'''
+        elapsed = time.time() - self.start
+        if self.done > 0:
+            eta = elapsed / self.done * (self.total - self.done)
+        else:
+            eta = 0
+
+        return '[{}/{}] {} failed, {:.0f}s elapsed, {:.0f}s left'.format(
+            self.done, self.total, self.failed, elapsed, eta)
+
+    def close(self):
+        if self.live and self.done > 0:
+            self.out.write('\n')
+        if self.report is not None:
+            self.report.close()
 
 
 class ConverterManager(object):
     '''Manage the conversion of original files to corpus xml'''
-    LANGUAGEGUESSER = text_cat.Classifier(None)
     FILES = []
+    # The relative cost per byte of the different converters, used to
+    # convert the most expensive files first.
+    COST_WEIGHTS = {
+        'PDF2XMLConverter': 2.0,
+        'DocConverter': 2.0,
+        'DocxConverter': 1.5,
+        'RTFConverter': 1.5,
+        'HTMLConverter': 1.0,
+        'SVGConverter': 1.0,
+        'AvvirConverter': 1.0,
+        'BiblexmlConverter': 1.0,
+        'PlaintextConverter': 1.0,
+    }
 
-    def __init__(self, write_intermediate):
+    def __init__(self, write_intermediate, manifest=None, jobs=None,
+                 cost_weights=None, report=None, profile_dir=None,
+                 language_cache=None):
         self.write_intermediate = write_intermediate
+        self.report = report
+        self.profile_dir = profile_dir
+        self.language_cache = language_cache
+        self.manifest = manifest
+        self.use_manifest = manifest is not None
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+        self.cost_weights = dict(self.COST_WEIGHTS)
+        if cost_weights is not None:
+            self.cost_weights.update(cost_weights)
+
+    def __getstate__(self):
+        '''Leave the manifest in the parent process when pickling'''
+        state = dict(self.__dict__)
+        state['manifest'] = None
+
+        return state
 
     @property
     def write_intermediate(self):
@@ -2435,54 +2847,126 @@ class ConverterManager(object):
         self.__write_intermediate = write_intermediate
 
     def convert(self, xsl_file):
+        '''Convert xsl_file, profiling the conversion if asked to'''
+        if self.profile_dir is None:
+            return self.convert_file(xsl_file)
+
+        try:
+            name = self.converter_class(xsl_file[:-4]).__name__
+        except ConversionException:
+            name = 'Unknown'
+        profiler = PROFILERS.setdefault(name, cProfile.Profile())
+        profiler.enable()
+        try:
+            return self.convert_file(xsl_file)
+        finally:
+            profiler.disable()
+
+    def convert_file(self, xsl_file):
+        '''Convert the original file belonging to xsl_file
+
+        Returns a dict describing the outcome, so that workers can report
+        back to the parent process. It contains the status of the
+        conversion, the converter used, the time spent in each stage, the
+        size of the original and converted files, the error message of a
+        failed conversion, how many times the XSLT and language guesser
+        caches were hit or missed and, when a manifest is used, the
+        fingerprints of the inputs.
+        '''
+        start = time.time()
+        cache_stats = dict(XslMaker.cache_stats)
+        language_cache_stats = self.language_cache_stats()
+        result = {'xsl_file': xsl_file, 'inputs': None, 'converter': None,
+                  'converted': None, 'timings': {}, 'orig_size': None,
+                  'converted_size': None, 'error': None,
+                  'language_stats': None}
         orig_file = xsl_file[:-4]
         if os.path.exists(orig_file) and not orig_file.endswith('.xsl'):
-
+            result['orig_size'] = os.path.getsize(orig_file)
+            conv = None
             try:
+                setup_start = time.time()
                 conv = self.converter(orig_file)
-                conv.write_complete(self.LANGUAGEGUESSER)
+                # Some converters already extract the text when they are
+                # made, that time is not setup
+                conv.timings.add('setup',
+                                 time.time() - setup_start -
+                                 sum(conv.timings.stages.values()))
+                result['converter'] = type(conv).__name__
+                result['converted'] = conv.converted_name
+                result['status'] = conv.write_complete(
+                    force=self.use_manifest)
+                if result['status'] == 'converted':
+                    result['converted_size'] = os.path.getsize(
+                        conv.converted_name)
+                if self.use_manifest:
+                    result['inputs'] = {
+                        name: BuildManifest.fingerprint(filename)
+                        for name, filename
+                        in BuildManifest.inputs(xsl_file).iteritems()}
             except ConversionException as e:
                 print >>sys.stderr, 'Could not convert {}'.format(orig_file)
                 print >>sys.stderr, str(e)
+                result['status'] = 'failed'
+                result['error'] = str(e)
+            if conv is not None:
+                result['timings'] = dict(conv.timings.stages)
+                result['language_stats'] = conv.language_stats
         else:
             print >>sys.stderr, '{} does not exist'.format(orig_file)
+            result['status'] = 'missing'
+
+        result['xsl_cache'] = {key: XslMaker.cache_stats[key] - value
+                               for key, value in cache_stats.iteritems()}
+        result['language_cache'] = {
+            key: self.language_cache_stats()[key] - value
+            for key, value in language_cache_stats.iteritems()}
+        result['time'] = time.time() - start
+
+        return result
+
+    @staticmethod
+    def language_cache_stats():
+        '''The result cache stats of the language guesser of this process'''
+        languageguesser = RESOURCES.peek('languageguesser')
+        if languageguesser is None:
+            return {'hits': 0, 'misses': 0}
+        else:
+            return dict(languageguesser.results.stats)
 
     def converter(self, orig_file):
+        return self.converter_class(orig_file)(
+            orig_file, write_intermediate=self.write_intermediate)
+
+    @staticmethod
+    def converter_class(orig_file):
+        '''Choose the Converter class that can convert orig_file'''
         if 'avvir_xml' in orig_file:
-            return AvvirConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return AvvirConverter
 
         elif orig_file.endswith('.txt'):
-            return PlaintextConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return PlaintextConverter
 
         elif orig_file.endswith('.pdf'):
-            return PDF2XMLConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return PDF2XMLConverter
 
         elif orig_file.endswith('.svg'):
-            return SVGConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return SVGConverter
 
         elif '.htm' in orig_file or '.php' in orig_file:
-            return HTMLConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return HTMLConverter
 
         elif orig_file.endswith('.doc') or orig_file.endswith('.DOC'):
-            return DocConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return DocConverter
 
         elif orig_file.endswith('.docx'):
-            return DocxConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return DocxConverter
 
         elif '.rtf' in orig_file:
-            return RTFConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return RTFConverter
 
         elif orig_file.endswith('.bible.xml'):
-            return BiblexmlConverter(
-                orig_file, write_intermediate=self.write_intermediate)
+            return BiblexmlConverter
 
         else:
             raise ConversionException(
@@ -2490,22 +2974,208 @@ class ConverterManager(object):
                 "\nHint: you may just have to rename the file".format(
                     orig_file))
 
+    def expected_cost(self, xsl_file):
+        '''Estimate the cost of converting the original of xsl_file
+
+        The estimate is the size of the original file multiplied by the
+        cost weight of the converter that handles it.
+        '''
+        orig_file = xsl_file[:-4]
+        try:
+            weight = self.cost_weights.get(
+                self.converter_class(orig_file).__name__, 1.0)
+            return os.path.getsize(orig_file) * weight
+        except (ConversionException, OSError):
+            return 0
+
+    def schedule(self, files):
+        '''Order files so that the most expensive ones are converted first'''
+        return sorted(files, key=self.expected_cost, reverse=True)
+
+    def files_to_convert(self):
+        '''Return the files that must be converted
+
+        When a manifest is used, files whose inputs are unchanged since the
+        last conversion are left out.
+        '''
+        if self.manifest is None:
+            return self.FILES
+        else:
+            return [xsl_file for xsl_file in self.FILES
+                    if self.manifest.is_stale(xsl_file)]
+
     def convert_in_parallel(self):
-        print 'Starting the conversion of {} files'.format(len(self.FILES))
+        '''Convert the files in self.jobs worker processes
 
-        pool_size = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=pool_size,)
-        pool.map(unwrap_self_convert,
-                 zip([self]*len(self.FILES), self.FILES))
+        The largest files are handed out first, one at a time, so that a
+        huge file is not left waiting at the end of the run.
+        '''
+        files = self.schedule(self.files_to_convert())
+        print 'Starting the conversion of {} files'.format(len(files))
+
+        # Load the shared resources before forking, so that the workers
+        # inherit them. When every worker gets several files, it will most
+        # likely need the language guesser, so load it once here instead
+        # of once in every worker.
+        RESOURCES.warm(STYLESHEETS)
+        if len(files) > self.jobs:
+            RESOURCES.get('languageguesser')
+        pool = multiprocessing.Pool(processes=self.jobs,
+                                    initializer=init_worker,
+                                    initargs=(self.profile_dir,
+                                              self.language_cache))
+        progress = ConversionProgress(len(files), self.report)
+        results = []
+        for result in pool.imap_unordered(unwrap_self_convert,
+                                          zip([self]*len(files), files),
+                                          chunksize=1):
+            self.handle_result(result)
+            progress.add(result)
+            results.append(result)
         pool.close()
         pool.join()
+        progress.close()
 
-    def convert_serially(self):
-        print 'Starting the conversion of {} files'.format(len(self.FILES))
+        self.finish(results)
 
-        for xsl_file in self.FILES:
+    def convert_serially(self):
+        files = self.files_to_convert()
+        print 'Starting the conversion of {} files'.format(len(files))
+        if self.language_cache is not None:
+            load_language_cache(self.language_cache)
+
+        progress = ConversionProgress(len(files), self.report, live=False)
+        results = []
+        for xsl_file in files:
             print 'converting', xsl_file[:-4]
-            self.convert(xsl_file)
+            result = self.convert(xsl_file)
+            self.handle_result(result)
+            progress.add(result)
+            results.append(result)
+        progress.close()
+
+        self.finish(results)
+
+    def handle_result(self, result):
+        '''Record the result of a single conversion'''
+        if self.manifest is not None:
+            self.manifest.record_result(result)
+
+    def finish(self, results):
+        '''Compact the manifest and summarise the results of a run'''
+        if self.manifest is not None:
+            self.manifest.compact()
+
+        self.print_summary(results)
+        self.print_stage_times(results)
+        self.print_cache_stats(results, 'xsl_cache', 'XSLT cache')
+        self.print_cache_stats(results, 'language_cache',
+                               'Language detection cache')
+        self.print_language_stats(results)
+        if self.profile_dir is not None:
+            dump_profiles(self.profile_dir)
+            self.merge_profiles()
+            self.print_stage_histogram(results)
+        if self.language_cache is not None:
+            self.save_language_cache()
+
+    def save_language_cache(self):
+        '''Write the language detection results of the run to
+        self.language_cache
+
+        The results of this process are saved, and the results saved by
+        the workers are added to them as the most recently used.
+        '''
+        save_language_cache()
+        cache = text_cat.ResultCache(filename=self.language_cache)
+        for filename in sorted(glob.glob(self.language_cache + '.[0-9]*')):
+            cache.update(text_cat.ResultCache(filename=filename))
+            os.remove(filename)
+        cache.save()
+
+    def worker_profiles(self):
+        '''Find the profiles dumped by the processes of a run
+
+        Returns a dict from converter names to the list of their profiles
+        '''
+        worker_profiles = collections.defaultdict(list)
+        for filename in glob.glob(os.path.join(self.profile_dir,
+                                               '*.*.prof')):
+            name = os.path.basename(filename).split('.')[0]
+            worker_profiles[name].append(filename)
+
+        return worker_profiles
+
+    def remove_worker_profiles(self):
+        '''Remove profiles left behind by an interrupted run'''
+        for filenames in self.worker_profiles().itervalues():
+            for filename in filenames:
+                os.remove(filename)
+
+    def merge_profiles(self):
+        '''Merge the profiles of the workers into one per converter
+
+        The profile of a converter from an earlier run is replaced.
+        '''
+        for name, filenames in self.worker_profiles().iteritems():
+            profile_name = os.path.join(self.profile_dir, name + '.prof')
+            pstats.Stats(*filenames).dump_stats(profile_name)
+            for filename in filenames:
+                os.remove(filename)
+            print 'Wrote profile of {} to {}'.format(name, profile_name)
+
+    @staticmethod
+    def print_stage_histogram(results):
+        '''Print how the stage times of the converted files are spread'''
+        histogram = util.StageHistogram()
+        for result in results:
+            for stage, seconds in result['timings'].iteritems():
+                histogram.add(stage, seconds)
+        print histogram.format()
+
+    def print_summary(self, results):
+        '''Tell how many files were skipped, rebuilt and failed'''
+        statuses = collections.Counter(result['status'] for result in results)
+        skipped = (len(self.FILES) - len(results) + statuses['uptodate'] +
+                   statuses['skipped'])
+        print '{} skipped, {} rebuilt, {} failed'.format(
+            skipped,
+            statuses['converted'] + statuses['empty'],
+            statuses['failed'] + statuses['missing'])
+
+    @staticmethod
+    def print_stage_times(results):
+        '''Print the total time spent in each conversion stage'''
+        stages = collections.Counter()
+        for result in results:
+            stages.update(result['timings'])
+        if stages:
+            print 'Time per stage: {}'.format(', '.join(
+                '{} {:.1f}s'.format(stage, seconds)
+                for stage, seconds in stages.most_common()))
+
+    @staticmethod
+    def print_cache_stats(results, key, name):
+        '''Summarise the cache usage stored under key by convert'''
+        hits = sum(result[key]['hits'] for result in results)
+        misses = sum(result[key]['misses'] for result in results)
+        if hits + misses > 0:
+            print '{}: {} hits, {} misses ({:.1f}% hit rate)'.format(
+                name, hits, misses, 100.0 * hits / (hits + misses))
+
+    @staticmethod
+    def print_language_stats(results):
+        '''Summarise how many texts LanguageDetector sent to the classifier'''
+        stats = collections.Counter()
+        for result in results:
+            if result['language_stats'] is not None:
+                stats.update(result['language_stats'])
+        if stats:
+            avoided = stats['inherited'] + stats['lexicon']
+            print ('Language detection: {} texts classified, {} classifier '
+                   'calls avoided ({} main language, {} lexicon)'.format(
+                       stats['classified'], avoided, stats['inherited'],
+                       stats['lexicon']))
 
     def collect_files(self, sources):
         print 'Collecting files to convert'
@@ -2534,6 +3204,60 @@ class ConverterManager(object):
                 print >>sys.stderr, 'This is neither a file nor a directory.'
 
 
+# The profiles of each converter type, when convert2xml is run with --profile
+PROFILERS = {}
+
+
+def dump_profiles(profile_dir):
+    '''Dump the profiles of this process into profile_dir, and start
+    afresh
+    '''
+    for name, profiler in PROFILERS.iteritems():
+        profiler.dump_stats(os.path.join(
+            profile_dir, '{}.{}.prof'.format(name, os.getpid())))
+    PROFILERS.clear()
+
+
+def load_language_cache(filename, save_as=None):
+    '''Give the language guesser of this process the results cached in
+    filename
+
+    The results are saved to save_as, or back to filename, by
+    save_language_cache.
+    '''
+    languageguesser = RESOURCES.get('languageguesser')
+    languageguesser.results = text_cat.ResultCache(
+        languageguesser.results.size, filename)
+    if save_as is not None:
+        languageguesser.results.filename = save_as
+
+
+def save_language_cache():
+    '''Save the results of the language guesser of this process'''
+    languageguesser = RESOURCES.peek('languageguesser')
+    if languageguesser is not None:
+        languageguesser.results.save()
+
+
+def init_worker(profile_dir, language_cache=None):
+    '''Set up a worker process of ConverterManager.convert_in_parallel
+
+    The shared resources are loaded, and if the conversion is profiled,
+    the profiles of the worker are dumped once, when it exits. Likewise
+    the language detection results are saved next to language_cache,
+    for ConverterManager.save_language_cache to collect.
+    '''
+    RESOURCES.warm(STYLESHEETS)
+    if profile_dir is not None:
+        multiprocessing.util.Finalize(None, dump_profiles,
+                                      args=(profile_dir, ), exitpriority=10)
+    if language_cache is not None:
+        load_language_cache(language_cache,
+                            '{}.{}'.format(language_cache, os.getpid()))
+        multiprocessing.util.Finalize(None, save_language_cache,
+                                      exitpriority=10)
+
+
 def unwrap_self_convert(arg, **kwarg):
     return ConverterManager.convert(*arg, **kwarg)
 
@@ -2553,6 +3277,47 @@ def parse_options():
                         help=u"Write the intermediate XML representation \
                         to ORIGFILE.im.xml, for debugging the XSLT.\
                         (Has no effect if the converted file already exists.)")
+    parser.add_argument(u'--manifest',
+                        help=u"Keep track of the converted files in the \
+                        build manifest MANIFEST, and only convert files \
+                        whose content, metadata or conversion tools \
+                        changed since they were last converted.")
+    parser.add_argument(u'--report',
+                        help=u"Write a JSON line for each converted file to \
+                        REPORT, with the status, converter, time spent in \
+                        each stage and file sizes.")
+    parser.add_argument(u'--profile',
+                        metavar=u'DIR',
+                        help=u"Profile the conversion. Write a cProfile dump \
+                        for each converter type to DIR, and print a \
+                        histogram of the time spent in each stage.")
+    parser.add_argument(u'--langcache',
+                        metavar=u'FILE',
+                        help=u"Keep the results of language detection in \
+                        FILE between runs, so that paragraphs seen by an \
+                        earlier run are not classified again.")
+    parser.add_argument(u'-j', u'--jobs',
+                        type=int,
+                        help=u"The number of files to convert in parallel. \
+                        Defaults to the number of cpus.")
+    parser.add_argument(u'--cost-weight',
+                        action=u'append',
+                        default=[],
+                        metavar=u'CONVERTER=WEIGHT',
+                        help=u"Set the relative cost per byte of a \
+                        converter, e.g. PDF2XMLConverter=3. The most \
+                        expensive files are converted first. May be \
+                        given several times.")
+    parser.add_argument(u'--trivial-policy',
+                        choices=LanguageDetector.TRIVIAL_POLICIES,
+                        default=LanguageDetector.TRIVIAL_POLICY,
+                        help=u"How to set the language of paragraphs \
+                        that are too short to classify reliably: \
+                        classify them anyway, give those without \
+                        letters the main language (script, the \
+                        default), give all of them the main language \
+                        (inherit), or look their words up in the word \
+                        models (lexicon).")
     parser.add_argument('sources',
                         nargs='+',
                         help="The original file(s) or \
@@ -2576,7 +3341,32 @@ def main():
     sanity_check()
     args = parse_options()
 
-    cm = ConverterManager(args.write_intermediate)
+    if args.manifest is not None:
+        manifest = BuildManifest(args.manifest)
+    else:
+        manifest = None
+
+    cost_weights = {}
+    for cost_weight in args.cost_weight:
+        try:
+            name, weight = cost_weight.split('=')
+            cost_weights[name] = float(weight)
+        except ValueError:
+            raise util.ArgumentError(
+                'Invalid cost weight {}, it should look like '
+                'CONVERTER=WEIGHT'.format(cost_weight))
+
+    # Set before forking, so that the workers inherit it
+    LanguageDetector.TRIVIAL_POLICY = args.trivial_policy
+
+    if args.profile is not None and not os.path.isdir(args.profile):
+        os.makedirs(args.profile)
+
+    cm = ConverterManager(args.write_intermediate, manifest, args.jobs,
+                          cost_weights, args.report, args.profile,
+                          args.langcache)
+    if args.profile is not None:
+        cm.remove_worker_profiles()
 
     cm.collect_files(args.sources)
 
@@ -211,10 +211,8 @@ class CorpusXMLFile:
         if file_name is None:
             file_name = self.get_name()
 
-        self.etree.write(file_name,
-                         encoding='utf8',
-                         pretty_print=True,
-                         xml_declaration=True)
+        util.write_xml(self.etree, file_name, xml_declaration=True,
+                       encoding='UTF8')
 
 
 class SentenceDivider:
@@ -872,12 +870,8 @@ class Tmx(object):
         if out_dir != '' and not os.path.isdir(out_dir):
             os.makedirs(out_dir)
 
-        with open(out_filename, "w") as tmx_file:
-            string = etree.tostring(self.get_tmx(),
-                                    pretty_print=True,
-                                    encoding="utf-8",
-                                    xml_declaration=True)
-            tmx_file.write(string)
+        util.write_xml(self.get_tmx(), out_filename, xml_declaration=True,
+                       encoding='utf-8')
 
     def remove_tu_with_empty_seg(self):
         """Remove tu elements that contain empty seg element
@@ -21,7 +21,13 @@
 
 from __future__ import unicode_literals
 
+import copy
 import os
+import re
+import shutil
+import StringIO
+import sys
+import tempfile
 import unittest
 import doctest
 from lxml import etree
@@ -202,3 +208,419 @@ class TestAnalyser(unittest.TestCase):
             '\t"¶" CLB #1->1\n\n]]></dependency></body></document>')
         self.maxDiff = None
         self.assertEqual(etree.tostring(got, encoding='unicode'), want)
+
+
+class FakeToolsAnalyser(analyser.Analyser):
+    '''Replace the external tools with simple text transformations
+
+    preprocess splits the text into one word per line, lookup is
+    skipped, lookup2cg turns each word into a cohort and vislcg3 passes
+    its input through.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(FakeToolsAnalyser, self).__init__(*args, **kwargs)
+        self.runs = []
+
+    def run_preprocess(self, text):
+        self.runs.append('preprocess')
+        return b''.join(word + b'\n' for word in text.split())
+
+    def run_lookup(self, preprocess):
+        self.runs.append('lookup')
+        return preprocess
+
+    def run_lookup2cg(self, lookup):
+        self.runs.append('lookup2cg')
+        return b''.join(b'"<{0}>"\n\t"{0}" N\n'.format(word)
+                        for word in lookup.split())
+
+    def run_vislcg3(self, grammar, cg):
+        self.runs.append('vislcg3')
+        return cg
+
+
+class HfstToolsAnalyser(FakeToolsAnalyser):
+    '''Like FakeToolsAnalyser, but lookup2cg hides markup like
+    apertium-deshtml does, so hfst-proc never sees it
+    '''
+    def run_lookup2cg(self, lookup):
+        return super(HfstToolsAnalyser, self).run_lookup2cg(
+            re.sub(b'<[^>]*>', b' ', lookup))
+
+
+class AnalyserTestCase(unittest.TestCase):
+    '''Make analysers and converted files in a temporary corpus'''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_analyser(self, analyser_class=FakeToolsAnalyser, fstkit='xfst',
+                      grammar_dir=here, **kwargs):
+        return analyser_class(
+            'sme',
+            fstkit,
+            fst_file=os.path.join(grammar_dir, 'analyser.xfst'),
+            disambiguation_analysis_file=os.path.join(grammar_dir,
+                                                      'disambiguation.cg3'),
+            function_analysis_file=os.path.join(grammar_dir,
+                                                'functions.cg3'),
+            dependency_analysis_file=os.path.join(grammar_dir,
+                                                  'dependency.cg3'),
+            **kwargs)
+
+    def make_files(self, names, paragraphs=None):
+        '''Copy smefile.xml to names in the converted directory
+
+        If paragraphs is given, the body of each file is the first
+        paragraph of smefile.xml repeated that many times.
+        '''
+        converted = os.path.join(self.tmpdir, 'converted', 'sme')
+        if not os.path.isdir(converted):
+            os.makedirs(converted)
+        xml_files = []
+        for i, name in enumerate(names):
+            xml_files.append(os.path.join(converted, name))
+            if paragraphs is None:
+                shutil.copy(os.path.join(here, 'smefile.xml'), xml_files[-1])
+                continue
+            tree = etree.parse(os.path.join(here, 'smefile.xml'))
+            body = tree.find('.//body')
+            paragraph = body[0]
+            body.remove(paragraph)
+            for _ in range(paragraphs[i]):
+                body.append(copy.deepcopy(paragraph))
+            tree.write(xml_files[-1])
+        return xml_files
+
+
+class TestAnalyserStages(AnalyserTestCase):
+    def make_smefile_analyser(self, fstkit):
+        a = self.make_analyser(fstkit=fstkit)
+        a.xml_file = parallelize.CorpusXMLFile(
+            os.path.join(here, 'smefile.xml'))
+        return a
+
+    def test_each_stage_runs_once(self):
+        a = self.make_smefile_analyser('xfst')
+        a.dependency_analysis()
+        a.dependency_analysis()
+
+        self.assertEqual(a.runs,
+                         ['preprocess', 'lookup', 'lookup2cg', 'vislcg3',
+                          'vislcg3', 'vislcg3'])
+        self.assertEqual(a.timings.counts.keys(),
+                         ['ccat', 'preprocess', 'lookup', 'lookup2cg',
+                          'disambiguation', 'function', 'dependency'])
+        self.assertEqual(set(a.timings.counts.values()), set([1]))
+        self.assertTrue(a.get_dependency().startswith(b'"<Muhto>"'))
+
+    def test_hfst_runs_ccat_once(self):
+        a = self.make_smefile_analyser('hfst')
+        a.dependency_analysis()
+
+        self.assertEqual(a.runs, ['lookup2cg', 'vislcg3', 'vislcg3',
+                                  'vislcg3'])
+        self.assertEqual(a.timings.counts['ccat'], 1)
+
+    def test_new_file_forgets_outputs(self):
+        a = self.make_smefile_analyser('xfst')
+        a.disambiguation_analysis()
+        a.xml_file = parallelize.CorpusXMLFile(
+            os.path.join(here, 'smefile.xml'))
+
+        self.assertIsNone(a.get_disambiguation())
+
+
+class ShellToolsAnalyser(analyser.Analyser):
+    '''Replace the external tools with standard unix commands
+
+    preprocess splits the text into one word per line, lookup and
+    lookup2cg pass their input on, and the three vislcg3 runs upcase,
+    pass on and reverse their input.
+    '''
+    def preprocess_command(self):
+        return ['tr', ' ', '\n']
+
+    def lookup_command(self):
+        return ['cat']
+
+    def lookup2cg_commands(self):
+        return [['cat']]
+
+    def vislcg3_command(self, grammar):
+        return {self.disambiguation_analysis_file: ['tr', 'a-z', 'A-Z'],
+                self.function_analysis_file: ['cat'],
+                self.dependency_analysis_file: ['rev']}[grammar]
+
+
+class TestAnalyserPipe(AnalyserTestCase):
+    def test_pipe_analysis(self):
+        a = self.make_analyser(ShellToolsAnalyser, pipe=True)
+        a.xml_file = parallelize.CorpusXMLFile(
+            os.path.join(here, 'smefile.xml'))
+        a.pipe_analysis()
+
+        self.assertTrue(a.get_disambiguation().startswith(
+            b'MUHTO\nGASKKOHAGAID,\nJA\n'))
+        self.assertTrue(a.get_dependency().startswith(
+            b'OTHUM\n,DIAGAHOKKSAG\nAJ\n'))
+        self.assertEqual(a.timings.counts.keys(), ['ccat', 'pipeline'])
+
+
+class TestAnalyserBatch(AnalyserTestCase):
+    def setUp(self):
+        super(TestAnalyserBatch, self).setUp()
+        self.a = self.make_analyser(batch_size=2)
+
+    def test_batches(self):
+        self.a.xml_files = ['a', 'b', 'c']
+        self.assertEqual(self.a.batches(), [['a', 'b'], ['c']])
+
+    def test_delimiter_to_flush(self):
+        self.assertEqual(
+            self.a.delimiter_to_flush(
+                b'"<a>"\n\t"a" N\n"<<SKIP/>>"\n\t"<SKIP/>" ?\n"<b>"\n'),
+            b'"<a>"\n\t"a" N\n<STREAMCMD:FLUSH>\n"<b>"\n')
+
+    def test_split_at_flush(self):
+        self.assertEqual(
+            self.a.split_at_flush(b'"<a>"\n<STREAMCMD:FLUSH>\n"<b>"\n'),
+            [b'"<a>"\n', b'"<b>"\n'])
+
+    def test_batch_analysis(self):
+        analyses = self.a.batch_analysis([b'a b \xc2\xb6\n', b'c \xc2\xb6\n'])
+
+        self.assertEqual(
+            analyses,
+            [(b'"<a>"\n\t"a" N\n"<b>"\n\t"b" N\n"<\xc2\xb6>"\n'
+              b'\t"\xc2\xb6" N\n',) * 2,
+             (b'"<c>"\n\t"c" N\n"<\xc2\xb6>"\n\t"\xc2\xb6" N\n',) * 2])
+        self.assertEqual(self.a.runs,
+                         ['preprocess', 'lookup', 'lookup2cg', 'vislcg3',
+                          'vislcg3', 'vislcg3'])
+
+    def test_hfst_batch_analysis(self):
+        a = self.make_analyser(HfstToolsAnalyser, fstkit='hfst',
+                               batch_size=2)
+        analyses = a.batch_analysis([b'a b \xc2\xb6\n', b'c \xc2\xb6\n'])
+
+        self.assertEqual([disambiguation for disambiguation, _ in analyses],
+                         [b'"<a>"\n\t"a" N\n"<b>"\n\t"b" N\n"<\xc2\xb6>"\n'
+                          b'\t"\xc2\xb6" N\n',
+                          b'"<c>"\n\t"c" N\n"<\xc2\xb6>"\n\t"\xc2\xb6" N\n'])
+        self.assertEqual(a.runs,
+                         ['lookup2cg', 'vislcg3', 'vislcg3', 'vislcg3'])
+
+    def test_batch_analysis_unsplittable(self):
+        self.a.delimiter_to_flush = lambda cg: cg
+        self.assertIsNone(self.a.batch_analysis([b'a \xc2\xb6\n',
+                                                 b'b \xc2\xb6\n']))
+
+    def test_analyse_batch(self):
+        xml_files = self.make_files(['a.xml', 'b.xml'])
+        self.a.analyse_batch(xml_files)
+
+        self.assertEqual(self.a.runs.count('lookup'), 1)
+        for name in ['a.xml', 'b.xml']:
+            analysed = etree.parse(
+                os.path.join(self.tmpdir, 'analysed', 'sme', name))
+            self.assertTrue(analysed.find('.//dependency').text.startswith(
+                '"<Muhto>"'))
+            self.assertTrue(analysed.find('.//dependency').text.endswith(
+                '"<¶>"\n\t"¶" N\n'))
+
+    def test_unwritable_analysis(self):
+        xml_files = self.make_files(['a.xml', 'b.xml'])
+        os.makedirs(self.a.analysis_name(xml_files[0]))
+
+        results = self.a.analyse_batch(xml_files)
+
+        self.assertEqual([result['status'] for result in results],
+                         ['failed', 'analysed'])
+        self.assertIsNotNone(results[0]['error'])
+
+    def test_batch_errors_name_all_files(self):
+        def run_lookup(preprocess):
+            self.a.check_error(['lookup'], b'lookup complains')
+            return preprocess
+
+        self.a.run_lookup = run_lookup
+        stderr = StringIO.StringIO()
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = stderr
+        xml_files = self.make_files(['a.xml', 'b.xml'])
+        self.a.analyse_batch(xml_files)
+
+        self.assertIn('In the batch of {}, {}\n'.format(*xml_files),
+                      stderr.getvalue())
+        self.assertIsNone(self.a.batch_files)
+
+
+class TestAnalyserStaleness(AnalyserTestCase):
+    def setUp(self):
+        super(TestAnalyserStaleness, self).setUp()
+        for name in ['analyser.xfst', 'disambiguation.cg3', 'functions.cg3',
+                     'dependency.cg3']:
+            grammar = os.path.join(self.tmpdir, name)
+            shutil.copy(os.path.join(here, name), grammar)
+            os.utime(grammar, (1000, 1000))
+
+        self.a = self.make_analyser(analyser.Analyser,
+                                    grammar_dir=self.tmpdir)
+
+        self.converted, = self.make_files(['file.xml'])
+        self.analysed = os.path.join(self.tmpdir, 'analysed', 'sme',
+                                     'file.xml')
+        os.makedirs(os.path.dirname(self.analysed))
+        shutil.copy(os.path.join(here, 'smefile.xml'), self.analysed)
+        os.utime(self.converted, (2000, 2000))
+        os.utime(self.analysed, (3000, 3000))
+
+    def test_uptodate(self):
+        self.assertFalse(self.a.is_stale(self.converted))
+
+    def test_missing_analysis(self):
+        os.remove(self.analysed)
+        self.assertTrue(self.a.is_stale(self.converted))
+
+    def test_newer_converted_file(self):
+        os.utime(self.converted, (4000, 4000))
+        self.assertTrue(self.a.is_stale(self.converted))
+
+    def test_newer_grammar(self):
+        os.utime(self.a.function_analysis_file, (4000, 4000))
+        self.assertTrue(self.a.is_stale(self.converted))
+
+    def test_collect_files(self):
+        converted_dir = os.path.join(self.tmpdir, 'converted')
+        self.a.collect_files([converted_dir], force=False)
+        self.assertEqual((self.a.xml_files, self.a.uptodate), ([], 1))
+
+        self.a.collect_files([converted_dir], force=True)
+        self.assertEqual((self.a.xml_files, self.a.uptodate),
+                         ([self.converted], 0))
+
+    def test_marker(self):
+        os.remove(self.analysed)
+        self.a.record_outcome({'xml_file': self.converted, 'status': 'ocr'})
+        self.assertFalse(self.a.is_stale(self.converted))
+
+        os.utime(self.a.marker_name(self.converted), (1500, 1500))
+        self.assertTrue(self.a.is_stale(self.converted))
+
+    def test_newer_marker(self):
+        self.a.record_outcome({'xml_file': self.converted,
+                               'status': 'empty'})
+        os.utime(self.analysed, (1500, 1500))
+        self.assertFalse(self.a.is_stale(self.converted))
+
+    def test_no_marker_for_failures(self):
+        os.remove(self.analysed)
+        self.a.record_outcome({'xml_file': self.converted,
+                               'status': 'failed'})
+        self.assertFalse(os.path.exists(self.a.marker_name(self.converted)))
+        self.assertTrue(self.a.is_stale(self.converted))
+
+
+class SleepingAnalyser(ShellToolsAnalyser):
+    '''The dependency analysis hangs'''
+    def vislcg3_command(self, grammar):
+        if grammar == self.dependency_analysis_file:
+            return ['sleep', '10']
+        return super(SleepingAnalyser, self).vislcg3_command(grammar)
+
+
+class TestAnalyserScheduling(AnalyserTestCase):
+    def test_analyse_result(self):
+        a = self.make_analyser(FakeToolsAnalyser)
+        xml_file, = self.make_files(['a.xml'], paragraphs=[2])
+        result = a.analyse(xml_file)
+
+        self.assertEqual(result['xml_file'], xml_file)
+        self.assertEqual(result['size'], os.path.getsize(xml_file))
+        self.assertEqual(result['status'], 'analysed')
+        self.assertIsNone(result['error'])
+        self.assertIn('dependency', result['timings'].stages)
+
+    def test_analyse_batch_results(self):
+        a = self.make_analyser(FakeToolsAnalyser, batch_size=3)
+        xml_files = self.make_files(['a.xml', 'empty.xml', 'b.xml'],
+                                    paragraphs=[2, 0, 1])
+        results = a.analyse_batch(xml_files)
+
+        self.assertEqual([result['status'] for result in results],
+                         ['analysed', 'empty', 'analysed'])
+        self.assertIn('dependency', results[0]['timings'].stages)
+        self.assertIsNone(results[1]['timings'])
+
+    def test_empty_files_are_up_to_date(self):
+        a = self.make_analyser(FakeToolsAnalyser, batch_size=2)
+        xml_files = self.make_files(['a.xml', 'empty.xml'], paragraphs=[2, 0])
+        a.analyse_batch(xml_files)
+        a.analyse(xml_files[1])
+
+        self.assertEqual([a.is_stale(xml_file) for xml_file in xml_files],
+                         [False, False])
+
+    def test_largest_first(self):
+        a = self.make_analyser(FakeToolsAnalyser, batch_size=2)
+        a.xml_files = self.make_files(['small.xml', 'large.xml', 'medium.xml'],
+                                      paragraphs=[1, 3, 2])
+        self.assertEqual(
+            [[os.path.basename(name) for name in batch]
+             for batch in a.batches()],
+            [['large.xml', 'medium.xml'], ['small.xml']])
+
+    def test_default_batch_size(self):
+        self.assertEqual(
+            self.make_analyser(FakeToolsAnalyser).batch_size,
+            analyser.Analyser.default_batch_size)
+        self.assertEqual(
+            self.make_analyser(FakeToolsAnalyser, pipe=True).batch_size, 1)
+        self.assertEqual(
+            self.make_analyser(FakeToolsAnalyser, pipe=True,
+                               batch_size=5).batch_size, 5)
+
+    def test_pool_size(self):
+        a = self.make_analyser(ShellToolsAnalyser, jobs=3)
+        self.assertEqual(a.pool_size(), 3)
+
+        a.jobs = None
+        self.assertGreaterEqual(a.pool_size(), 1)
+
+    def test_processes_per_task(self):
+        a = self.make_analyser(ShellToolsAnalyser)
+        self.assertEqual(a.processes_per_task(), 1)
+        a.pipe = True
+        self.assertEqual(a.processes_per_task(), 7)
+
+    def test_memory_per_task(self):
+        a = self.make_analyser(ShellToolsAnalyser)
+        sizes = [os.path.getsize(name) for name in a.dependencies]
+        self.assertEqual(a.memory_per_task(), max(sizes) * 2)
+        a.pipe = True
+        self.assertEqual(a.memory_per_task(), sum(sizes) * 2)
+
+    def test_timeout(self):
+        a = self.make_analyser(SleepingAnalyser, timeout=0.5)
+        xml_file, = self.make_files(['a.xml'], paragraphs=[2])
+        result = a.analyse(xml_file)
+
+        self.assertEqual(result['status'], 'timeout')
+        self.assertEqual(result['error'], 'sleep timed out')
+
+    def test_pipe_timeout(self):
+        a = self.make_analyser(SleepingAnalyser, timeout=0.5, pipe=True)
+        xml_file, = self.make_files(['a.xml'], paragraphs=[2])
+        self.assertEqual(a.analyse(xml_file)['status'], 'timeout')
+
+    def test_analyse_in_parallel(self):
+        a = self.make_analyser(FakeToolsAnalyser, jobs=2)
+        a.xml_files = self.make_files(['a.xml', 'b.xml', 'c.xml'],
+                                      paragraphs=[2, 1, 3])
+        results = a.analyse_in_parallel()
+
+        self.assertEqual(sorted(result['xml_file'] for result in results),
+                         sorted(a.xml_files))
+        self.assertEqual(set(result['status'] for result in results),
+                         set(['analysed']))
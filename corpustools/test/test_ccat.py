@@ -1,10 +1,15 @@
 # -*- coding:utf-8 -*-
 
 from corpustools import ccat
+from corpustools import util
 import unittest
 from lxml import etree
 import io
 import cStringIO
+import os
+import pickle
+import shutil
+import tempfile
 
 
 class TestCcatHyph(unittest.TestCase):
@@ -1281,3 +1286,191 @@ class TestCcat(unittest.TestCase):
                 '\t"aggregáhta" N Sg Nom @SUBJ> #11->12 \n"<billánii>"\n'
                 '\t"billánit" V IV Ind Prt Sg3 @FS-ADVL> #12->0 \n"<.>"\n'
                 '\t"." CLB #13->12 \n\n"<¶>"\n\t"¶" CLB #1->1 \n\n'))
+
+
+class TestCcatStream(unittest.TestCase):
+    '''Test that stream_file gives the same output as process_file
+    '''
+    document = (
+        '<document id="no_id" xml:lang="sme">'
+        '<header><title>Test</title></header>'
+        '<body>'
+        '<p type="title">Bajil<hyph/>čála</p>'
+        '<p>Mun lean <errorort correct="sámegiel">sámegiel</errorort> '
+        '<span type="quote" xml:lang="nob">ikke samisk</span></p>'
+        '<p>mellom<hyph/>krigs<hyph/>tiden</p>'
+        '<section><p type="listitem">Nubbi</p>'
+        '<p>Goalmmát <errorlang correct="norsk">dárogiella</errorlang>'
+        '</p></section>'
+        '</body>'
+        '</document>')
+
+    def assertSameOutput(self, **options):
+        xml_printer = ccat.XMLPrinter(**options)
+        xml_printer.etree = etree.parse(io.BytesIO(self.document))
+        expected = xml_printer.process_file().getvalue()
+
+        xml_printer = ccat.XMLPrinter(**options)
+        buffer = cStringIO.StringIO()
+        xml_printer.stream_file(io.BytesIO(self.document), buffer)
+
+        self.assertEqual(buffer.getvalue(), expected)
+        return buffer.getvalue()
+
+    def test_default(self):
+        self.assertEqual(
+            self.assertSameOutput(),
+            'Mun lean sámegiel ikke samisk ¶\n'
+            'mellomkrigstiden ¶\n'
+            'Goalmmát dárogiella ¶\n')
+
+    def test_options(self):
+        for options in [{'all_paragraphs': True},
+                        {'title': True, 'listitem': True},
+                        {'lang': 'nob'},
+                        {'lang': '!nob'},
+                        {'hyph_replacement': 'xml'},
+                        {'hyph_replacement': None},
+                        {'one_word_per_line': True},
+                        {'typos': True},
+                        {'correction': True},
+                        {'errorort': True},
+                        {'noforeign': True}]:
+            self.assertSameOutput(**options)
+
+    def test_missing_lang_without_paragraphs(self):
+        xml_printer = ccat.XMLPrinter(table=True)
+        buffer = cStringIO.StringIO()
+        xml_printer.stream_file(
+            io.BytesIO('<document><body><p>Tekst</p></body></document>'),
+            buffer)
+        self.assertEqual(buffer.getvalue(), '')
+
+
+class TestCcatParallel(unittest.TestCase):
+    '''Test the corpus wide, parallel ccat
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.corpus = os.path.join(self.tmpdir, 'converted')
+        for relpath, text in [('b/one.xml', 'Okta'),
+                              ('a/two.xml', 'Guokte'),
+                              ('a/c/three.xml', 'Golbma'),
+                              ('four.xml', 'Njeallje')]:
+            path = os.path.join(self.corpus, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as xml_file:
+                xml_file.write(
+                    '<document xml:lang="sme"><body><p>{}</p></body>'
+                    '</document>'.format(text))
+        with open(os.path.join(self.corpus, 'notxml.txt'), 'w') as txt_file:
+            txt_file.write('not xml')
+
+    def test_find_xml_files(self):
+        self.assertEqual(
+            [relpath for _, relpath in ccat.find_xml_files([self.corpus])],
+            ['four.xml', 'a/two.xml', 'a/c/three.xml', 'b/one.xml'])
+
+    def test_find_xml_files_in_two_targets(self):
+        targets = [os.path.join(self.corpus, 'a'),
+                   os.path.join(self.corpus, 'b'),
+                   os.path.join(self.corpus, 'four.xml')]
+        self.assertEqual(
+            [relpath for _, relpath in ccat.find_xml_files(targets)],
+            ['a/two.xml', 'a/c/three.xml', 'b/one.xml', 'four.xml'])
+
+    def test_same_name_in_two_targets(self):
+        other = os.path.join(self.tmpdir, 'other')
+        os.makedirs(os.path.join(other, 'a'))
+        shutil.copy(os.path.join(self.corpus, 'a', 'two.xml'),
+                    os.path.join(other, 'a', 'two.xml'))
+        files = list(ccat.find_xml_files([self.corpus, other]))
+
+        self.assertEqual(
+            [relpath for _, relpath in files],
+            ['converted/four.xml', 'converted/a/two.xml',
+             'converted/a/c/three.xml', 'converted/b/one.xml',
+             'other/a/two.xml'])
+        ccat.check_output_names(self.tmpdir, files)
+
+    def test_check_output_names(self):
+        target = os.path.join(self.corpus, 'four.xml')
+        files = list(ccat.find_xml_files([target, target]))
+
+        self.assertRaises(util.ArgumentError, ccat.check_output_names,
+                          self.tmpdir, files)
+
+    def test_ccat_in_parallel(self):
+        files = list(ccat.find_xml_files([self.corpus]))
+        results = list(ccat.ccat_in_parallel(ccat.XMLPrinter(), files, 2,
+                                             buffer_size=2))
+
+        self.assertEqual([(path, relpath) for path, relpath, _ in results],
+                         files)
+        self.assertEqual([text for _, _, text in results],
+                         ['Njeallje ¶\n', 'Guokte ¶\n', 'Golbma ¶\n',
+                          'Okta ¶\n'])
+
+    def test_open_output(self):
+        with ccat.open_output(self.tmpdir, 'a/c/three.xml') as output:
+            output.write('Golbma ¶\n')
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.tmpdir, 'a/c/three.txt')))
+
+
+class TestCcatDispatch(unittest.TestCase):
+    '''Test the handler table of XMLPrinter
+    '''
+    def test_handlers(self):
+        xml_printer = ccat.XMLPrinter(errorort=True, noforeign=True)
+
+        self.assertEqual(xml_printer.handlers['errorort'],
+                         xml_printer.visit_child_error_inline)
+        self.assertEqual(xml_printer.handlers['errorlex'],
+                         xml_printer.visit_child_nonerror)
+        self.assertEqual(xml_printer.handlers['errorlang'],
+                         xml_printer.visit_child_tail)
+
+    def test_unknown_tag(self):
+        xml_printer = ccat.XMLPrinter(correction=True)
+        textlist = []
+        xml_printer.visit_children(
+            etree.fromstring('<p><errorx correct="b">a</errorx></p>'),
+            textlist, 'sme')
+
+        self.assertEqual(textlist, ['b'])
+        self.assertEqual(xml_printer.handlers['errorx'],
+                         xml_printer.visit_child_error_inline)
+
+    def test_nested_errorlang_not_inline(self):
+        paragraph = etree.fromstring(
+            '<p>x <errorort correct="x1">a <errorlang correct="y">b'
+            '</errorlang> c</errorort> z</p>')
+        for options, expected in [
+                (dict(typos=True, noforeign=True), 'a y c\tx1\nb\ty\n'),
+                (dict(one_word_per_line=True, noforeign=True),
+                 'x\na y c\tx1\nb\ty\nc\nz\n')]:
+            buffer = io.BytesIO()
+            ccat.XMLPrinter(**options).collect_text(paragraph, 'sme', buffer)
+            self.assertEqual(buffer.getvalue(), expected)
+
+    def test_pickle(self):
+        xml_printer = pickle.loads(pickle.dumps(ccat.XMLPrinter(typos=True)))
+        self.assertEqual(xml_printer.handlers['errorort'],
+                         xml_printer.visit_child_error_not_inline)
+
+
+class TestHasText(unittest.TestCase):
+    def test_has_text(self):
+        for document, expected in [
+                ('<document><body><p> </p><p><em> </em> </p></body>'
+                 '</document>', False),
+                ('<document><body><p/><p> <em/>a</p></body></document>',
+                 True),
+                ('<document><body><p><span><em>a</em></span></p></body>'
+                 '</document>', True)]:
+            self.assertEqual(ccat.has_text(etree.fromstring(document)),
+                             expected)
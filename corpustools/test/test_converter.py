@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 import unittest
 import codecs
+import glob
 import io
+import json
 import os
+import pstats
+import shutil
+import tempfile
+import time
 import lxml.etree as etree
 import lxml.doctestcompare as doctestcompare
 from lxml.html import html5parser
@@ -11,6 +17,7 @@ import doctest
 from corpustools import converter
 from corpustools import text_cat
 from corpustools import util
+from corpustools import xslsetter
 
 
 here = os.path.dirname(__file__)
@@ -138,6 +145,28 @@ class TestConverter(unittest.TestCase):
         self.assertRaises(converter.ConversionException,
                           self.converter_inside_orig.validate_complete, complete)
 
+
+class TestConverterResources(unittest.TestCase):
+    def test_validate_complete_loads_dtd_once(self):
+        '''Check that the DTD is only parsed once per process
+        '''
+        conv = converter.Converter(
+            os.path.join(here,
+                         'converter_data/fakecorpus/orig/nob/samediggi-'
+                         'article-16.html'))
+        self.addCleanup(os.remove, conv.logfile)
+        complete = etree.fromstring('<document/>')
+        converter.RESOURCES.get('dtd')
+        load_count = converter.RESOURCES.load_count
+
+        for _ in range(2):
+            self.assertRaises(converter.ConversionException,
+                              conv.validate_complete,
+                              complete)
+
+        self.assertEqual(converter.RESOURCES.load_count, load_count)
+
+
 class XMLTester(unittest.TestCase):
     def assertXmlEqual(self, got, want):
         """Check if two stringified xml snippets are equal
@@ -2602,6 +2631,306 @@ class TestXslMaker(XMLTester):
         want = etree.parse(os.path.join(here, 'converter_data/test.xsl'))
         self.assertXmlEqual(etree.tostring(got), etree.tostring(want))
 
+    def test_transformer_cache(self):
+        '''Check that identical metadata reuses the compiled transformer
+        '''
+        filename = os.path.join(here,
+                                'converter_data/samediggi-article-48.html.xsl')
+        converter.XslMaker.cache.clear()
+        hits = converter.XslMaker.cache_stats['hits']
+        misses = converter.XslMaker.cache_stats['misses']
+
+        first = converter.XslMaker(filename).transformer
+        second = converter.XslMaker(filename).transformer
+
+        self.assertIs(first, second)
+        self.assertEqual(converter.XslMaker.cache_stats['hits'], hits + 1)
+        self.assertEqual(converter.XslMaker.cache_stats['misses'], misses + 1)
+
+    def test_cache_key_ignores_comments(self):
+        '''Check that comments do not influence the cache key
+        '''
+        without_comment = etree.fromstring(
+            '<xsl:stylesheet '
+            'xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">'
+            '<xsl:variable name="title" select="\'a\'"/>'
+            '</xsl:stylesheet>')
+        with_comment = etree.fromstring(
+            '<xsl:stylesheet '
+            'xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">'
+            '<!-- the title --><xsl:variable name="title" select="\'a\'"/>'
+            '</xsl:stylesheet>')
+
+        self.assertEqual(converter.XslMaker.cache_key(without_comment),
+                         converter.XslMaker.cache_key(with_comment))
+
+
+class TmpCorpusTester(unittest.TestCase):
+    '''Set up a corpus with one original file in a temporary directory'''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.orig = os.path.join(self.tmpdir, 'orig/sme/admin/a.txt')
+        os.makedirs(os.path.dirname(self.orig))
+        with open(self.orig, 'w') as orig:
+            orig.write('Sámediggi lea sámiid álbmotválljen orgána.\n')
+        metadata = xslsetter.MetadataHandler(self.orig + '.xsl', create=True)
+        metadata.write_file()
+        self.manifest_name = os.path.join(self.tmpdir, 'manifest.jsonl')
+
+
+class TestBuildManifest(TmpCorpusTester):
+    def convert(self):
+        manager = converter.ConverterManager(
+            False, converter.BuildManifest(self.manifest_name))
+        manager.FILES = [self.orig + '.xsl']
+        results = [manager.convert(xsl_file)
+                   for xsl_file in manager.files_to_convert()]
+        for result in results:
+            manager.handle_result(result)
+        manager.finish(results)
+
+        return results
+
+    def test_unknown_file_is_stale(self):
+        manifest = converter.BuildManifest(self.manifest_name)
+        self.assertTrue(manifest.is_stale(self.orig + '.xsl'))
+
+    def test_skip_unchanged(self):
+        self.assertEqual([result['status'] for result in self.convert()],
+                         ['converted'])
+        self.assertEqual(self.convert(), [])
+
+    def test_touched_file_is_not_stale(self):
+        self.convert()
+        later = time.time() + 10
+        os.utime(self.orig, (later, later))
+
+        self.assertEqual(self.convert(), [])
+
+    def test_changed_file_is_stale(self):
+        self.convert()
+        with open(self.orig, 'a') as orig:
+            orig.write('Ođđa cealkka.\n')
+
+        self.assertEqual([result['status'] for result in self.convert()],
+                         ['converted'])
+
+    def test_removed_converted_file_is_stale(self):
+        result = self.convert()[0]
+        os.remove(result['converted'])
+
+        manifest = converter.BuildManifest(self.manifest_name)
+        self.assertTrue(manifest.is_stale(self.orig + '.xsl'))
+
+    def test_changed_dependencies(self):
+        self.convert()
+        manifest = converter.BuildManifest(self.manifest_name)
+        manifest.dependencies = 'something else'
+
+        self.assertTrue(manifest.is_stale(self.orig + '.xsl'))
+
+
+class TestConverterManagerConvert(TmpCorpusTester):
+    def test_result(self):
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+
+        self.assertEqual(result['status'], 'converted')
+        self.assertEqual(result['converter'], 'PlaintextConverter')
+        self.assertEqual(result['orig_size'], os.path.getsize(self.orig))
+        self.assertEqual(result['converted_size'],
+                         os.path.getsize(result['converted']))
+        self.assertIsNone(result['error'])
+        for stage in ['setup', 'intermediate', 'xslt', 'validate',
+                      'errormarkup', 'fix', 'fix.fix_newstags',
+                      'fix.detect_quotes', 'fix.fix_body_encoding',
+                      'languagedetection', 'write']:
+            self.assertIn(stage, result['timings'])
+
+    def test_fix_is_timed_without_its_steps(self):
+        detect_quotes = converter.DocumentFixer.detect_quotes
+
+        def slow_detect_quotes(fixer):
+            time.sleep(0.2)
+            detect_quotes(fixer)
+
+        converter.DocumentFixer.detect_quotes = slow_detect_quotes
+        self.addCleanup(setattr, converter.DocumentFixer, 'detect_quotes',
+                        detect_quotes)
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+
+        self.assertGreaterEqual(result['timings']['fix.detect_quotes'], 0.2)
+        self.assertLess(result['timings']['fix'], 0.2)
+
+    def test_setup_is_timed_without_extraction(self):
+        init = converter.PlaintextConverter.__init__
+
+        def extracting_init(conv, *args, **kwargs):
+            init(conv, *args, **kwargs)
+            with conv.timings.timer('extract'):
+                time.sleep(0.2)
+
+        converter.PlaintextConverter.__init__ = extracting_init
+        self.addCleanup(setattr, converter.PlaintextConverter, '__init__',
+                        init)
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+
+        self.assertGreaterEqual(result['timings']['extract'], 0.2)
+        self.assertLess(result['timings']['setup'], 0.2)
+
+    def test_profile(self):
+        profile_dir = os.path.join(self.tmpdir, 'profile')
+        os.mkdir(profile_dir)
+        manager = converter.ConverterManager(False, profile_dir=profile_dir)
+        manager.FILES = [self.orig + '.xsl']
+        manager.convert_serially()
+
+        self.assertEqual(os.listdir(profile_dir),
+                         ['PlaintextConverter.prof'])
+
+    def test_profile_in_parallel(self):
+        profile_dir = os.path.join(self.tmpdir, 'profile')
+        os.mkdir(profile_dir)
+        manager = converter.ConverterManager(False, jobs=1,
+                                             profile_dir=profile_dir)
+        manager.FILES = [self.orig + '.xsl']
+        manager.convert_in_parallel()
+
+        self.assertEqual(os.listdir(profile_dir),
+                         ['PlaintextConverter.prof'])
+
+    def keep_language_guesser_results(self):
+        languageguesser = converter.RESOURCES.get('languageguesser')
+        self.addCleanup(setattr, languageguesser, 'results',
+                        languageguesser.results)
+
+    def test_language_cache(self):
+        self.keep_language_guesser_results()
+        language_cache = os.path.join(self.tmpdir, 'langcache')
+        manager = converter.ConverterManager(False,
+                                             language_cache=language_cache)
+        manager.FILES = [self.orig + '.xsl']
+        manager.convert_serially()
+
+        self.assertGreater(
+            len(text_cat.ResultCache(filename=language_cache).entries), 0)
+
+    def test_language_cache_in_parallel(self):
+        self.keep_language_guesser_results()
+        language_cache = os.path.join(self.tmpdir, 'langcache')
+        manager = converter.ConverterManager(False, jobs=1,
+                                             language_cache=language_cache)
+        manager.FILES = [self.orig + '.xsl']
+        manager.convert_in_parallel()
+
+        self.assertGreater(
+            len(text_cat.ResultCache(filename=language_cache).entries), 0)
+        self.assertEqual(glob.glob(language_cache + '.*'), [])
+
+    def test_profile_is_replaced(self):
+        profile_dir = os.path.join(self.tmpdir, 'profile')
+        os.mkdir(profile_dir)
+        profile_name = os.path.join(profile_dir, 'PlaintextConverter.prof')
+        manager = converter.ConverterManager(False, profile_dir=profile_dir)
+        manager.FILES = [self.orig + '.xsl']
+
+        calls = []
+        for _ in range(2):
+            manager.convert_serially()
+            calls.append(pstats.Stats(profile_name).total_calls)
+
+        self.assertLess(calls[1], calls[0] * 1.5)
+
+    def test_failed_result(self):
+        with open(self.orig + '.xsl', 'w') as xsl:
+            xsl.write('<xsl:stylesheet')
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('Syntax error', result['error'])
+
+    def test_report(self):
+        report_name = os.path.join(self.tmpdir, 'report.jsonl')
+        manager = converter.ConverterManager(False, report=report_name)
+        manager.FILES = [self.orig + '.xsl']
+        manager.convert_serially()
+
+        with open(report_name) as report:
+            results = [json.loads(line) for line in report]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['status'], 'converted')
+
+    def test_monolingual_skips_languageguesser(self):
+        metadata = xslsetter.MetadataHandler(self.orig + '.xsl')
+        metadata.set_variable('monolingual', '1')
+        metadata.write_file()
+        converter.RESOURCES.resources.pop('languageguesser', None)
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+
+        self.assertEqual(result['status'], 'converted')
+        self.assertNotIn('languageguesser', converter.RESOURCES.resources)
+
+    def test_multilingual_loads_languageguesser(self):
+        converter.RESOURCES.resources.pop('languageguesser', None)
+        manager = converter.ConverterManager(False)
+        manager.convert(self.orig + '.xsl')
+
+        self.assertIn('languageguesser', converter.RESOURCES.resources)
+
+    def test_language_cache_stats(self):
+        manager = converter.ConverterManager(False)
+        result = manager.convert(self.orig + '.xsl')
+        self.assertEqual(sorted(result['language_cache']), ['hits', 'misses'])
+        self.assertEqual(sum(result['language_cache'].values()), 1)
+        self.assertEqual(result['language_stats'],
+                         {'classified': 1, 'inherited': 0, 'lexicon': 0})
+
+
+class TestConversionProgress(unittest.TestCase):
+    def test_line(self):
+        out = io.BytesIO()
+        progress = converter.ConversionProgress(3, out=out)
+        progress.add({'status': 'converted'})
+        progress.add({'status': 'failed'})
+
+        self.assertTrue(progress.line().startswith('[2/3] 1 failed'))
+        self.assertEqual(out.getvalue().count('\r'), 2)
+
+
+class TestConverterManagerSchedule(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.files = []
+        for name, size in [('small.txt', 10), ('medium.pdf', 100),
+                           ('large.txt', 1000), ('unknown.xyz', 5000)]:
+            orig = os.path.join(self.tmpdir, name)
+            with open(orig, 'w') as orig_file:
+                orig_file.write('a' * size)
+            self.files.append(orig + '.xsl')
+
+    def test_largest_first(self):
+        manager = converter.ConverterManager(False)
+        self.assertEqual(
+            [os.path.basename(xsl_file)
+             for xsl_file in manager.schedule(self.files)],
+            ['large.txt.xsl', 'medium.pdf.xsl', 'small.txt.xsl',
+             'unknown.xyz.xsl'])
+
+    def test_cost_weights(self):
+        manager = converter.ConverterManager(
+            False, cost_weights={'PDF2XMLConverter': 20.0})
+        self.assertEqual(
+            [os.path.basename(xsl_file)
+             for xsl_file in manager.schedule(self.files)],
+            ['medium.pdf.xsl', 'large.txt.xsl', 'small.txt.xsl',
+             'unknown.xyz.xsl'])
+
 
 class TestPDF2XMLConverter(XMLTester):
     '''Test the class that converts from pdf2xml to giellatekno/divvun xml
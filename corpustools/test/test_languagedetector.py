@@ -220,3 +220,52 @@ class TestLanguageDetector(XMLTester):
 
         self.assertXmlEqual(etree.tostring(got_document),
                             etree.tostring(expected_document))
+
+
+class TestTrivialPolicy(XMLTester):
+    '''Test how LanguageDetector handles texts that are too short'''
+    def detect(self, trivial_policy):
+        self.root = etree.fromstring(
+            '<document xml:lang="sme">'
+            '<header><multilingual>'
+            '<language xml:lang="nob"/>'
+            '</multilingual></header>'
+            '<body>'
+            '<p>2014-2017</p>'
+            '<p>dessuten</p>'
+            '<p>ikke</p>'
+            '<p>Sametinget er samenes folkevalgte organ i Norge</p>'
+            '</body>'
+            '</document>')
+        language_detector = converter.LanguageDetector(
+            self.root, LANGUAGEGUESSER, trivial_policy=trivial_policy)
+        language_detector.detect_language()
+
+        return language_detector.stats
+
+    def langs(self):
+        return [p.get('{http://www.w3.org/XML/1998/namespace}lang')
+                for p in self.root.iter('p')]
+
+    def test_classify(self):
+        self.assertEqual(self.detect('classify'),
+                         {'classified': 4, 'inherited': 0, 'lexicon': 0})
+        self.assertEqual(self.langs()[1:], ['nob', 'nob', 'nob'])
+
+    def test_script(self):
+        self.assertEqual(self.detect('script'),
+                         {'classified': 3, 'inherited': 1, 'lexicon': 0})
+        self.assertEqual(self.langs(), [None, 'nob', 'nob', 'nob'])
+
+    def test_inherit(self):
+        self.assertEqual(self.detect('inherit'),
+                         {'classified': 1, 'inherited': 3, 'lexicon': 0})
+        self.assertEqual(self.langs(), [None, None, None, 'nob'])
+
+    def test_lexicon(self):
+        self.assertEqual(self.detect('lexicon'),
+                         {'classified': 1, 'inherited': 2, 'lexicon': 1})
+        self.assertEqual(self.langs(), [None, 'nob', None, 'nob'])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, self.detect, 'guess')
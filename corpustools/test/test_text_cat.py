@@ -3,9 +3,13 @@
 
 from __future__ import unicode_literals
 
+import glob
+import json
 import unittest
 import os
+import shutil
 import StringIO
+import tempfile
 
 from corpustools import text_cat
 
@@ -45,6 +49,41 @@ class TestTextCat(unittest.TestCase):
             guesser.classify("eg køyrer ikkje"),
             "nob")              # because restriction
 
+    def test_classify_many(self):
+        guesser = text_cat.Classifier()
+        texts = ["eg køyrer ikkje",
+                 "",
+                 "Sámediggi nammada sámi báikenammakonsuleanttaid",
+                 "Regional utvikling"]
+        self.assertEqual(guesser.classify_many(texts),
+                         [guesser.classify(text) for text in texts])
+        self.assertEqual(
+            guesser.classify_many(texts, langs=["nob", "sma"]),
+            [guesser.classify(text, langs=["nob", "sma"]) for text in texts])
+        self.assertEqual(guesser.classify_many([]), [])
+
+    def test_tokenise(self):
+        model = text_cat.NGramModel()
+        self.assertEqual(model.tokenise(""), [])
+        self.assertEqual(model.tokenise(" \t"), [])
+        self.assertEqual(model.tokenise("ja,  dat\u00a0lea (ok)"),
+                         ["ja", "", "dat", "lea", "", "ok", ""])
+
+    def test_freq_of_text_file(self):
+        text = "šuhkoláda ja gáhkku\nja gáfe ja\ngáhkku\n"
+        for Model in [text_cat.CharModel, text_cat.WordModel]:
+            model = Model()
+            model.CHUNK_LINES = 2
+            freq = model.freq_of_text_file(
+                StringIO.StringIO(text.encode('utf-8')))
+            self.assertEqual(freq.items(),
+                             Model().freq_of_text(text, {}).items())
+
+    def test_charmodel_grams_of_word(self):
+        self.assertEqual(text_cat.CharModel.grams_of_word("ab"),
+                         ["_", "_a", "_ab", "_ab_", "a", "ab", "ab_",
+                          "b", "b_", "_"])
+
     def test_charmodel_compare(self):
         swe_train = """riksspråkets långa i och u i en mängd ord här (och likartat i det övriga) motsvaras av dette. På samma sätt heter"""
         qer_train = """Ulið witå ig ir faingin få wårå jär å Skansem og sai åv liteð för ið um övkallmåleð. Merkwärdut naug ar eð itte weð kringt noger ar tålåð yvyr dyö jär, fast eð ärer Övdalim og övkallum til mier eld ollt eller."""
@@ -93,3 +132,336 @@ class TestTextCat(unittest.TestCase):
                         wmodel_nob.compare_tc(nob_test, cmodel_nob.compare(ctext_nob)))
         self.assertEqual(0,
                          wmodel_sme.compare_tc(nob_test, cmodel_sme.compare(ctext_nob)))
+
+
+class TestCharModelTable(unittest.TestCase):
+    def setUp(self):
+        self.models = {
+            'swe': text_cat.CharModel().of_text(
+                "riksspråkets långa i och u i en mängd ord här"),
+            'qer': text_cat.CharModel().of_text(
+                "Ulið witå ig ir faingin få wårå jär å Skansem"),
+        }
+        self.unknowns = [
+            text_cat.CharModel().of_text(text)
+            for text in ["Ig dalsker nu að ið ollum",
+                         "sådan slåttermark som bara slås med orv och lie",
+                         "xyz", ""]]
+
+    def compare_all(self):
+        table = text_cat.CharModelTable(self.models)
+        for unknown in self.unknowns:
+            self.assertEqual(
+                table.scores(unknown, ['qer', 'swe']),
+                {lang: model.compare(unknown)
+                 for lang, model in self.models.iteritems()})
+        self.assertEqual(table.scores(self.unknowns[0], ['swe']).keys(),
+                         ['swe'])
+
+    def test_scores(self):
+        self.compare_all()
+
+    def test_scores_without_numpy(self):
+        numpy = text_cat.numpy
+        text_cat.numpy = None
+        try:
+            self.compare_all()
+        finally:
+            text_cat.numpy = numpy
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru(self):
+        cache = text_cat.ResultCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats, {'hits': 2, 'misses': 1})
+
+    def test_update(self):
+        cache = text_cat.ResultCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        other = text_cat.ResultCache(size=2)
+        other.put('a', 3)
+        cache.update(other)
+
+        self.assertEqual(cache.entries.items(), [('b', 2), ('a', 3)])
+
+    def test_classify_many(self):
+        guesser = text_cat.Classifier()
+        texts = ["eg  køyrer ikkje", "eg køyrer\tikkje\n",
+                 "Sámediggi nammada sámi báikenammakonsuleanttaid"]
+        self.assertEqual(guesser.classify_many(texts), ["nno", "nno", "sme"])
+        self.assertEqual(guesser.results.stats, {'hits': 0, 'misses': 3})
+        self.assertEqual(len(guesser.results.entries), 2)
+
+        self.assertEqual(guesser.classify_many(texts), ["nno", "nno", "sme"])
+        self.assertEqual(guesser.results.stats, {'hits': 3, 'misses': 3})
+
+        guesser.classify_many(texts, langs=["nob", "sma"])
+        self.assertEqual(guesser.results.stats, {'hits': 3, 'misses': 6})
+
+    def test_cached_result_is_unchanged(self):
+        guesser = text_cat.Classifier()
+        uncached = text_cat.Classifier(result_cache_size=0)
+        for text in ["Sámediggi nammada sámi", "Sámediggi  nammada sámi"]:
+            self.assertEqual(guesser.classify_full(text),
+                             uncached.classify_full(text))
+        self.assertEqual(uncached.results.stats['hits'], 0)
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'results')
+        guesser = text_cat.Classifier(result_cache_file=filename)
+        guesser.classify("eg køyrer ikkje")
+        guesser.results.save()
+
+        guesser = text_cat.Classifier(result_cache_file=filename)
+        self.assertEqual(guesser.classify("eg køyrer ikkje"), "nno")
+        self.assertEqual(guesser.results.stats, {'hits': 1, 'misses': 0})
+
+        restricted = text_cat.Classifier(langs=["nob", "nno"],
+                                         result_cache_file=filename)
+        self.assertNotEqual(restricted.version, guesser.version)
+
+    def test_load_without_size(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'results')
+        cache = text_cat.ResultCache(filename=filename)
+        cache.put('a', 1)
+        cache.save()
+
+        self.assertEqual(len(text_cat.ResultCache(
+            filename=filename).entries), 1)
+        self.assertEqual(len(text_cat.ResultCache(
+            size=0, filename=filename).entries), 0)
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.model_dir = os.path.join(self.tmpdir, 'lm')
+        os.mkdir(self.model_dir)
+        for fname in ['nob.lm', 'nob.wm', 'sme.lm', 'sme.wm']:
+            shutil.copy(os.path.join(here, '..', 'lm', fname),
+                        self.model_dir)
+
+    def test_cache_is_written(self):
+        text_cat.Classifier(self.model_dir)
+        self.assertTrue(os.path.exists(self.model_dir + '.cache'))
+
+    def test_no_cache(self):
+        text_cat.Classifier(self.model_dir, use_cache=False)
+        self.assertFalse(os.path.exists(self.model_dir + '.cache'))
+
+    def test_cached_models_are_equal(self):
+        uncached = text_cat.Classifier(self.model_dir, use_cache=False)
+        text_cat.Classifier(self.model_dir)
+        cached = text_cat.Classifier(self.model_dir)
+
+        for lang in ['nob', 'sme']:
+            self.assertIsInstance(cached.wmodels[lang].ngrams,
+                                  text_cat.NGramTable)
+            self.assertEqual(dict(cached.cmodels[lang].ngrams.iteritems()),
+                             uncached.cmodels[lang].ngrams)
+            self.assertEqual(dict(cached.wmodels[lang].ngrams.iteritems()),
+                             uncached.wmodels[lang].ngrams)
+            self.assertEqual(dict(cached.wmodels[lang].freq.iteritems()),
+                             uncached.wmodels[lang].freq)
+        self.assertEqual(cached.classify("Regional utvikling"), "nob")
+
+    def test_changed_model_file(self):
+        text_cat.Classifier(self.model_dir)
+        with open(os.path.join(self.model_dir, 'nob.lm'), 'w') as model:
+            model.write('x\t1\n'.encode('utf-8'))
+
+        cached = text_cat.Classifier(self.model_dir)
+        self.assertEqual(cached.cmodels['nob'].ngrams.items(), [('x', 0)])
+        self.assertEqual(
+            len(glob.glob(os.path.join(self.model_dir + '.cache', 'nob.lm.*'))),
+            1)
+
+
+class TestBinaryModel(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, model, name='model'):
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'wb') as binary:
+            model.to_binary_file(binary)
+        return fname
+
+    def test_round_trip(self):
+        model = text_cat.WordModel().of_text(
+            "šuhkoláda ja gáhkku ja gáfe ja gáhkku")
+        fname = self.write(model)
+        self.assertTrue(text_cat.NGramModel.is_binary_file(fname))
+        binary = text_cat.WordModel().of_binary_file(fname)
+
+        self.assertEqual(dict(binary.ngrams.iteritems()), model.ngrams)
+        self.assertEqual(dict(binary.freq.iteritems()), model.freq)
+        self.assertEqual(
+            dict(zip(binary.ngrams, binary.invrank2.tolist())),
+            model.invrank2)
+        self.assertEqual(binary.compare_tc("ja gáfe", 1000),
+                         model.compare_tc("ja gáfe", 1000))
+
+    def test_write_loaded_model(self):
+        model = text_cat.WordModel().of_text(
+            "šuhkoláda ja gáhkku ja gáfe ja gáhkku")
+        binary = text_cat.WordModel().of_binary_file(self.write(model))
+        with open(self.write(binary, 'rewritten'), 'rb') as rewritten:
+            with open(self.write(model, 'written'), 'rb') as written:
+                self.assertEqual(rewritten.read(), written.read())
+
+    def test_lookups(self):
+        model = text_cat.WordModel().of_text(
+            "šuhkoláda ja gáhkku ja gáfe ja gáhkku")
+        binary = text_cat.WordModel().of_binary_file(self.write(model))
+
+        self.assertEqual(binary.ngrams["ja"], model.ngrams["ja"])
+        self.assertIn("šuhkoláda", binary.ngrams)
+        self.assertNotIn("šuhkoládaa", binary.ngrams)
+        self.assertNotIn("j", binary.ngrams)
+        self.assertNotIn("", binary.ngrams)
+        self.assertEqual(
+            binary.ngrams.positions(["ja", "kaffe", "šuhkoládaa"]).tolist(),
+            [binary.ngrams.position("ja"), -1, -1])
+
+    def test_invrank2_many(self):
+        model = text_cat.WordModel().of_text(
+            "šuhkoláda ja gáhkku ja gáfe ja gáhkku")
+        binary = text_cat.WordModel().of_binary_file(self.write(model))
+        words = ["gáfe", "kaffe", "šuhkoládadahkki", "", "ja"]
+
+        self.assertEqual(binary.invrank2_many(words),
+                         model.invrank2_many(words))
+        self.assertEqual(
+            binary.invrank2_many(words, text_cat.encode_grams(words)),
+            model.invrank2_many(words))
+        self.assertIsNone(model.invrank2_many(words)[1])
+
+    def test_compare_tc_freq(self):
+        model = text_cat.WordModel().of_text(
+            "šuhkoláda ja gáhkku ja gáfe ja gáhkku")
+        binary = text_cat.WordModel().of_binary_file(self.write(model))
+        for text, normaliser in [("ja gáfe", 1000), ("kaffe", 900),
+                                 ("", 800), ("gáhkku ja ja", 0)]:
+            freq = model.freq_of_text(text, {})
+            self.assertEqual(binary.compare_tc_freq(freq, normaliser),
+                             model.compare_tc_freq(freq, normaliser))
+
+    def test_empty_model(self):
+        binary = text_cat.WordModel().of_binary_file(
+            self.write(text_cat.WordModel().of_freq({})))
+        self.assertEqual(len(binary.ngrams), 0)
+        self.assertNotIn("ja", binary.ngrams)
+        self.assertEqual(binary.compare_tc("ja", 1000), 0)
+
+    def test_classifier_reads_binary_models(self):
+        model_dir = os.path.join(self.tmpdir, 'lm')
+        os.mkdir(model_dir)
+        for lang in ['nob', 'sme']:
+            for ext, Model in [('.lm', text_cat.CharModel),
+                               ('.wm', text_cat.WordModel)]:
+                fname = os.path.join(here, '..', 'lm', lang + ext)
+                model = Model().of_model_file(open(fname), fname)
+                with open(os.path.join(model_dir, lang + ext), 'wb') as binary:
+                    model.to_binary_file(binary)
+
+        guesser = text_cat.Classifier(model_dir, use_cache=False)
+        self.assertEqual(guesser.classify("Regional utvikling"), "nob")
+        self.assertEqual(guesser.classify("Sámediggi nammada sámi"), "sme")
+
+
+class TestFolderCounter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.corpus = os.path.join(self.tmpdir, 'sme.txt')
+        with open(self.corpus, 'w') as corpus:
+            for i in range(50):
+                corpus.write('Sámediggi lea sámiid álbmotválljen orgána '
+                             '{}.\n'.format(i).encode('utf-8'))
+        with open(os.path.join(self.tmpdir, 'nob.txt'), 'w') as corpus:
+            corpus.write('Sametinget er samenes folkevalgte organ.\n')
+
+    def use_small_shards(self):
+        self.addCleanup(setattr, text_cat.FolderCounter, 'SHARD_SIZE',
+                        text_cat.FolderCounter.SHARD_SIZE)
+        text_cat.FolderCounter.SHARD_SIZE = 100
+
+    def test_shards_cover_file(self):
+        shards = text_cat.FolderCounter.shards(self.corpus)
+        self.assertEqual(len(shards), 1)
+
+        self.use_small_shards()
+        shards = text_cat.FolderCounter.shards(self.corpus)
+        self.assertGreater(len(shards), 1)
+        lines = []
+        for shard in shards:
+            lines.extend(text_cat.shard_lines(*shard))
+        with open(self.corpus) as corpus:
+            self.assertEqual(lines, corpus.readlines())
+
+    def test_counter_gives_same_models(self):
+        self.use_small_shards()
+        counter = text_cat.FolderCounter(self.tmpdir, jobs=2)
+
+        for Model in [text_cat.CharModel, text_cat.WordModel]:
+            serial = text_cat.FolderTrainer(self.tmpdir, Model=Model)
+            counted = text_cat.FolderTrainer(self.tmpdir, Model=Model,
+                                             counter=counter)
+            self.assertEqual(sorted(counted.models), ['nob', 'sme'])
+            for lang, model in serial.models.iteritems():
+                self.assertEqual(counted.models[lang].freq.items(),
+                                 model.freq.items())
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        corpora = {
+            'nob': 'Sametinget er samenes folkevalgte organ i Norge, '
+                   'og det har {} representanter.\n',
+            'sme': 'Sámediggi lea sámiid álbmotválljen orgána Norggas, '
+                   'ja das leat {} áirasa.\n',
+        }
+        for lang, line in corpora.items():
+            with open(os.path.join(self.tmpdir, lang + '.txt'), 'w') as corpus:
+                for i in range(50):
+                    corpus.write(line.format(i).encode('utf-8'))
+
+    def test_split(self):
+        benchmark = text_cat.Benchmark(self.tmpdir, holdout_every=10,
+                                       max_paragraphs=3)
+        paragraphs = benchmark.split()
+        self.assertEqual([lang for lang, paragraph in paragraphs],
+                         ['nob'] * 3 + ['sme'] * 3)
+        self.assertIn('og det har 9 representanter', paragraphs[0][1])
+
+    def test_run(self):
+        results = text_cat.Benchmark(self.tmpdir, holdout_every=5,
+                                     train=True).run()
+
+        self.assertEqual(results['paragraphs'], 20)
+        self.assertEqual(results['confusion'], {'nob': {'nob': 10},
+                                                'sme': {'sme': 10}})
+        self.assertEqual(results['accuracy'], 1.0)
+        self.assertEqual(results['language_accuracy'],
+                         {'nob': 1.0, 'sme': 1.0})
+        self.assertGreater(results['paragraphs_per_second'], 0)
+        self.assertGreater(results['peak_memory_kb'], 0)
+        self.assertTrue(results['parameters']['trained'])
+        json.loads(json.dumps(results))
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from lxml import etree
+
 from corpustools import util
 
 class TestSplitPath(unittest.TestCase):
@@ -25,3 +32,160 @@ class TestSplitPath(unittest.TestCase):
              'bible',
              'osko',
              'omoss.html'))
+
+
+class TestExternalPipelineRunner(unittest.TestCase):
+    def test_run(self):
+        runner = util.ExternalPipelineRunner()
+        runner.run([['tr', 'a-z', 'A-Z'], ['rev'], ['cat']],
+                   to_stdin=b'abc\ndef\n',
+                   tee=[0])
+
+        self.assertEqual(runner.stdout, b'CBA\nFED\n')
+        self.assertEqual(runner.tees, {0: b'ABC\nDEF\n'})
+        self.assertEqual(runner.returncode, [0, 0, 0])
+        self.assertEqual(runner.stderr, [b'', b'', b''])
+
+    def test_missing_command(self):
+        runner = util.ExternalPipelineRunner()
+        with self.assertRaises(OSError):
+            runner.run([['cat'], ['no-such-command-here']], to_stdin=b'a')
+
+    def test_timeout(self):
+        runner = util.ExternalPipelineRunner()
+        runner.run([['cat'], ['sleep', '10']], to_stdin=b'a', timeout=0.2)
+        self.assertTrue(runner.timed_out)
+
+
+class TestExternalCommandRunner(unittest.TestCase):
+    def test_run(self):
+        runner = util.ExternalCommandRunner()
+        runner.run(['rev'], to_stdin=b'abc\n', timeout=10)
+        self.assertEqual(runner.stdout, b'cba\n')
+        self.assertFalse(runner.timed_out)
+
+    def test_timeout(self):
+        runner = util.ExternalCommandRunner()
+        runner.run(['sleep', '10'], timeout=0.2)
+        self.assertTrue(runner.timed_out)
+
+
+class TestResourceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.registry = util.ResourceRegistry()
+        self.registry.register('answer', self.load_answer)
+
+    def load_answer(self):
+        self.loaded.append('answer')
+        return 42
+
+    def test_load_once(self):
+        self.assertEqual(self.registry.get('answer'), 42)
+        self.assertEqual(self.registry.get('answer'), 42)
+        self.assertEqual(self.loaded, ['answer'])
+        self.assertEqual(self.registry.load_count, 1)
+
+    def test_warm(self):
+        self.registry.warm()
+        self.assertEqual(self.registry.load_count, 1)
+        self.registry.get('answer')
+        self.assertEqual(self.registry.load_count, 1)
+
+    def test_warm_names(self):
+        self.registry.register('question', lambda: None)
+        self.registry.warm(['question'])
+        self.assertEqual(self.loaded, [])
+        self.assertEqual(self.registry.resources.keys(), ['question'])
+
+    def test_peek(self):
+        self.assertIsNone(self.registry.peek('answer'))
+        self.registry.get('answer')
+        self.assertEqual(self.registry.peek('answer'), 42)
+
+    def test_clear(self):
+        self.registry.get('answer')
+        self.registry.clear()
+        self.registry.get('answer')
+        self.assertEqual(self.registry.load_count, 2)
+
+
+class TestTimings(unittest.TestCase):
+    def test_timer(self):
+        timings = util.Timings()
+        with timings.timer('stage'):
+            pass
+        with timings.timer('stage'):
+            pass
+
+        self.assertEqual(timings.stages.keys(), ['stage'])
+        self.assertGreaterEqual(timings.stages['stage'], 0.0)
+        self.assertEqual(timings.counts['stage'], 2)
+
+    def test_nested_timer(self):
+        timings = util.Timings()
+        with timings.timer('outer'):
+            with timings.timer('inner'):
+                time.sleep(0.2)
+
+        self.assertGreaterEqual(timings.stages['inner'], 0.2)
+        self.assertLess(timings.stages['outer'], 0.1)
+        self.assertEqual(timings.nested, [])
+
+
+class TestStageHistogram(unittest.TestCase):
+    def test_add(self):
+        histogram = util.StageHistogram()
+        histogram.add('xslt', 0.0005)
+        histogram.add('xslt', 0.05)
+        histogram.add('xslt', 20)
+
+        self.assertEqual(histogram.counts['xslt'], [1, 0, 1, 0, 0, 1])
+        self.assertEqual(histogram.totals['xslt'], 20.0505)
+
+    def test_format(self):
+        histogram = util.StageHistogram()
+        histogram.add('validate', 0.5)
+        lines = histogram.format().split('\n')
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('validate'))
+
+
+class TestWriteXml(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.filename = os.path.join(tmpdir, 'test.xml')
+        self.tree = etree.parse(io.BytesIO(
+            '<!DOCTYPE document><document><body><p>Sámi</p></body>'
+            '</document>'))
+
+    def read(self):
+        with open(self.filename) as xml_file:
+            return xml_file.read()
+
+    def test_write_element(self):
+        util.write_xml(self.tree.getroot(), self.filename)
+
+        self.assertEqual(self.read(),
+                         etree.tostring(self.tree.getroot(), encoding='utf8',
+                                        pretty_print=True))
+
+    def test_write_tree(self):
+        util.write_xml(self.tree, self.filename, xml_declaration=True,
+                       encoding='utf-8')
+
+        self.assertEqual(self.read(),
+                         etree.tostring(self.tree, encoding='utf-8',
+                                        pretty_print=True,
+                                        xml_declaration=True))
+
+    def test_write_tree_like_elementtree(self):
+        util.write_xml(self.tree, self.filename, xml_declaration=True,
+                       encoding='UTF8')
+
+        expected = io.BytesIO()
+        self.tree.write(expected, encoding='utf8', pretty_print=True,
+                        xml_declaration=True)
+        self.assertEqual(self.read(), expected.getvalue())
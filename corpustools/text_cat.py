@@ -36,14 +36,31 @@ from __future__ import unicode_literals
 
 import os
 import glob
+import hashlib
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
 import sys
 import re
+import resource
+import shutil
+import struct
+import tempfile
+import time
 import argparse
+import collections
 
 import argparse_version
 import util
 import gzip
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 here = os.path.dirname(__file__)
 
@@ -68,11 +85,118 @@ def ensure_unicode(text):
         return text
 
 
+# The binary model format, see NGramModel.to_binary_file
+BINARY_MAGIC = b'TCNGRAM1'
+BINARY_HEADER = b'<8sII'
+
+
+def encode_grams(grams):
+    """Return grams utf-8 encoded in a numpy array
+
+    Looking the same n-grams up in several NGramTables is faster with
+    the array than with the list.
+
+    """
+    encoded = [gram.encode('utf-8') for gram in grams]
+    return numpy.array(encoded,
+                       dtype='S{}'.format(max([len(gram) for gram in encoded]
+                                              or [1])))
+
+
+class NGramTable(object):
+    """A read only mapping from n-grams to numbers, kept in numpy arrays
+
+    grams is a sorted array of utf-8 encoded n-grams, numbers holds the
+    rank or frequency of each of them. The arrays are usually views of a
+    memory mapped binary model file, see NGramModel.of_binary_file.
+
+    """
+    def __init__(self, grams, numbers):
+        self.grams = grams
+        self.numbers = numbers
+
+    def positions(self, grams):
+        """Return the positions of grams in self.grams, -1 for the grams
+        that are not in the table
+
+        grams is a list of n-grams, or an array made by encode_grams.
+
+        """
+        if not isinstance(grams, numpy.ndarray):
+            grams = encode_grams(grams)
+        if len(self.grams) == 0:
+            return numpy.full(len(grams), -1, dtype=numpy.intp)
+
+        fits = None
+        if grams.itemsize > self.grams.itemsize:
+            # Grams wider than the table are not in it, but would be
+            # found truncated
+            fits = numpy.char.str_len(grams) <= self.grams.itemsize
+            grams = grams.astype(self.grams.dtype)
+        positions = numpy.minimum(numpy.searchsorted(self.grams, grams),
+                                  len(self.grams) - 1)
+        found = self.grams[positions] == grams
+        if fits is not None:
+            found &= fits
+
+        return numpy.where(found, positions, -1)
+
+    def position(self, gram):
+        """Return the position of gram in self.grams, -1 if it is not in
+        the table
+
+        A single gram is looked up faster than with positions.
+
+        """
+        encoded = gram.encode('utf-8')
+        if len(encoded) <= self.grams.itemsize:
+            position = self.grams.searchsorted(encoded)
+            if position < len(self.grams) and \
+                    self.grams[position] == encoded:
+                return position
+        return -1
+
+    def __len__(self):
+        return len(self.grams)
+
+    def __contains__(self, gram):
+        return self.position(gram) >= 0
+
+    def __getitem__(self, gram):
+        position = self.position(gram)
+        if position < 0:
+            raise KeyError(gram)
+        return int(self.numbers[position])
+
+    def get(self, gram, default=None):
+        try:
+            return self[gram]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return (gram.decode('utf-8') for gram in self.grams)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return self.numbers.tolist()
+
+    def iteritems(self):
+        return itertools.izip(self, self.numbers.tolist())
+
+    def items(self):
+        return list(self.iteritems())
+
+
 class NGramModel(object):
     SPLITCHARS = re.compile(
         r"[][}{)(>< \n\t:;!.?_,¶§%&£€$¹°½¼¾©←→▪➢√|#–‒…·•@~\\/”“«»\"0-9=*+‑-]")
     NB_NGRAMS = 400
     MISSING_VALUE = 400
+    # The number of lines of a text file that are counted together
+    CHUNK_LINES = 10000
 
     def __init__(self, arg={}, lang='input'):
         self.lang = lang        # for debugging
@@ -95,6 +219,68 @@ class NGramModel(object):
         raise NotImplementedError(
             "You have to subclass and override of_model_file")
 
+    def of_binary_file(self, fname):
+        """Read a model written by to_binary_file
+
+        The file is mapped into memory, so all the processes that read
+        the same model file share one copy of it. self.ngrams and
+        self.freq are read only NGramTables of the ranks and the
+        frequencies.
+
+        """
+        with open(fname, 'rb') as fil:
+            buf = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, width = struct.unpack_from(BINARY_HEADER, buf)
+        if magic != BINARY_MAGIC:
+            raise ValueError("{} is not a binary model file".format(fname))
+
+        grams_end = struct.calcsize(BINARY_HEADER) + count * width
+        ranks_start = grams_end + -grams_end % 8
+        ranks_end = ranks_start + count * 4
+        freqs_start = ranks_end + -ranks_end % 8
+        grams = numpy.frombuffer(buf, dtype='S{}'.format(width),
+                                 count=count,
+                                 offset=struct.calcsize(BINARY_HEADER))
+        self.ngrams = NGramTable(
+            grams,
+            numpy.frombuffer(buf, dtype='<i4', count=count,
+                             offset=ranks_start))
+        self.freq = NGramTable(
+            grams,
+            numpy.frombuffer(buf, dtype='<i8', count=count,
+                             offset=freqs_start))
+        return self
+
+    def to_binary_file(self, fil):
+        """Write the model in the binary format that of_binary_file reads
+
+        The format is a header with BINARY_MAGIC, the number of n-grams
+        and the width of the string table, followed by the string table,
+        the n-grams utf-8 encoded, zero padded to the width and sorted,
+        then their ranks as int32 and their frequencies as int64. The
+        arrays start at multiples of 8 bytes.
+
+        """
+        # Looking the n-grams of a loaded model up one by one is slow
+        ngrams = dict(self.ngrams.iteritems())
+        freq = dict(self.freq.iteritems())
+        encoded = [gram.encode('utf-8') for gram in ngrams]
+        width = max([len(gram) for gram in encoded] or [1])
+        grams = numpy.array(encoded, dtype='S{}'.format(width))
+        order = numpy.argsort(grams, kind='mergesort')
+        ranks = numpy.array([ngrams[gram] for gram in ngrams], dtype='<i4')
+        freqs = numpy.array([freq[gram] for gram in ngrams], dtype='<i8')
+
+        data = struct.pack(BINARY_HEADER, BINARY_MAGIC, len(encoded), width)
+        for array in (grams[order], ranks[order], freqs[order]):
+            data += b'\0' * (-len(data) % 8) + array.tostring()
+        fil.write(data)
+
+    @staticmethod
+    def is_binary_file(fname):
+        with open(fname, 'rb') as fil:
+            return fil.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
     def freq_of_model_file(self, fil, fname, gram_column, freq_column):
         freq = {}
         for nl, strline in enumerate(fil.readlines()):
@@ -118,23 +304,61 @@ class NGramModel(object):
         on the input text; this includes whitespace (like byte order
         marks) that might not all be in SPLITCHARS
 
+        Joining the whitespace separated parts with a space, which is
+        one of the SPLITCHARS, gives the same tokens in one split.
+
         """
-        tokens = (re.split(self.SPLITCHARS, t)
-                  for t in text.split())
-        return sum(tokens, [])  # flatten
+        parts = text.split()
+        if not parts:
+            return []
+        return self.SPLITCHARS.split(' '.join(parts))
+
+    def count_words(self, text, counts, words):
+        """Count the tokens of text in counts, appending the tokens that
+        were not seen before to words, so that words keeps the order in
+        which they were first seen.
+
+        """
+        for word in self.tokenise(text):
+            if word in counts:
+                counts[word] += 1
+            else:
+                counts[word] = 1
+                words.append(word)
 
     def freq_of_text(self, text, freq):
-        """This should update freq and return it."""
+        """Update freq with the n-grams of text and return it."""
+        counts = {}
+        words = []
+        self.count_words(text, counts, words)
+        return self.freq_of_words(words, counts, freq)
+
+    def freq_of_words(self, words, counts, freq):
+        """Update freq with the n-grams of words, where each word occurs
+        counts[word] times, and return it.
+
+        The words are visited in the order they were first seen, so the
+        n-grams are added to freq in the same order as when going
+        through the text token by token.
+
+        """
         raise NotImplementedError(
-            "You have to subclass and override freq_of_text")
+            "You have to subclass and override freq_of_words")
 
     def to_model_file(self, fil, fname):
         raise NotImplementedError(
             "You have to subclass and override to_model_file")
 
     def freq_of_text_file(self, fil):
+        """The words of CHUNK_LINES lines are counted before their n-grams
+        are added to freq, so that the n-grams of a word are only made
+        once per chunk.
+
+        """
         freq = {}
-        for nl, strline in enumerate(fil.readlines()):
+        counts = {}
+        words = []
+        for nl, strline in enumerate(fil):
             try:
                 line = strline.decode('utf-8')
             except UnicodeDecodeError as e:
@@ -143,7 +367,12 @@ class NGramModel(object):
                          "(not warning again)".format(nl, e))
                 self.unicode_warned += 1
                 continue
-            freq = self.freq_of_text(line, freq)
+            self.count_words(line, counts, words)
+            if (nl + 1) % self.CHUNK_LINES == 0:
+                freq = self.freq_of_words(words, counts, freq)
+                counts = {}
+                words = []
+        freq = self.freq_of_words(words, counts, freq)
         if self.unicode_warned != 0:
             note("Saw {} UnicodeDecodeErrors".format(self.unicode_warned))
         return freq
@@ -162,10 +391,10 @@ class NGramModel(object):
             gram: freq[gram]
             for gram in self.ngrams
         }
-        self.ngramskeyset = set(self.ngrams.keys())
 
     def compare(self, unknown):
-        missing_count = len(unknown.ngramskeyset - self.ngramskeyset)
+        missing_count = sum(1 for gram in unknown.ngrams
+                            if gram not in self.ngrams)
         d_missing = self.MISSING_VALUE * missing_count
         d_found = sum(
             abs(rank - self.ngrams[gram])
@@ -188,17 +417,21 @@ class CharModel(NGramModel):
                          if g != ''])
         fil.write(lines.encode('utf-8'))
 
-    def freq_of_text(self, text, freq):
-        words = self.tokenise(text)
+    @staticmethod
+    def grams_of_word(word):
+        """Return the 1-4 grams of word padded with _, in text order"""
+        _word_ = '_'+word+'_'
+        size = len(_word_)
+        return [_word_[i:i+s]
+                for i in xrange(size)
+                for s in (1, 2, 3, 4)
+                if i+s <= size]
+
+    def freq_of_words(self, words, counts, freq):
         for word in words:
-            _word_ = '_'+word+'_'
-            size = len(_word_)
-            for i in range(size):
-                for s in (1, 2, 3, 4):
-                    sub = _word_[i:i+s]
-                    freq[sub] = freq.get(sub, 0) + 1
-                    if i+s >= size:
-                        break
+            count = counts[word]
+            for sub in self.grams_of_word(word):
+                freq[sub] = freq.get(sub, 0) + count
         return freq
 
 
@@ -217,14 +450,22 @@ class WordModel(NGramModel):
                          if g != ''])
         fil.write(lines.encode('utf-8'))
 
-    def freq_of_text(self, text, freq):
-        words = self.tokenise(text)
+    def freq_of_words(self, words, counts, freq):
         for word in words:
-            freq[word] = freq.get(word, 0) + 1
+            freq[word] = freq.get(word, 0) + counts[word]
         return freq
 
     def finish(self, freq):
         super(WordModel, self).finish(freq)
+        self.finish_invrank()
+
+    def finish_invrank(self):
+        """compare_tc only needs the squared inverted ranks
+
+        They are a dict like self.ngrams, or an array in the order of
+        the n-grams of a binary model.
+
+        """
         # See text_cat.pl line 642ff; we invert and normalise the
         # ranking to make it possible to use compare_tc where one wm
         # is shorter than the other, e.g. if there is only a small
@@ -232,10 +473,22 @@ class WordModel(NGramModel):
         # words:
         n_words = len(self.ngrams)
         normaliser = float(n_words) / float(self.NB_NGRAMS)
-        self.invrank = {
-            gram: ((n_words - rank) / normaliser)
-            for gram, rank in self.ngrams.iteritems()
-        }
+        if isinstance(self.ngrams, NGramTable):
+            # Square with python floats, numpy's x*x may round
+            # differently from python's x**2
+            self.invrank2 = numpy.array(
+                [((n_words - rank) / normaliser)**2
+                 for rank in self.ngrams.values()])
+        else:
+            self.invrank2 = {
+                gram: ((n_words - rank) / normaliser)**2
+                for gram, rank in self.ngrams.iteritems()
+            }
+
+    def of_binary_file(self, fname):
+        super(WordModel, self).of_binary_file(fname)
+        self.finish_invrank()
+        return self
 
     def compare_tc(self, unknown_text, normaliser):
         """Implements line 442 of text_cat.pl, where `normaliser` is
@@ -245,23 +498,285 @@ class WordModel(NGramModel):
         if normaliser <= 0:
             return normaliser
         else:
-            unknown_freq = self.freq_of_text(unknown_text, {})
+            return self.compare_tc_freq(self.freq_of_text(unknown_text, {}),
+                                        normaliser)
+
+    def compare_tc_freq(self, unknown_freq, normaliser):
+        """Like compare_tc, but with the word frequencies of the unknown
+        text already counted
+
+        This is a sparse dot product of unknown_freq and invrank2, only
+        the words of the unknown text are looked up.
+
+        """
+        return self.sum_tc(self.invrank2_many(unknown_freq.keys()),
+                           unknown_freq.values(), normaliser)
+
+    def invrank2_many(self, words, encoded=None):
+        """Return the squared inverted rank of each of words, None for
+        the words that are not in the model
+
+        encoded may hold words as made by encode_grams, to look the same
+        words up in several binary models without encoding them again.
+
+        """
+        if isinstance(self.ngrams, NGramTable):
+            positions = self.ngrams.positions(
+                words if encoded is None else encoded)
+            found = numpy.flatnonzero(positions >= 0)
+            invrank2s = [None] * len(words)
+            for index, invrank2 in zip(
+                    found.tolist(),
+                    self.invrank2[positions[found]].tolist()):
+                invrank2s[index] = invrank2
+            return invrank2s
+        else:
+            return [self.invrank2.get(word) for word in words]
+
+    @staticmethod
+    def sum_tc(invrank2s, freqs, normaliser):
+        """Sum the terms of compare_tc for words with the squared inverted
+        ranks invrank2s and the frequencies freqs
+
+        The terms are computed and summed in the same order as
+        text_cat.pl does, so that the scores don't change with rounding.
+
+        """
+        if normaliser <= 0:
+            return normaliser
+        else:
             return (
                 sum(
-                    self.invrank[word]**2 * unknown_freq[word] * 100 / normaliser
+                    invrank2 * freq * 100 / normaliser
 
-                    for word in unknown_freq.keys()
-                    if word in self.ngrams
+                    for invrank2, freq in zip(invrank2s, freqs)
+                    if invrank2 is not None
                 )
             )
 
 
+class CharModelTable(object):
+    """Score an input profile against several character models at once
+
+    The n-grams of all the models are collected in one vocabulary, and
+    the rank of each n-gram in each model is kept in a row of a numpy
+    array, with MISSING marking the n-grams that are not in a model.
+    The scores are the same as those of CharModel.compare. Without
+    numpy, each model is compared in turn.
+
+    """
+    MISSING = -1
+
+    def __init__(self, models):
+        self.models = models
+        self.langs = sorted(models.keys())
+        self.rows = {lang: row for row, lang in enumerate(self.langs)}
+        self.vocabulary = {}
+        for lang in self.langs:
+            for gram in models[lang].ngrams:
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+
+        if numpy is not None:
+            self.ranks = numpy.full(
+                (len(self.langs), len(self.vocabulary)), self.MISSING,
+                dtype=numpy.int32)
+            for lang in self.langs:
+                ngrams = models[lang].ngrams
+                columns = [self.vocabulary[gram] for gram in ngrams]
+                self.ranks[self.rows[lang], columns] = ngrams.values()
+
+    def scores(self, unknown, langs):
+        """Return a dict with the distance from unknown to each language
+        in langs
+
+        """
+        return self.scores_many([unknown], langs)[0]
+
+    def scores_many(self, unknowns, langs):
+        """Return a list with a dict of distances to the languages in langs
+        for each of the unknown models
+
+        All the input profiles are scored in one go: their columns are
+        concatenated, and the distances of each profile are summed from
+        the running totals of the distance array.
+
+        """
+        if numpy is None:
+            return [{lang: self.models[lang].compare(unknown)
+                     for lang in langs}
+                    for unknown in unknowns]
+
+        columns = []
+        input_ranks = []
+        ends = []
+        outside = []
+        for unknown in unknowns:
+            missing = 0
+            for gram, rank in unknown.ngrams.iteritems():
+                column = self.vocabulary.get(gram)
+                if column is None:
+                    missing += 1
+                else:
+                    columns.append(column)
+                    input_ranks.append(rank)
+            ends.append(len(columns))
+            outside.append(missing)
+
+        rows = [self.rows[lang] for lang in langs]
+        ranks = self.ranks[numpy.ix_(rows, columns)]
+        distances = numpy.where(
+            ranks == self.MISSING,
+            NGramModel.MISSING_VALUE,
+            numpy.abs(ranks - numpy.array(input_ranks, dtype=numpy.int32)))
+        running = numpy.zeros((len(rows), len(columns) + 1),
+                              dtype=numpy.int64)
+        numpy.cumsum(distances, axis=1, out=running[:, 1:])
+        ends = numpy.array(ends, dtype=numpy.intp)
+        starts = numpy.concatenate(([0], ends[:-1]))
+        totals = (running[:, ends] - running[:, starts] +
+                  NGramModel.MISSING_VALUE * numpy.array(outside))
+
+        return [{lang: int(total) for lang, total in zip(langs, column)}
+                for column in totals.T]
+
+
+class ModelCache(object):
+    """Keep the compiled models of a model directory as binary files
+
+    Parsing the .lm and .wm files is slow. So the models are compiled to
+    the binary format of NGramModel.to_binary_file, which loads much
+    faster, and kept in a directory next to the model directory. A cached
+    model is only used if the model file it was compiled from has the
+    same sha1 as when it was cached.
+
+    """
+    def __init__(self, folder):
+        self.directory = os.path.normpath(folder) + '.cache'
+        self.digests = {}
+
+    @staticmethod
+    def digest(fname):
+        with open(fname, 'rb') as fil:
+            return hashlib.sha1(fil.read()).hexdigest()
+
+    def load(self, fname, Model, lang='input'):
+        """Return the model in fname, compiling it only if needed
+
+        Failing to write the cache is not an error, the model directory
+        may well be read only.
+
+        """
+        digest = self.digest(fname)
+        self.digests[fname] = digest
+        basename = os.path.basename(fname)
+        cached = os.path.join(self.directory,
+                              '{}.{}'.format(basename, digest))
+        if os.path.exists(cached):
+            return Model(lang=lang).of_binary_file(cached)
+
+        model = Model(lang=lang).of_model_file(open(fname, 'r'), fname)
+        tmpname = '{}.{}'.format(cached, os.getpid())
+        try:
+            if os.path.isfile(self.directory):
+                # The cache of older versions was a single file
+                os.remove(self.directory)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for old in glob.glob(os.path.join(self.directory,
+                                              basename + '.*')):
+                if not old.startswith(cached):
+                    os.remove(old)
+            with open(tmpname, 'wb') as binary:
+                model.to_binary_file(binary)
+            os.rename(tmpname, cached)
+        except (IOError, OSError):
+            return model
+
+        return Model(lang=lang).of_binary_file(cached)
+
+
+class ResultCache(object):
+    """Remember the ranked results of Classifier.classify_many_full
+
+    This is a LRU cache of at most size results. The keys are made by
+    the Classifier from the normalised text, the candidate languages,
+    the drop ratio and the version of the models, so a result is never
+    used with other models than the ones that made it. If filename is
+    given, the cache is read from it, and save writes it back.
+
+    """
+    VERSION = 1
+
+    def __init__(self, size=10000, filename=None):
+        self.size = size
+        self.filename = filename
+        self.entries = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+        if filename is not None:
+            try:
+                with open(filename, 'rb') as cache:
+                    version, entries = marshal.load(cache)
+                if version == self.version() and size > 0:
+                    self.entries.update(entries[-size:])
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+
+    @classmethod
+    def version(cls):
+        return (cls.VERSION, ) + tuple(sys.version_info[:2])
+
+    def get(self, key):
+        """Return the result for key, or None if it is not cached"""
+        try:
+            result = self.entries.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.entries[key] = result
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def update(self, other):
+        """Add the results of the cache other as the most recently used"""
+        for key, result in other.entries.iteritems():
+            self.entries.pop(key, None)
+            self.put(key, result)
+
+    def save(self):
+        """Write the cache to filename, if it was given"""
+        if self.filename is not None:
+            tmpname = '{}.{}'.format(self.filename, os.getpid())
+            try:
+                with open(tmpname, 'wb') as cache:
+                    marshal.dump((self.version(), self.entries.items()),
+                                 cache)
+                os.rename(tmpname, self.filename)
+            except (IOError, OSError):
+                pass
+
+
 class Classifier(object):
     DROP_RATIO = 1.10
 
-    def __init__(self, folder=None, langs=[], verbose=False):
+    def __init__(self, folder=None, langs=[], verbose=False, use_cache=True,
+                 result_cache_size=10000, result_cache_file=None):
+        """The results of the last result_cache_size texts are remembered,
+        see ResultCache.
+
+        """
         if folder is None:
             folder = os.path.join(here, 'lm')
+        if use_cache and numpy is not None:
+            cache = ModelCache(folder)
+        else:
+            cache = None
         self.cmodels = {}
         self.wmodels = {}
 
@@ -282,28 +797,61 @@ class Classifier(object):
                 raise ValueError(
                     "Unknown language(s): " + ", ".join(not_found))
 
+        model_files = []
         for fname in fnames:
             lang = util.basename_noext(fname, ext)
-            self.cmodels[lang] = CharModel(lang).of_model_file(
-                open(fname, 'r'), fname)
+            self.cmodels[lang] = self.load_model(fname, CharModel, lang,
+                                                 cache)
+            model_files.append(fname)
             if verbose:
                 note("Loaded %s" % (fname,))
 
             fname_wm = os.path.join(folder, lang+'.wm')
             # fname_wmgz = os.path.join(folder, lang+'.wm.gz')
             if os.path.exists(fname_wm):
-                self.wmodels[lang] = WordModel(lang).of_model_file(
-                    open(fname_wm, 'r'), fname_wm)
+                self.wmodels[lang] = self.load_model(fname_wm, WordModel,
+                                                     lang, cache)
+                model_files.append(fname_wm)
                 if verbose:
                     note("Loaded %s" % (fname_wm,))
             else:
                 self.wmodels[lang] = WordModel(lang).of_freq({})
 
+        self.version = self.models_version(model_files, cache)
+        self.results = ResultCache(result_cache_size, result_cache_file)
+
         if len(self.cmodels) == 0:
             raise ValueError("No character models created!")
         else:
             self.langs = set(self.cmodels.keys())
             self.langs_warned = set()
+            self.ctable = CharModelTable(self.cmodels)
+
+    @staticmethod
+    def load_model(fname, Model, lang, cache=None):
+        """Load a model file, which may be in the binary format"""
+        if NGramModel.is_binary_file(fname):
+            if numpy is None:
+                raise ValueError(
+                    "Reading the binary model {} needs numpy".format(fname))
+            return Model(lang=lang).of_binary_file(fname)
+        elif cache is not None:
+            return cache.load(fname, Model, lang)
+        else:
+            return Model(lang=lang).of_model_file(open(fname, 'r'), fname)
+
+    @staticmethod
+    def models_version(fnames, cache=None):
+        """Return a digest of the model files in fnames"""
+        digest = hashlib.sha1()
+        for fname in sorted(fnames):
+            if cache is not None and fname in cache.digests:
+                file_digest = cache.digests[fname]
+            else:
+                file_digest = ModelCache.digest(fname)
+            digest.update('{}:{}\n'.format(os.path.basename(fname),
+                                            file_digest).encode('utf-8'))
+        return digest.hexdigest()
 
     def get_langs(self, langs=[]):
         if langs == []:
@@ -320,18 +868,102 @@ class Classifier(object):
             return active_langs
 
     def classify_full(self, intext, langs=[], verbose=False):
+        return self.classify_many_full([intext], langs, verbose)[0]
+
+    def classify_many_full(self, intexts, langs=[], verbose=False):
+        """Classify a batch of texts, returning the ranked results of
+        classify_full for each of them
+
+        Results are looked up in, and added to, self.results.
+
+        The character models of all the texts are scored together, the
+        word models are only used for the texts where the character
+        models are too close to call.
+
+        """
         active_langs = self.get_langs(langs)
+        candidates = [l for l in self.cmodels if l in active_langs]
+        key = (tuple(sorted(candidates)), self.DROP_RATIO, self.version)
+
+        # The models only see the whitespace separated tokens, so texts
+        # that only differ in whitespace get the same result. Each
+        # distinct text that is not in self.results is classified once.
+        results = [None] * len(intexts)
+        unknown = collections.OrderedDict()
+        for i, intext in enumerate(intexts):
+            text = ' '.join(ensure_unicode(intext).split())
+            result = None if verbose else self.results.get((text, ) + key)
+            if result is None:
+                unknown.setdefault(text, []).append(i)
+            else:
+                results[i] = list(result)
+
+        texts = unknown.keys()
+        ingrams = [CharModel().of_text(text) for text in texts]
+        cscores = [{l: score[l] for l in candidates}
+                   for score in self.ctable.scores_many(ingrams, candidates)]
+        wscores = self.word_scores_many(texts, cscores)
 
-        text = ensure_unicode(intext)
-        ingram = CharModel().of_text(text)
+        for text, cscored, wscored in zip(texts, cscores, wscores):
+            result = self.rank(text, cscored, wscored, verbose)
+            self.results.put((text, ) + key, result)
+            for i in unknown[text]:
+                results[i] = list(result)
 
-        cscored = {l: model.compare(ingram)
-                   for l, model in self.cmodels.iteritems()
-                   if l in active_langs}
+        return results
+
+    def close_langs(self, cscored):
+        """Return the languages whose character model scores are too
+        close to the best one to decide between them
+
+        """
         cranked = util.sort_by_value(cscored)
         cbest = cranked[0]
-        cfiltered = {l: d for l, d in cranked
-                     if d <= cbest[1] * self.DROP_RATIO}
+        return {l: d for l, d in cranked
+                if d <= cbest[1] * self.DROP_RATIO}
+
+    def word_scores_many(self, texts, cscores):
+        """Score texts against the word models of their close languages
+
+        Returns a dict from language to word model score for each text,
+        or None where the character models decide alone. Along with
+        compare_tc, implements text_cat.pl line 442 and on. The words of
+        a text are only counted once for all the candidate languages,
+        and each word model looks up the words of all the texts at once.
+
+        """
+        wscores = [None] * len(texts)
+        batches = collections.defaultdict(list)
+        vocabulary = {}
+        for i, (text, cscored) in enumerate(zip(texts, cscores)):
+            cfiltered = self.close_langs(cscored)
+            if len(cfiltered) > 1:
+                unknown_freq = WordModel().freq_of_text(text, {})
+                columns = [vocabulary.setdefault(word, len(vocabulary))
+                           for word in unknown_freq]
+                wscores[i] = {}
+                for l in cfiltered:
+                    if l in self.wmodels:
+                        batches[l].append((i, unknown_freq, columns))
+
+        words = sorted(vocabulary, key=vocabulary.get)
+        encoded = encode_grams(words) if numpy is not None else None
+        for l, batch in batches.iteritems():
+            invrank2s = self.wmodels[l].invrank2_many(words, encoded)
+            for i, unknown_freq, columns in batch:
+                wscores[i][l] = WordModel.sum_tc(
+                    [invrank2s[column] for column in columns],
+                    unknown_freq.itervalues(), cscores[i][l])
+
+        return wscores
+
+    def rank(self, text, cscored, wscores, verbose=False):
+        """Rank the languages of text, given the character model scores
+        and the word model scores of word_scores_many
+
+        """
+        cranked = util.sort_by_value(cscored)
+        cfiltered = self.close_langs(cscored)
 
         if len(cfiltered) <= 1:
             if verbose:
@@ -339,10 +971,8 @@ class Classifier(object):
                     cfiltered, text))
             return list(cfiltered.iteritems())
         else:
-            # Along with compare_tc, implements text_cat.pl line
-            # 442 and on:
-            wscored = {l: model.compare_tc(text, cscored[l])
-                       for l, model in self.wmodels.iteritems()
+            wscored = {l: wscores[l]
+                       for l in self.wmodels
                        if l in cfiltered}
             cwcombined = {l: (cscored[l] - wscore)
                           for l, wscore in wscored.iteritems()}
@@ -361,40 +991,169 @@ class Classifier(object):
     def classify(self, text, langs=[], verbose=False):
         return self.classify_full(text, langs, verbose)[0][0]
 
+    def classify_many(self, texts, langs=[], verbose=False):
+        """Return the best language of each of the texts"""
+        return [ranked[0][0]
+                for ranked in self.classify_many_full(texts, langs, verbose)]
+
+
+def find_corpora(folder, exts):
+    """Return (lang, fname) of the corpus files in folder"""
+    corpora = []
+    for ext in exts:
+        files = glob.glob(os.path.normcase(os.path.join(folder, '*'+ext)))
+        for fname in files:
+            corpora.append((util.basename_noext(fname, ext), fname))
+
+    if len(corpora) == 0:
+        raise Exception(
+            "No suitable files found matching {}/*.{}{}{}!".format(
+                folder, "{", ",".join(exts), "}"))
+
+    return corpora
+
+
+def open_corpus(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    else:
+        return open(fname, 'r')
+
+
+def shard_lines(fname, start, end):
+    """Yield the lines of fname that start in the byte range [start, end)
+
+    Gzipped files can't be sought, so they are only read as one shard.
+
+    """
+    with open_corpus(fname) as fil:
+        pos = 0
+        if start > 0:
+            fil.seek(start - 1)
+            # Skip the line that started in the previous shard
+            pos = start - 1 + len(fil.readline())
+        while end is None or pos < end:
+            line = fil.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def count_shard(shard):
+    """Count the words of a shard of a corpus file, see FolderCounter
+
+    This is run in the worker processes, so it has to be a module level
+    function.
+
+    """
+    fname, start, end = shard
+    model = NGramModel()
+    counts = {}
+    words = []
+    for strline in shard_lines(fname, start, end):
+        try:
+            line = strline.decode('utf-8')
+        except UnicodeDecodeError:
+            model.unicode_warned += 1
+            continue
+        model.count_words(line, counts, words)
+
+    return words, counts, model.unicode_warned
+
+
+class FolderCounter(object):
+    """Count the words of the corpora in a folder in worker processes
+
+    Each corpus is split in shards of about SHARD_SIZE bytes, so that a
+    large corpus is counted by several workers. The workers stream
+    their shard and only return the word counts, which are merged in
+    shard order. The models are made from the merged counts with
+    freq_of_words, which gives the same frequency tables as training
+    on one file at a time.
+
+    """
+    SHARD_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, folder, exts=['.txt', '.txt.gz'], jobs=None,
+                 verbose=False):
+        self.counts = {}
+
+        corpora = find_corpora(folder, exts)
+        shards = []
+        for lang, fname in corpora:
+            shards.extend(self.shards(fname))
+        if verbose:
+            note("Counting {} shards of {} files in {} processes".format(
+                len(shards), len(corpora), jobs or multiprocessing.cpu_count()))
+
+        file_counts = {}
+        pool = multiprocessing.Pool(processes=jobs)
+        try:
+            results = pool.imap(count_shard, shards)
+            for (fname, start, end), (words, counts, unicode_errors) in \
+                    itertools.izip(shards, results):
+                if unicode_errors != 0:
+                    note("Saw {} UnicodeDecodeErrors in {}".format(
+                        unicode_errors, fname))
+                all_words, all_counts = file_counts.setdefault(fname,
+                                                               ([], {}))
+                for word in words:
+                    if word in all_counts:
+                        all_counts[word] += counts[word]
+                    else:
+                        all_counts[word] = counts[word]
+                        all_words.append(word)
+            pool.close()
+        finally:
+            pool.terminate()
+
+        for lang, fname in corpora:
+            self.counts[lang] = file_counts[fname]
+
+    @classmethod
+    def shards(cls, fname):
+        """Return (fname, start, end) of the shards of fname"""
+        if fname.endswith('.gz'):
+            return [(fname, 0, None)]
+
+        size = os.path.getsize(fname)
+        starts = range(0, size, cls.SHARD_SIZE) or [0]
+        ends = starts[1:] + [None]
+        return [(fname, start, end) for start, end in zip(starts, ends)]
+
 
 class FolderTrainer(object):
     def __init__(self, folder, exts=['.txt', '.txt.gz'], Model=CharModel,
-                 verbose=False):
+                 verbose=False, counter=None):
+        """If counter is a FolderCounter, the models are made from its
+        word counts instead of by reading the corpora in this process.
+
+        """
         self.models = {}
 
-        for ext in exts:
-            files = glob.glob(os.path.normcase(os.path.join(folder, '*'+ext)))
-            for fname in files:
-                if verbose:
-                    msg = "Processing %s" % (fname,)
-                    if os.path.getsize(fname) > 5000000:
-                        msg += " (this may take a while)"
-                    note(msg)
-                    sys.stderr.flush()
-                lang = util.basename_noext(fname, ext)
-                self.models[lang] = Model(lang).of_text_file(
-                    self.open_corpus(fname))
-
-        if len(self.models) == 0:
-            raise Exception(
-                "No suitable files found matching {}/*.{}{}{}!".format(
-                    folder, "{", ",".join(exts), "}"))
-
-    def open_corpus(self, fname):
-        if fname.endswith('.gz'):
-            return gzip.open(fname, 'rb')
-        else:
-            return open(fname, 'r')
+        if counter is not None:
+            for lang, (words, counts) in counter.counts.iteritems():
+                self.models[lang] = Model(lang).of_freq(
+                    Model().freq_of_words(words, counts, {}))
+            return
 
-    def save(self, folder, ext='.lm', verbose=False):
+        for lang, fname in find_corpora(folder, exts):
+            if verbose:
+                msg = "Processing %s" % (fname,)
+                if os.path.getsize(fname) > 5000000:
+                    msg += " (this may take a while)"
+                note(msg)
+                sys.stderr.flush()
+            self.models[lang] = Model(lang).of_text_file(open_corpus(fname))
+
+    def save(self, folder, ext='.lm', verbose=False, binary=False):
         for lang, model in self.models.iteritems():
             fname = os.path.join(folder, lang+ext)
-            model.to_model_file(open(fname, 'w'))
+            if binary:
+                model.to_binary_file(open(fname, 'wb'))
+            else:
+                model.to_model_file(open(fname, 'w'))
         if verbose and len(self.models) != 0:
             note("Wrote {%s}%s" % (",".join(self.models.keys()), ext))
 
@@ -403,32 +1162,214 @@ class FileTrainer(object):
     def __init__(self, fil, Model=CharModel, verbose=False):
         self.model = Model().of_text_file(fil)
 
-    def save(self, fil, verbose=False):
-        self.model.to_model_file(fil)
+    def save(self, fil, verbose=False, binary=False):
+        if binary:
+            self.model.to_binary_file(fil)
+        else:
+            self.model.to_model_file(fil)
+
+
+class Benchmark(object):
+    """Measure the accuracy and speed of a Classifier on held out text
+
+    Every holdout_every'th line of at least min_length characters of the
+    corpora in corp_dir is a test paragraph, labelled with the language
+    of its corpus. If train is True, models are trained on the other
+    lines, so that the test paragraphs are really unseen; otherwise the
+    models in model_dir are used.
+
+    """
+    def __init__(self, corp_dir, model_dir=None, holdout_every=10,
+                 min_length=20, max_paragraphs=1000, train=False,
+                 langs=[], drop_ratio=None, use_cache=True, verbose=False):
+        """use_cache must be False if the NB_NGRAMS were changed, the
+        cached models have the default number of n-grams.
+
+        """
+        self.corp_dir = corp_dir
+        self.model_dir = model_dir
+        self.holdout_every = holdout_every
+        self.min_length = min_length
+        self.max_paragraphs = max_paragraphs
+        self.train = train
+        self.langs = langs
+        self.drop_ratio = drop_ratio
+        self.use_cache = use_cache
+        self.verbose = verbose
+
+    def split(self, tmpdir=None):
+        """Return a list of (lang, paragraph) held out from the corpora
+
+        If tmpdir is given, the other lines are written to a corpus file
+        there for each language.
+        """
+        paragraphs = []
+        for lang, fname in sorted(find_corpora(self.corp_dir,
+                                               ['.txt', '.txt.gz'])):
+            if self.langs and lang not in self.langs:
+                continue
+            training = None
+            if tmpdir is not None:
+                training = open(os.path.join(tmpdir, lang + '.txt'), 'w')
+            held_out = 0
+            candidates = 0
+            for strline in open_corpus(fname):
+                try:
+                    line = strline.decode('utf-8').strip()
+                except UnicodeDecodeError:
+                    continue
+                if len(line) >= self.min_length:
+                    candidates += 1
+                    if (candidates % self.holdout_every == 0 and
+                            held_out < self.max_paragraphs):
+                        paragraphs.append((lang, line))
+                        held_out += 1
+                        continue
+                if training is not None:
+                    training.write(strline)
+            if training is not None:
+                training.close()
+
+        return paragraphs
+
+    def run(self):
+        """Return the results as a dict that can be dumped as JSON"""
+        tmpdir = None
+        try:
+            model_dir = self.model_dir
+            if self.train:
+                tmpdir = tempfile.mkdtemp()
+                model_dir = os.path.join(tmpdir, 'lm')
+                os.mkdir(model_dir)
+                paragraphs = self.split(tmpdir)
+                start = time.time()
+                for Model, ext in [(CharModel, '.lm'), (WordModel, '.wm')]:
+                    FolderTrainer(tmpdir, exts=['.txt'], Model=Model,
+                                  verbose=self.verbose).save(model_dir, ext)
+                train_time = time.time() - start
+            else:
+                paragraphs = self.split()
+                train_time = None
+
+            start = time.time()
+            classifier = Classifier(model_dir, langs=self.langs,
+                                    use_cache=self.use_cache and
+                                    not self.train,
+                                    result_cache_size=0)
+            load_time = time.time() - start
+            if self.drop_ratio is not None:
+                classifier.DROP_RATIO = self.drop_ratio
+
+            start = time.time()
+            guesses = classifier.classify_many(
+                [paragraph for lang, paragraph in paragraphs])
+            classify_time = time.time() - start
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir)
+
+        confusion = {}
+        for (lang, paragraph), guess in zip(paragraphs, guesses):
+            row = confusion.setdefault(lang, {})
+            row[guess] = row.get(guess, 0) + 1
+        correct = sum(row.get(lang, 0) for lang, row in confusion.items())
+
+        return {
+            'parameters': {
+                'corp_dir': self.corp_dir,
+                'model_dir': None if self.train else self.model_dir,
+                'trained': self.train,
+                'holdout_every': self.holdout_every,
+                'min_length': self.min_length,
+                'drop_ratio': classifier.DROP_RATIO,
+                'char_ngrams': CharModel.NB_NGRAMS,
+                'word_ngrams': WordModel.NB_NGRAMS,
+                'numpy': numpy is not None,
+            },
+            'paragraphs': len(paragraphs),
+            'accuracy': float(correct) / len(paragraphs) if paragraphs
+            else None,
+            'language_accuracy': {
+                lang: float(row.get(lang, 0)) / sum(row.values())
+                for lang, row in confusion.items()},
+            'confusion': confusion,
+            'train_time': train_time,
+            'load_time': load_time,
+            'classify_time': classify_time,
+            'paragraphs_per_second': len(paragraphs) / classify_time
+            if classify_time > 0 else None,
+            # ru_maxrss is in kilobytes on linux
+            'peak_memory_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def bench(args):
+    langs = [l for l in args.langs.split(",") if l != ""]
+    if args.nb_char_ngrams is not None:
+        CharModel.NB_NGRAMS = args.nb_char_ngrams
+    if args.nb_word_ngrams is not None:
+        WordModel.NB_NGRAMS = args.nb_word_ngrams
+    results = Benchmark(args.corp_dir, args.model_dir,
+                        holdout_every=args.holdout_every,
+                        min_length=args.min_length,
+                        max_paragraphs=args.max_paragraphs,
+                        train=args.train, langs=langs, drop_ratio=args.u,
+                        use_cache=(args.nb_char_ngrams is None and
+                                   args.nb_word_ngrams is None),
+                        verbose=args.verbose).run()
+
+    note("{} paragraphs, {:.1%} correct, {:.0f} paragraphs/s, "
+         "models loaded in {:.2f}s".format(
+             results['paragraphs'], results['accuracy'] or 0,
+             results['paragraphs_per_second'] or 0, results['load_time']))
+    for lang, accuracy in sorted(results['language_accuracy'].items()):
+        note("{}\t{:.1%}\t{}".format(
+            lang, accuracy, pretty_tbl(util.sort_by_value(
+                results['confusion'][lang], reverse=True))))
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
 
 
 def proc(args):
     langs = [l for l in args.langs.split(",") if l != ""]
-    c = Classifier(folder=args.model_dir, langs=langs)
+    c = Classifier(folder=args.model_dir, langs=langs,
+                   result_cache_file=args.result_cache)
     if args.u is not None:
         c.DROP_RATIO = args.u
     if args.verbose:
         note("Drop ratio: {}".format(c.DROP_RATIO))
     if args.s:
-        for line in sys.stdin:
-            print c.classify(line.decode('utf-8'), verbose=args.verbose)
+        # Classify the lines in batches, so that the models are scored
+        # against many lines at a time without reading all of stdin first
+        while True:
+            lines = [line.decode('utf-8')
+                     for line in itertools.islice(sys.stdin, 1000)]
+            if not lines:
+                break
+            for lang in c.classify_many(lines, verbose=args.verbose):
+                print lang
     else:
         print c.classify(sys.stdin.read().decode('utf-8'),
                          verbose=args.verbose)
+    c.results.save()
+    if args.verbose:
+        note("Result cache: {hits} hits, {misses} misses".format(
+            **c.results.stats))
 
 
 def file_comp(args):
     if args.mtype == 'lm':
         FileTrainer(sys.stdin, Model=CharModel, verbose=args.verbose).save(
-            sys.stdout, verbose=args.verbose)
+            sys.stdout, verbose=args.verbose, binary=args.binary)
     elif args.mtype == 'wm':
         FileTrainer(sys.stdin, Model=WordModel, verbose=args.verbose).save(
-            sys.stdout, verbose=args.verbose)
+            sys.stdout, verbose=args.verbose, binary=args.binary)
     else:
         raise util.ArgumentError(
             "This shouldn't happen; mtype should be lm or wm")
@@ -440,10 +1381,18 @@ def folder_comp(args):
     for d in [args.corp_dir, args.model_dir]:
         if not os.path.isdir(d):
             raise util.ArgumentError("{} is not a directory!".format(d))
-    FolderTrainer(args.corp_dir, Model=CharModel, verbose=args.verbose).save(
-        args.model_dir, ext='.lm', verbose=args.verbose)
-    FolderTrainer(args.corp_dir, Model=WordModel, verbose=args.verbose).save(
-        args.model_dir, ext='.wm', verbose=args.verbose)
+    if args.jobs == 1:
+        counter = None
+    else:
+        # Count the words once, both models are made from the counts
+        counter = FolderCounter(args.corp_dir, jobs=args.jobs,
+                                verbose=args.verbose)
+    FolderTrainer(args.corp_dir, Model=CharModel, verbose=args.verbose,
+                  counter=counter).save(
+        args.model_dir, ext='.lm', verbose=args.verbose, binary=args.binary)
+    FolderTrainer(args.corp_dir, Model=WordModel, verbose=args.verbose,
+                  counter=counter).save(
+        args.model_dir, ext='.wm', verbose=args.verbose, binary=args.binary)
 
 
 def parse_options():
@@ -477,6 +1426,11 @@ def parse_options():
                              "between (by default uses all languages in model_dir).",
                              type=str,
                              default="")
+    proc_parser.add_argument('-c', '--result-cache',
+                             help="Remember the results in this file between "
+                             "runs, so that lines that were seen before with "
+                             "the same models are not classified again.",
+                             metavar='FILE')
     proc_parser.set_defaults(func=proc)
 
     complm_parser = subparsers.add_parser(
@@ -484,12 +1438,18 @@ def parse_options():
         help='Compile character model from stdin to stdout.')
     complm_parser.set_defaults(func=file_comp)
     complm_parser.set_defaults(mtype='lm')
+    complm_parser.add_argument('-b', '--binary',
+                               help="Write the binary format.",
+                               action="store_true")
 
     compwm_parser = subparsers.add_parser(
         'compwm',
         help='Compile word model from stdin to stdout.')
     compwm_parser.set_defaults(func=file_comp)
     compwm_parser.set_defaults(mtype='wm')
+    compwm_parser.add_argument('-b', '--binary',
+                               help="Write the binary format.",
+                               action="store_true")
 
     compdir_parser = subparsers.add_parser(
         'compdir',
@@ -498,8 +1458,67 @@ def parse_options():
                                 help='Directory to read corpora (*.txt) from.')
     compdir_parser.add_argument('model_dir',
                                 help='Directory to write LM and WM files in.')
+    compdir_parser.add_argument('-j', '--jobs',
+                                help="The number of processes to count the "
+                                "corpora in. Defaults to the number of cpus, "
+                                "1 trains in this process.",
+                                type=int)
+    compdir_parser.add_argument('-b', '--binary',
+                                help="Write the binary format.",
+                                action="store_true")
     compdir_parser.set_defaults(func=folder_comp)
 
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Measure accuracy and speed on paragraphs held out from a '
+        'corpus directory.')
+    bench_parser.add_argument('corp_dir',
+                              help='Directory to read corpora (*.txt) from.')
+    bench_parser.add_argument('model_dir',
+                              help="Language model directory. Defaults to "
+                              "the directory {}.".format(
+                                  os.path.join(here, 'lm/')),
+                              nargs='?')
+    bench_parser.add_argument('--train',
+                              help="Train models on the lines that are not "
+                              "held out, instead of using model_dir.",
+                              action="store_true")
+    bench_parser.add_argument('--holdout-every',
+                              help="Hold out every Nth line (default 10).",
+                              type=int,
+                              default=10,
+                              metavar='N')
+    bench_parser.add_argument('--min-length',
+                              help="Only hold out lines with at least this "
+                              "many characters (default 20).",
+                              type=int,
+                              default=20)
+    bench_parser.add_argument('--max-paragraphs',
+                              help="Hold out at most this many lines per "
+                              "language (default 1000).",
+                              type=int,
+                              default=1000)
+    bench_parser.add_argument('-u',
+                              help="Drop ratio, see proc -h.",
+                              type=float)
+    bench_parser.add_argument('--nb-char-ngrams',
+                              help="The number of n-grams to keep in the "
+                              "character models.",
+                              type=int)
+    bench_parser.add_argument('--nb-word-ngrams',
+                              help="The number of words to keep in the word "
+                              "models.",
+                              type=int)
+    bench_parser.add_argument('-l', '--langs',
+                              help="Comma-separated list of languages to "
+                              "test (by default all corpora).",
+                              type=str,
+                              default="")
+    bench_parser.add_argument('-o', '--output',
+                              help="Write the JSON results to this file "
+                              "instead of stdout.")
+    bench_parser.set_defaults(func=bench)
+
     return parser.parse_args()
 
 
@@ -20,13 +20,22 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import bisect
 from collections import namedtuple
+from collections import OrderedDict
+import contextlib
 import inspect
 import operator
 import os
 import platform
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+from lxml import etree
 
 PathComponents = namedtuple('PathComponents',
                             'root module lang genre subdirs basename')
@@ -196,6 +205,29 @@ def print_element(element, level, indent, out):
         out.write('{}\n'.format(element.tail.strip().encode('utf8')))
 
 
+def write_xml(xml, filename, xml_declaration=False, encoding='utf8'):
+    '''Write an xml document to filename
+
+    The document is serialised straight into the file, without making
+    a string of the whole document first.
+
+    xml is either a lxml.etree ElementTree, which is written with its
+    write method, or an element. Only the element itself is written,
+    not the doctype or the siblings of the document it belongs to.
+
+    The xml declaration spells encoding the way it is given.
+    '''
+    with open(filename, 'w') as xml_file:
+        if xml_declaration:
+            xml_file.write(
+                "<?xml version='1.0' encoding='{}'?>\n".format(encoding))
+        if hasattr(xml, 'getroot'):
+            xml.write(xml_file, encoding=encoding, pretty_print=True)
+        else:
+            with etree.xmlfile(xml_file, encoding=encoding) as xf:
+                xf.write(xml, pretty_print=True)
+
+
 def name_to_unicode(filename):
     if platform.system() == 'Windows':
         return filename
@@ -203,6 +235,47 @@ def name_to_unicode(filename):
         return filename.decode('utf-8')
 
 
+def kill_after(timeout, processes, killed):
+    '''Kill processes if they are still running after timeout seconds
+
+    killed is a threading.Event that is set when the processes are
+    killed.
+
+    Returns the timer, which should be cancelled when the processes are
+    done, or None if timeout is None
+    '''
+    if timeout is None:
+        return None
+
+    def kill():
+        killed.set()
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+
+    return timer
+
+
+def available_memory():
+    '''Return the memory available to new processes in bytes
+
+    Returns None if it cannot be found out
+    '''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+
+
 class ExternalCommandRunner(object):
     '''Class to run external command through subprocess
 
@@ -212,9 +285,14 @@ class ExternalCommandRunner(object):
         self.stdout = None
         self.stderr = None
         self.returncode = None
+        self.timed_out = False
+
+    def run(self, command, cwd=None, to_stdin=None, timeout=None):
+        '''Run the command, save the result
 
-    def run(self, command, cwd=None, to_stdin=None):
-        '''Run the command, save the result'''
+        If the command is not done within timeout seconds, it is killed
+        and self.timed_out is set.
+        '''
         try:
             subp = subprocess.Popen(command,
                                     stdin=subprocess.PIPE,
@@ -225,5 +303,238 @@ class ExternalCommandRunner(object):
             print('Please install {}'.format(command[0]))
             raise
 
-        (self.stdout, self.stderr) = subp.communicate(to_stdin)
+        killed = threading.Event()
+        timer = kill_after(timeout, [subp], killed)
+        try:
+            (self.stdout, self.stderr) = subp.communicate(to_stdin)
+        finally:
+            if timer is not None:
+                timer.cancel()
         self.returncode = subp.returncode
+        self.timed_out = killed.is_set()
+
+
+class ExternalPipelineRunner(object):
+    '''Class to run a chain of external commands connected by pipes
+
+    The output of each command goes straight into the next one through
+    an OS pipe, so only the output of the last command is held in
+    memory. The outputs of chosen commands are also copied with tee into
+    temporary files.
+
+    Save the output of the last command, the error output and return
+    value of each command, and the copied outputs.
+    '''
+    def __init__(self):
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.tees = None
+        self.timed_out = False
+
+    def run(self, commands, to_stdin=None, tee=(), timeout=None):
+        '''Run the commands, save the result
+
+        tee is a list of the indexes of the commands whose output should
+        be saved in self.tees
+
+        If the commands are not done within timeout seconds, they are
+        killed and self.timed_out is set.
+        '''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            chain = []
+            for i, command in enumerate(commands):
+                chain.append(command)
+                if i in tee:
+                    chain.append(['tee', os.path.join(tmpdir, str(i))])
+
+            processes, errors = self.start(chain)
+
+            killed = threading.Event()
+            timer = kill_after(timeout, processes, killed)
+            writer = threading.Thread(target=self.write_stdin,
+                                      args=(processes[0].stdin, to_stdin))
+            writer.start()
+            try:
+                self.stdout = processes[-1].stdout.read()
+                processes[-1].stdout.close()
+                writer.join()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            self.timed_out = killed.is_set()
+
+            self.returncode = []
+            self.stderr = []
+            for command, process, error in zip(chain, processes, errors):
+                process.wait()
+                error.seek(0)
+                if command[0] != 'tee':
+                    self.returncode.append(process.returncode)
+                    self.stderr.append(error.read())
+                error.close()
+
+            self.tees = {}
+            for i in tee:
+                with open(os.path.join(tmpdir, str(i))) as tee_file:
+                    self.tees[i] = tee_file.read()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @staticmethod
+    def start(chain):
+        '''Start the commands in chain, each reading the output of the
+        previous one
+
+        Returns the processes and the files their error output goes to
+        '''
+        processes = []
+        errors = []
+        for command in chain:
+            errors.append(tempfile.TemporaryFile())
+            try:
+                process = subprocess.Popen(
+                    command,
+                    stdin=(processes[-1].stdout if processes
+                           else subprocess.PIPE),
+                    stdout=subprocess.PIPE,
+                    stderr=errors[-1],
+                    close_fds=True)
+            except OSError:
+                print('Please install {}'.format(command[0]))
+                for process in processes:
+                    process.kill()
+                    process.wait()
+                raise
+            if processes:
+                # Only the next command should read this output, so that
+                # it gets SIGPIPE if that command dies
+                processes[-1].stdout.close()
+            processes.append(process)
+
+        return processes, errors
+
+    @staticmethod
+    def write_stdin(stdin, to_stdin):
+        '''Write to_stdin to the first command of the chain'''
+        try:
+            if to_stdin is not None:
+                stdin.write(to_stdin)
+        except IOError:
+            pass
+        finally:
+            try:
+                stdin.close()
+            except IOError:
+                pass
+
+
+class ResourceRegistry(object):
+    '''Load read only resources lazily, once per process
+
+    A resource is registered by name together with a function that loads
+    it. The resource is loaded the first time it is asked for, and then
+    reused. Call warm before forking worker processes to let them inherit
+    the loaded resources.
+    '''
+    def __init__(self):
+        self.loaders = {}
+        self.resources = {}
+        self.load_count = 0
+
+    def register(self, name, loader):
+        '''Register loader as the function that loads name'''
+        self.loaders[name] = loader
+
+    def get(self, name):
+        '''Return the resource name, loading it if needed'''
+        try:
+            return self.resources[name]
+        except KeyError:
+            resource = self.loaders[name]()
+            self.resources[name] = resource
+            self.load_count += 1
+
+            return resource
+
+    def peek(self, name):
+        '''Return the resource called name if it is loaded, else None'''
+        return self.resources.get(name)
+
+    def warm(self, names=None):
+        '''Load the resources in names, or all registered resources'''
+        if names is None:
+            names = self.loaders.keys()
+        for name in names:
+            self.get(name)
+
+    def clear(self):
+        '''Forget the loaded resources'''
+        self.resources.clear()
+
+
+class Timings(object):
+    '''Accumulate the wall clock time spent in named stages'''
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+        # The time spent in the timers nested in each running timer
+        self.nested = []
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''Time the code run inside the with block as stage
+
+        Time spent in timers nested inside the block only counts for
+        their own stages, so the stages add up to the time spent.
+        '''
+        start = time.time()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.add(stage, seconds - self.nested.pop())
+            if self.nested:
+                self.nested[-1] += seconds
+
+    def add(self, stage, seconds):
+        '''Add seconds to the time spent in stage'''
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+
+class StageHistogram(object):
+    '''Count how often each stage took a given order of magnitude of time'''
+    LIMITS = [0.001, 0.01, 0.1, 1, 10]
+    LABELS = ['<1ms', '<10ms', '<100ms', '<1s', '<10s', '>=10s']
+
+    def __init__(self):
+        self.counts = OrderedDict()
+        self.totals = OrderedDict()
+
+    def add(self, stage, seconds):
+        '''Count one run of stage that took seconds'''
+        if stage not in self.counts:
+            self.counts[stage] = [0] * len(self.LABELS)
+            self.totals[stage] = 0.0
+        self.counts[stage][bisect.bisect(self.LIMITS, seconds)] += 1
+        self.totals[stage] += seconds
+
+    def format(self):
+        '''Format the histogram as a table, one line per stage'''
+        width = max([len('stage')] + [len(stage) for stage in self.counts])
+        lines = ['{:<{width}} {} {:>9}'.format(
+            'stage',
+            ' '.join('{:>7}'.format(label) for label in self.LABELS),
+            'total',
+            width=width)]
+        for stage, counts in self.counts.iteritems():
+            lines.append('{:<{width}} {} {:>8.1f}s'.format(
+                stage,
+                ' '.join('{:>7}'.format(count) for count in counts),
+                self.totals[stage],
+                width=width))
+
+        return '\n'.join(lines)